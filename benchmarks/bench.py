@@ -0,0 +1,231 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tracemalloc
+from time import perf_counter
+from typing import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from Compiler import Compiler
+from Executor import MEMO_SIZE, Executor
+from Parser import Parser
+from Scanner import FastScanner
+from Transpiler import PythonEngine, Transpiler
+from Version import VERSION
+from VM import VM
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+# Phases faster than this are too short to time reliably, so only their
+# memory is compared against the baseline
+NOISE_FLOOR = 0.001
+
+# Scripts run by every engine, in the order they are reported
+SCRIPTS = ['fib', 'nested_loops', 'closures', 'strings']
+# Phases timed for every workload; the synthetic source is only scanned and parsed
+PHASES = ['scan', 'parse', 'execute', 'vm', 'python']
+FRONT_END = ['scan', 'parse']
+
+# Recurses 'n' deep, for finding how deep the tree walker can go before it
+# runs out of Python stack
+DEPTH_SOURCE = 'fun f(n) {{ if n == 0 {{ return 0; }} return f(n - 1) + 1; }}\nf({});\n'
+
+
+def synthetic_source(functions: int = 1500) -> str:
+    # Deterministic, so that every run lexes and parses exactly the same text
+    parts = []
+    for i in range(functions):
+        parts.append(f'fun f{i}(a, b, c) {{\n'
+                     f'    total = (a + {i}.5) * b - c / {i % 7 + 1};\n'
+                     f'    if total >= {i} && !(a == b) || c != {i} {{\n'
+                     f'        total = total % {i % 5 + 2} + (a << 2) - -b;\n'
+                     f'    }} else {{\n'
+                     f'        name = \'f{i}\' + \' calls f{max(i - 1, 0)}\';\n'
+                     f'    }}\n'
+                     f'    while total > 0 {{\n'
+                     f'        total = total - {i % 3 + 1};\n'
+                     f'    }}\n'
+                     f'    return f{max(i - 1, 0)}(a, b - 1, c) + total;\n'
+                     f'}}\n\n')
+    return ''.join(parts)
+
+
+def load_workloads() -> Dict[str, Tuple[str, List[str]]]:
+    workloads = {}
+    for name in SCRIPTS:
+        with open(os.path.join(HERE, name + '.ti'), 'rt') as file:
+            workloads[name] = (file.read(), PHASES)
+    workloads['synthetic'] = (synthetic_source(), FRONT_END)
+    return workloads
+
+
+def prepare(source: str, phase: str) -> Callable[[], Any]:
+    # Returns the work of one phase, with everything it depends on done
+    # beforehand so that only the phase itself is measured. The resolver
+    # annotates the AST in place, so executing needs a fresh tree every time.
+    if phase == 'scan':
+        return lambda: FastScanner().scan_source(source)
+    tokens = FastScanner().scan_source(source)
+    if phase == 'parse':
+        return lambda: Parser().parse(tokens)
+    ast = Parser().parse(tokens)
+    if phase == 'execute':
+        return lambda: Executor().execute(ast)
+    elif phase == 'python':
+        return lambda: PythonEngine().execute(Transpiler().compile(ast))
+    return lambda: VM().execute(Compiler().compile(ast))
+
+
+def measure(source: str, phase: str, warmup: int, repeat: int) -> Dict[str, Any]:
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(warmup + repeat):
+            work = prepare(source, phase)
+            gc.collect()
+            start = perf_counter()
+            work()
+            elapsed = perf_counter() - start
+            if i >= warmup:
+                times.append(elapsed)
+
+        # Measured in a run of its own, as tracing slows everything down
+        work = prepare(source, phase)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            work()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'peak_bytes': peak}
+
+
+def recursion_depth(memo_size: int) -> int:
+    # The deepest DEPTH_SOURCE runs on the tree walker, found by bisecting
+    low, high = 0, sys.getrecursionlimit() * 4
+    while high - low > 1:
+        middle = (low + high) // 2
+        try:
+            Executor(memo_size=memo_size).execute(Parser().parse(FastScanner().scan_source(DEPTH_SOURCE.format(middle))))
+            low = middle
+        except RecursionError:
+            high = middle
+    return low
+
+
+def run(names: List[str], warmup: int, repeat: int) -> Dict[str, Any]:
+    workloads = load_workloads()
+    results = {}
+    for name in names:
+        source, phases = workloads[name]
+        results[name] = {phase: measure(source, phase, warmup, repeat) for phase in phases}
+    return {
+        'tipy': VERSION,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'warmup': warmup,
+        'repeat': repeat,
+        'results': results,
+        'depth': recursion_depth(MEMO_SIZE),
+        'depth_no_memo': recursion_depth(0),
+    }
+
+
+def table(report: Dict[str, Any]) -> str:
+    lines = [f'{"workload":<14} {"phase":<8} {"min":>10} {"median":>10} {"peak":>10}']
+    for name, phases in report['results'].items():
+        for phase, result in phases.items():
+            lines.append(f'{name:<14} {phase:<8} {result["min"] * 1e3:>8.2f}ms {result["median"] * 1e3:>8.2f}ms '
+                         f'{result["peak_bytes"] / 1024:>8.0f}KB')
+    lines.append(f'\nrecursion depth: {report["depth"]} ({report["depth_no_memo"]} without memoization)')
+    return '\n'.join(lines)
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    # The minimum is compared rather than the median, being the least
+    # disturbed by whatever else the machine is doing
+    regressions = []
+    if report['depth'] < baseline.get('depth', 0):
+        regressions.append(f'recursion depth: {baseline["depth"]} -> {report["depth"]}')
+    for name, phases in report['results'].items():
+        for phase, result in phases.items():
+            old = baseline['results'].get(name, {}).get(phase)
+            if old is None:
+                continue
+            metrics = ['min', 'peak_bytes'] if old['min'] >= NOISE_FLOOR else ['peak_bytes']
+            for metric in metrics:
+                if old[metric] and result[metric] > old[metric] * (1 + threshold):
+                    change = 100 * (result[metric] / old[metric] - 1)
+                    regressions.append(f'{name} {phase} {metric}: {old[metric]:.6g} -> {result[metric]:.6g} '
+                                       f'({change:+.1f}%)')
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='tipy benchmarks - time scanning, parsing and execution separately')
+    arg_parser.add_argument('workloads', nargs='*', metavar='workload',
+                            help=f'workloads to run (default: all of {", ".join(SCRIPTS + ["synthetic"])})')
+    arg_parser.add_argument('--warmup', type=int, default=1, help='untimed runs before measuring')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='timed runs per phase')
+    arg_parser.add_argument('--output', metavar='FILE', help='write the results as JSON')
+    arg_parser.add_argument('--baseline', metavar='FILE', default=BASELINE,
+                            help='results to compare against (default: benchmarks/baseline.json)')
+    arg_parser.add_argument('--threshold', type=float, default=0.25,
+                            help='slowdown or memory growth, as a fraction, counted as a regression')
+    arg_parser.add_argument('--update-baseline', action='store_true',
+                            help='store these results as the new baseline instead of comparing')
+    args = arg_parser.parse_args()
+
+    names = args.workloads or SCRIPTS + ['synthetic']
+    for name in names:
+        if name not in SCRIPTS + ['synthetic']:
+            arg_parser.error(f'unknown workload {name}')
+    if args.repeat < 1:
+        arg_parser.error('--repeat must be at least 1')
+
+    report = run(names, args.warmup, args.repeat)
+    print(table(report))
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(report, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'wt') as file:
+            json.dump(report, file, indent=2)
+        print(f'\nbaseline written to {args.baseline}')
+        return 0
+
+    if report['depth'] < report['depth_no_memo']:
+        # A memoized call must not take more Python frames than a plain one
+        print(f'\nmemoization lowers the recursion depth from {report["depth_no_memo"]} to {report["depth"]}')
+        return 1
+
+    try:
+        with open(args.baseline, 'rt') as file:
+            baseline = json.load(file)
+    except OSError:
+        print(f'\nno baseline at {args.baseline}, run with --update-baseline to store one')
+        return 0
+
+    if baseline.get('python') != report['python'] or baseline.get('machine') != report['machine']:
+        print(f'\nwarning: baseline was taken with Python {baseline.get("python")} on {baseline.get("machine")}')
+    regressions = compare(report, baseline, args.threshold)
+    if regressions:
+        print(f'\n{len(regressions)} regressions over {args.threshold:.0%}:')
+        print('\n'.join(regressions))
+        return 1
+    print(f'\nno regressions over {args.threshold:.0%}')
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
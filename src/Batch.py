@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import traceback
+from collections import deque
+from io import StringIO
+from multiprocessing.connection import Connection, wait
+from time import monotonic, perf_counter
+from typing import *
+
+from Cache import CACHE_DIR, Cache
+from Error import *
+from Interpreter import Program
+from Parser import Parser
+from Scanner import FastScanner
+
+# Outcomes of a script
+OK = 'ok'
+ERROR = 'error'  # a tipy error, reported like main.py does
+TIMEOUT = 'timeout'
+CRASHED = 'crashed'  # the interpreter itself failed, or its worker died
+
+
+class BatchResult:
+    __slots__ = ('file_name', 'outcome', 'status', 'output', 'elapsed')
+
+    def __init__(self, file_name: str, outcome: str, status: int, output: str, elapsed: float):
+        self.file_name = file_name
+        self.outcome = outcome
+        self.status = status  # what 'python main.py file_name' would exit with
+        self.output = output
+        self.elapsed = elapsed
+
+
+def find_scripts(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return [path]
+    scripts = []
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories[:] = sorted(name for name in subdirectories if name != CACHE_DIR)
+        scripts += [os.path.join(directory, name) for name in sorted(files) if name.endswith('.ti')]
+    return scripts
+
+
+def run_script(file_name: str, engine: str, level: int, cache: Cache) -> BatchResult:
+    output = StringIO()
+    start = perf_counter()
+    try:
+        try:
+            with open(file_name, 'rt') as file:
+                source = file.read()
+        except OSError:
+            error('Unable to open file')
+        ast = cache.get(file_name, source.encode())
+        if ast is None:
+            ast = Parser().parse(FastScanner().scan_source(source))
+            cache.put(file_name, source.encode(), ast)
+        Program(source, engine, level, ast).run(output=output)
+        outcome, status = OK, 0
+    except TipyError as exception:
+        print(f'Error: {exception}\n', file=output)
+        outcome, status = ERROR, 255
+    except Exception:
+        output.write(traceback.format_exc())
+        outcome, status = CRASHED, 1
+    return BatchResult(file_name, outcome, status, output.getvalue(), perf_counter() - start)
+
+
+def serve(connection: Connection, engine: str, level: int, use_cache: bool) -> None:
+    # Body of a worker process: runs one script per request until told to stop
+    cache = Cache(use_cache)
+    while True:
+        file_name = connection.recv()
+        if file_name is None:
+            return
+        connection.send(run_script(file_name, engine, level, cache))
+
+
+class Worker:
+    def __init__(self, engine: str, level: int, use_cache: bool):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child, engine, level, use_cache), daemon=True)
+        self.process.start()
+        child.close()
+        self.file_name = None  # the script being run, None when idle
+        self.started = 0.0
+
+    def assign(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.started = monotonic()
+        self.connection.send(file_name)
+
+    def stop(self) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def run_batch(scripts: List[str], jobs: int, timeout: Optional[float], engine: str = 'tree', level: int = 0,
+              use_cache: bool = True) -> Iterator[BatchResult]:
+    # Yields results in the order scripts finish. A script that runs past
+    # 'timeout' seconds or takes its worker down is reported, and the worker
+    # replaced, without disturbing the other scripts.
+    pending = deque(scripts)
+    workers = [Worker(engine, level, use_cache) for _ in range(max(1, min(jobs, len(scripts))))]
+    try:
+        while True:
+            for worker in workers:
+                if worker.file_name is None and pending:
+                    worker.assign(pending.popleft())
+            busy = [worker for worker in workers if worker.file_name is not None]
+            if not busy:
+                return
+
+            wait_for = None
+            if timeout is not None:
+                wait_for = max(0.0, min(worker.started for worker in busy) + timeout - monotonic())
+            ready = wait([worker.connection for worker in busy] + [worker.process.sentinel for worker in busy],
+                         wait_for)
+
+            for i, worker in enumerate(workers):
+                if worker.file_name is None:
+                    continue
+                result = None
+                if worker.connection in ready or worker.process.sentinel in ready:
+                    try:
+                        result = worker.connection.recv()
+                    except (EOFError, OSError):
+                        worker.process.join(1)
+                        result = BatchResult(worker.file_name, CRASHED, 1,
+                                             f'worker exited with code {worker.process.exitcode}\n',
+                                             monotonic() - worker.started)
+                elif timeout is not None and monotonic() - worker.started >= timeout:
+                    result = BatchResult(worker.file_name, TIMEOUT, 1, f'timed out after {timeout}s\n',
+                                         monotonic() - worker.started)
+
+                if result is None:
+                    continue
+                if result.outcome == TIMEOUT or not worker.process.is_alive():
+                    worker.kill()
+                    workers[i] = worker = Worker(engine, level, use_cache)
+                worker.file_name = None
+                yield result
+    finally:
+        for worker in workers:
+            worker.stop()
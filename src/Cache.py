@@ -0,0 +1,238 @@
+import hashlib
+import marshal
+import os
+import struct
+import sys
+import zlib
+from array import array
+from types import CodeType
+from typing import *
+
+from FlatAST import FlatAST
+from Parser import ASTNode
+from Version import VERSION
+
+CACHE_DIR = '__tipycache__'
+MAGIC = b'TIC\x00'
+FORMAT_VERSION = 2
+
+# magic, format version, key (sha256 of interpreter version and source),
+# payload length, payload crc32
+HEADER = struct.Struct('<4sH32sII')
+LENGTH = struct.Struct('<I')
+FLOAT = struct.Struct('<d')
+
+# Literal tags in the payload
+STR = 0
+FLOAT_TAG = 1
+INT = 2
+FALSE = 3
+TRUE = 4
+
+# Arrays of a FlatAST, in the order they are written
+ARRAYS = ['kinds', 'first', 'counts', 'lines', 'operands', 'token_types', 'token_lines', 'token_lexemes', 'roots']
+
+
+class CorruptCache(Exception):
+    pass
+
+
+def cache_path(file_name: str, extension: str = '.tic') -> str:
+    directory, base = os.path.split(os.path.abspath(file_name))
+    return os.path.join(directory, CACHE_DIR, base[:-len('.ti')] + extension)
+
+
+def cache_key(source: bytes, salt: str = '') -> bytes:
+    # 'salt' is anything else the cached data depends on
+    digest = hashlib.sha256(VERSION.encode())
+    digest.update(b'\x00')
+    if salt:
+        digest.update(salt.encode())
+        digest.update(b'\x00')
+    digest.update(source)
+    return digest.digest()
+
+
+def code_salt(level: int) -> str:
+    # Code objects only load on the Python that compiled them
+    return f'python {sys.version} -O{level}'
+
+
+def little_endian(values: array) -> array:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def dump(flat: FlatAST) -> bytes:
+    parts = []
+    for name in ARRAYS:
+        values = getattr(flat, name)
+        parts.append(LENGTH.pack(len(values)))
+        parts.append(little_endian(values).tobytes())
+
+    parts.append(LENGTH.pack(len(flat.literals)))
+    for literal in flat.literals:
+        # bool before int, since bool is a subclass of int
+        if type(literal) is bool:
+            parts.append(bytes([TRUE if literal else FALSE]))
+        elif type(literal) is float:
+            parts.append(bytes([FLOAT_TAG]))
+            parts.append(FLOAT.pack(literal))
+        else:
+            encoded = (literal if type(literal) is str else str(literal)).encode()
+            parts.append(bytes([STR if type(literal) is str else INT]))
+            parts.append(LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+    return b''.join(parts)
+
+
+def load(payload: bytes) -> FlatAST:
+    flat = FlatAST()
+    view = memoryview(payload)
+    offset = 0
+
+    def read(size: int) -> memoryview:
+        nonlocal offset
+        if offset + size > len(view):
+            raise CorruptCache('truncated payload')
+        chunk = view[offset:offset + size]
+        offset += size
+        return chunk
+
+    def read_length() -> int:
+        return LENGTH.unpack(read(LENGTH.size))[0]
+
+    for name in ARRAYS:
+        values = array(getattr(flat, name).typecode)
+        values.frombytes(read(read_length() * values.itemsize))
+        setattr(flat, name, little_endian(values))
+
+    for _ in range(read_length()):
+        tag = read(1)[0]
+        if tag == STR:
+            flat.literals.append(str(read(read_length()), 'utf-8'))
+        elif tag == FLOAT_TAG:
+            flat.literals.append(FLOAT.unpack(read(FLOAT.size))[0])
+        elif tag == INT:
+            flat.literals.append(int(str(read(read_length()), 'ascii')))
+        elif tag in [FALSE, TRUE]:
+            flat.literals.append(tag == TRUE)
+        else:
+            raise CorruptCache('unknown literal tag')
+
+    if offset != len(view):
+        raise CorruptCache('trailing data')
+    return flat
+
+
+class Cache:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.events = []
+
+    def report(self) -> str:
+        return '\n'.join(self.events + [
+            f'cache: {self.hits} hits, {self.misses} misses, {self.writes} writes'])
+
+    def miss(self, path: str, reason: str) -> None:
+        self.misses += 1
+        self.events.append(f'cache: miss ({reason}) {path}')
+
+    def read(self, path: str, key: bytes) -> Optional[bytes]:
+        # The payload of a cache file, if it is intact and for 'key'
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            self.miss(path, 'not cached')
+            return None
+
+        if len(data) < HEADER.size:
+            self.miss(path, 'corrupt')
+            return None
+        magic, version, stored_key, length, checksum = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.miss(path, 'different format')
+            return None
+        elif stored_key != key:
+            self.miss(path, 'stale')
+            return None
+
+        payload = data[HEADER.size:]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            self.miss(path, 'corrupt')
+            return None
+        return payload
+
+    def write(self, path: str, key: bytes, payload: bytes) -> None:
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, key, len(payload), zlib.crc32(payload))
+        # Write to a temporary file first, so that a concurrent run never
+        # sees a half-written cache file
+        temporary = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporary, 'wb') as file:
+                file.write(header + payload)
+            os.replace(temporary, path)
+        except OSError:
+            # An unwritable directory just means no caching
+            self.events.append(f'cache: could not write {path}')
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return
+        self.writes += 1
+
+    def hit(self, path: str) -> None:
+        self.hits += 1
+        self.events.append(f'cache: hit {path}')
+
+    def get(self, file_name: str, source: bytes) -> Optional[List[ASTNode]]:
+        if not self.enabled:
+            return None
+        path = cache_path(file_name)
+        payload = self.read(path, cache_key(source))
+        if payload is None:
+            return None
+        try:
+            ast = load(payload).to_nodes()
+        except (CorruptCache, KeyError, IndexError, ValueError, struct.error):
+            self.miss(path, 'corrupt')
+            return None
+        self.hit(path)
+        return ast
+
+    def put(self, file_name: str, source: bytes, ast: List[ASTNode]) -> None:
+        if not self.enabled:
+            return
+        self.write(cache_path(file_name), cache_key(source), dump(FlatAST.from_nodes(ast)))
+
+    def get_code(self, file_name: str, source: bytes, level: int) -> Optional[CodeType]:
+        # The script as transpiled by the python engine at an optimization
+        # level, see Transpiler
+        if not self.enabled:
+            return None
+        path = cache_path(file_name, f'.O{level}.tpc')
+        payload = self.read(path, cache_key(source, code_salt(level)))
+        if payload is None:
+            return None
+        try:
+            code = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            code = None
+        if type(code) is not CodeType:
+            self.miss(path, 'corrupt')
+            return None
+        self.hit(path)
+        return code
+
+    def put_code(self, file_name: str, source: bytes, level: int, code: CodeType) -> None:
+        if not self.enabled:
+            return
+        self.write(cache_path(file_name, f'.O{level}.tpc'), cache_key(source, code_salt(level)), marshal.dumps(code))
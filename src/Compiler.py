@@ -0,0 +1,426 @@
+from enum import IntEnum, unique
+from typing import *
+
+from Error import *
+from Idioms import TESTS, counter_test, self_update
+from Parser import ASTNode, NodeType
+from Resolver import GLOBAL, Resolver
+from Token import Token, TokenType
+from Value import constant_key
+
+
+@unique
+class OpCode(IntEnum):
+    LOAD_CONST = 0
+    LOAD_LOCAL = 1
+    STORE_LOCAL = 2
+    LOAD_GLOBAL = 3
+    STORE_GLOBAL = 4
+    LOAD_REF = 5
+    STORE_REF = 6
+    POP = 7
+
+    JUMP = 8
+    JUMP_IF_FALSE = 9
+    JUMP_IF_TRUE = 10
+
+    ADD = 11
+    SUBTRACT = 12
+    MODULO = 13
+    MULTIPLY = 14
+    DIVIDE = 15
+    EQUALS = 16
+    NOT_EQUALS = 17
+    GREATER = 18
+    GREATER_EQUALS = 19
+    LESSER = 20
+    LESSER_EQUALS = 21
+    LEFT_SHIFT = 22
+    RIGHT_SHIFT = 23
+    BITOR = 24
+    BITXOR = 25
+    BITAND = 26
+
+    NOT = 27
+    NEGATE = 28
+    BITNOT = 29
+
+    MAKE_FUNCTION = 30
+    CALL = 31
+    PRINT = 32
+    RETURN = 33
+    TAIL_CALL = 34
+
+    # Superinstructions, each standing for a sequence of the above (see Idioms)
+    TEST_LOCAL = 35
+    TEST_GLOBAL = 36
+    UPDATE_LOCAL = 37
+    UPDATE_GLOBAL = 38
+
+    # Checks the function on top of the stack before its arguments are run
+    CHECK_CALL = 39
+    # Jumps to its argument while the global print is still the native one
+    JUMP_IF_PRINT = 40
+
+
+BINARY_OPS = {
+    TokenType.PLUS: OpCode.ADD,
+    TokenType.MINUS: OpCode.SUBTRACT,
+    TokenType.MODULO: OpCode.MODULO,
+    TokenType.STAR: OpCode.MULTIPLY,
+    TokenType.SLASH: OpCode.DIVIDE,
+    TokenType.EQUALS_EQUALS: OpCode.EQUALS,
+    TokenType.BANG_EQUALS: OpCode.NOT_EQUALS,
+    TokenType.GREATER: OpCode.GREATER,
+    TokenType.GREATER_EQUALS: OpCode.GREATER_EQUALS,
+    TokenType.LESSER: OpCode.LESSER,
+    TokenType.LESSER_EQUALS: OpCode.LESSER_EQUALS,
+    TokenType.LEFT_SHIFT: OpCode.LEFT_SHIFT,
+    TokenType.RIGHT_SHIFT: OpCode.RIGHT_SHIFT,
+}
+
+BITWISE_OPS = {
+    NodeType.BITOR: OpCode.BITOR,
+    NodeType.BITXOR: OpCode.BITXOR,
+    NodeType.BITAND: OpCode.BITAND,
+}
+
+# Nodes of the binary operators, their left operand is always children[-2]
+OPERATORS = [NodeType.ADDITION, NodeType.MULTIPLICATION, NodeType.COMPARISION, NodeType.EQUALITY,
+             NodeType.BITSHIFT, NodeType.BITOR, NodeType.BITXOR, NodeType.BITAND, NodeType.LOGOR,
+             NodeType.LOGAND]
+
+# Where the right operand of a TEST or UPDATE comes from
+CONST_OPERAND = 0
+LOCAL_OPERAND = 1
+GLOBAL_OPERAND = 2
+
+UNARY_OPS = {
+    TokenType.BANG: OpCode.NOT,
+    TokenType.MINUS: OpCode.NEGATE,
+    TokenType.BITNOT: OpCode.BITNOT,
+}
+
+
+class Code:
+    def __init__(self, name: str, params: List[str]):
+        self.name = name
+        self.params = params
+        self.ops = []  # flat list of (opcode, argument) pairs
+        self.frame_size = 1
+        self.captured = False  # whether nested functions keep a reference to the frame
+        self.consts = []
+        self.names = []
+        self.refs = []  # (name, depth, slot, fallback) for LOAD_REF/STORE_REF
+        self.operands = []  # operands of the superinstructions
+        self.slot_names = {}
+        self.const_index = {}
+        self.name_index = {}
+
+    def emit(self, op: OpCode, arg: int = 0) -> int:
+        self.ops.append(int(op))
+        self.ops.append(arg)
+        return len(self.ops) - 2
+
+    def patch(self, where: int) -> None:
+        self.ops[where + 1] = len(self.ops)
+
+    def add_const(self, value: Any) -> int:
+        key = constant_key(value)
+        if key not in self.const_index:
+            self.const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self.const_index[key]
+
+    def add_name(self, name: str) -> int:
+        if name not in self.name_index:
+            self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return self.name_index[name]
+
+    def add_ref(self, ref: Tuple[str, int, int, bool]) -> int:
+        self.refs.append(ref)
+        return len(self.refs) - 1
+
+    def add_operands(self, operands: Tuple[Any, ...]) -> int:
+        self.operands.append(operands)
+        return len(self.operands) - 1
+
+    def operand_name(self, source: int, operand: Any) -> str:
+        if source == CONST_OPERAND:
+            return repr(operand)
+        return self.slot_names.get(operand, '?') if source == LOCAL_OPERAND else operand
+
+    def disassemble(self) -> str:
+        lines = [f'code {self.name}({", ".join(self.params)}):']
+        for pc in range(0, len(self.ops), 2):
+            op = OpCode(self.ops[pc])
+            arg = self.ops[pc + 1]
+            if op == OpCode.LOAD_CONST:
+                detail = f'{arg} ({self.consts[arg]!r})'
+            elif op in [OpCode.LOAD_LOCAL, OpCode.STORE_LOCAL]:
+                detail = f'{arg} ({self.slot_names.get(arg, "?")})'
+            elif op in [OpCode.LOAD_GLOBAL, OpCode.STORE_GLOBAL]:
+                detail = f'{arg} ({self.names[arg]})'
+            elif op in [OpCode.LOAD_REF, OpCode.STORE_REF]:
+                detail = f'{arg} {self.refs[arg]}'
+            elif op == OpCode.MAKE_FUNCTION:
+                detail = f'{arg} ({self.consts[arg].name})'
+            elif op in [OpCode.TEST_LOCAL, OpCode.TEST_GLOBAL, OpCode.UPDATE_LOCAL, OpCode.UPDATE_GLOBAL]:
+                compare, left, source, right = self.operands[arg][-4:]
+                local = op in [OpCode.TEST_LOCAL, OpCode.UPDATE_LOCAL]
+                detail = (f'{arg} ({self.slot_names.get(left, "?") if local else left} {OpCode(compare).name} '
+                          f'{self.operand_name(source, right)})')
+            else:
+                detail = str(arg)
+            lines.append(f'{pc:6} {op.name:<16} {detail}')
+        for const in self.consts:
+            if isinstance(const, Code):
+                lines.append('')
+                lines.append(const.disassemble())
+        return '\n'.join(lines)
+
+
+class Compiler:
+    def __init__(self):
+        self.code = None
+        self.resolver = Resolver()
+
+    def load(self, name: str, depth: int, slot: int, fallback: bool) -> None:
+        if depth == GLOBAL:
+            self.code.emit(OpCode.LOAD_GLOBAL, self.code.add_name(name))
+        elif depth == 0:
+            self.code.slot_names[slot] = name
+            self.code.emit(OpCode.LOAD_LOCAL, slot)
+        else:
+            self.code.emit(OpCode.LOAD_REF,
+                           self.code.add_ref((name, depth, slot, fallback)))
+
+    def store(self, name: str, depth: int, slot: int, fallback: bool) -> None:
+        if depth == GLOBAL:
+            self.code.emit(OpCode.STORE_GLOBAL, self.code.add_name(name))
+        elif depth == 0:
+            self.code.slot_names[slot] = name
+            self.code.emit(OpCode.STORE_LOCAL, slot)
+        else:
+            self.code.emit(OpCode.STORE_REF,
+                           self.code.add_ref((name, depth, slot, fallback)))
+
+    def block_stmt(self, block: ASTNode) -> None:
+        for stmt in block.children:
+            self.compile_stmt(stmt)
+
+    def variable(self, name: str, depth: int, slot: int) -> Optional[Tuple[int, Any]]:
+        # Where a superinstruction finds a variable, None when it cannot
+        if depth == GLOBAL:
+            return GLOBAL_OPERAND, name
+        elif depth == 0:
+            self.code.slot_names[slot] = name
+            return LOCAL_OPERAND, slot
+        return None
+
+    def operand(self, expr: ASTNode) -> Optional[Tuple[int, Any]]:
+        if expr.type == NodeType.NUMBER:
+            return CONST_OPERAND, expr.children[0]
+        return self.variable(*expr.children[:3])
+
+    def branch(self, cond: ASTNode) -> int:
+        # Compiles a condition and the jump taken when it is false, returning
+        # where that jump is to be patched. A comparison of a variable with a
+        # number or another variable is one TEST, which skips the jump when
+        # the comparison holds.
+        test = counter_test(cond)
+        if test is not None:
+            op, left, right = test
+            left, right = self.operand(left), self.operand(right)
+            if left is not None and right is not None:
+                operands = (TESTS[op.type], int(BINARY_OPS[op.type]), left[1]) + right
+                self.code.emit(OpCode.TEST_LOCAL if left[0] == LOCAL_OPERAND else OpCode.TEST_GLOBAL,
+                               self.code.add_operands(operands))
+                return self.code.emit(OpCode.JUMP_IF_FALSE)
+        self.compile_expr(cond)
+        return self.code.emit(OpCode.JUMP_IF_FALSE)
+
+    def if_stmt(self, stmt: ASTNode) -> None:
+        jump_else = self.branch(stmt.children[0])
+        self.compile_stmt(stmt.children[1])
+        if stmt.children[2] is not None:
+            jump_end = self.code.emit(OpCode.JUMP)
+            self.code.patch(jump_else)
+            self.compile_stmt(stmt.children[2])
+            self.code.patch(jump_end)
+        else:
+            self.code.patch(jump_else)
+
+    def while_stmt(self, stmt: ASTNode) -> None:
+        start = len(self.code.ops)
+        jump_end = self.branch(stmt.children[0])
+        self.compile_stmt(stmt.children[1])
+        self.code.emit(OpCode.JUMP, start)
+        self.code.patch(jump_end)
+
+    def fun_decl(self, stmt: ASTNode) -> None:
+        params = [param.lexeme for param in stmt.children[1]]
+        code = self.compile_function(stmt.children[0].lexeme, params,
+                                     stmt.children[2].children)
+        code.frame_size = stmt.children[6]
+        code.captured = stmt.children[7]
+        self.code.emit(OpCode.MAKE_FUNCTION, self.code.add_const(code))
+        self.store(stmt.children[0].lexeme, *stmt.children[3:6])
+
+    def compile_function(self, name: str, params: List[str], body: List[ASTNode]) -> Code:
+        enclosing = self.code
+        self.code = Code(name, params)
+        for stmt in body:
+            self.compile_stmt(stmt)
+        # Falling off the end of a function returns 0
+        self.code.emit(OpCode.LOAD_CONST, self.code.add_const(0))
+        self.code.emit(OpCode.RETURN)
+        code = self.code
+        self.code = enclosing
+        return code
+
+    def compile_stmt(self, stmt: ASTNode) -> None:
+        if stmt.type == NodeType.BLOCK:
+            self.block_stmt(stmt)
+        elif stmt.type == NodeType.FUN:
+            self.fun_decl(stmt)
+        elif stmt.type == NodeType.IF:
+            self.if_stmt(stmt)
+        elif stmt.type == NodeType.RETURN:
+            expr = stmt.children[0]
+            if expr.type == NodeType.CALL and not self.prints(expr):
+                # 'return f(...)' replaces the current call instead of nesting
+                self.call(expr, OpCode.TAIL_CALL)
+                # Only reached when the callee was a native
+                self.code.emit(OpCode.RETURN)
+            else:
+                self.compile_expr(expr)
+                self.code.emit(OpCode.RETURN)
+        elif stmt.type == NodeType.VAR:
+            name, init, depth, slot, fallback = stmt.children
+            update = self_update(stmt)
+            target = self.variable(name.lexeme, depth, slot) if update is not None else None
+            right = self.operand(update[1]) if target is not None else None
+            if right is not None:
+                operands = (int(BINARY_OPS[update[0].type]), target[1]) + right
+                self.code.emit(OpCode.UPDATE_LOCAL if target[0] == LOCAL_OPERAND else OpCode.UPDATE_GLOBAL,
+                               self.code.add_operands(operands))
+            else:
+                self.compile_expr(init)
+                self.store(name.lexeme, depth, slot, fallback)
+        elif stmt.type == NodeType.WHILE:
+            self.while_stmt(stmt)
+        elif stmt.type == NodeType.EXPR:
+            self.compile_expr(stmt.children[0])
+            self.code.emit(OpCode.POP)
+
+    @staticmethod
+    def prints(expr: ASTNode) -> bool:
+        # Whether a CALL node calls the global print
+        callee = expr.children[0]
+        return callee.type == NodeType.IDENTIFIER and callee.children[0] == 'print' \
+            and callee.children[1] == GLOBAL
+
+    def call(self, expr: ASTNode, op: OpCode) -> None:
+        self.compile_expr(expr.children[0])
+        args = expr.children[1:]
+        if not all(arg.type in [NodeType.NUMBER, NodeType.STRING] for arg in args):
+            # A callee that cannot take these arguments is reported before
+            # any of them runs, as on the other engines
+            self.code.emit(OpCode.CHECK_CALL, len(args))
+        for arg in args:
+            self.compile_expr(arg)
+        self.code.emit(op, len(args))
+
+    def compile_expr(self, expr: ASTNode) -> None:
+        if expr.type == NodeType.STRING or expr.type == NodeType.NUMBER:
+            self.code.emit(OpCode.LOAD_CONST,
+                           self.code.add_const(expr.children[0]))
+        elif expr.type == NodeType.IDENTIFIER:
+            self.load(*expr.children)
+        elif expr.type == NodeType.UNARY:
+            ops = []
+            while expr.type == NodeType.UNARY:
+                ops.append(UNARY_OPS[expr.children[0].type])
+                expr = expr.children[1]
+            self.compile_expr(expr)
+            for op in reversed(ops):
+                self.code.emit(op)
+        elif expr.type == NodeType.CALL:
+            if self.prints(expr):
+                # Unless the script defined a print of its own, one PRINT per
+                # argument, so that each value is printed before the next one
+                # is evaluated, as the tree walker does
+                jump_print = self.code.emit(OpCode.JUMP_IF_PRINT)
+                self.call(expr, OpCode.CALL)
+                jump_end = self.code.emit(OpCode.JUMP)
+                self.code.patch(jump_print)
+                args = expr.children[1:]
+                for i, arg in enumerate(args):
+                    self.compile_expr(arg)
+                    self.code.emit(OpCode.PRINT, 1)
+                    if i < len(args) - 1:
+                        self.code.emit(OpCode.POP)
+                if not args:
+                    self.code.emit(OpCode.PRINT, 0)
+                self.code.patch(jump_end)
+            else:
+                self.call(expr, OpCode.CALL)
+        else:
+            # Binary operators: compile the leftmost operand of a chain like
+            # a + b + c + ... first, then each operator on the way back up,
+            # instead of recursing once per operator
+            spine = []
+            while expr.type in OPERATORS:
+                spine.append(expr)
+                expr = expr.children[-2]
+            self.compile_expr(expr)
+            for expr in reversed(spine):
+                self.compile_operator(expr)
+
+    def compile_operator(self, expr: ASTNode) -> None:
+        # Compiles the rest of a binary operator, its left operand is already
+        # on the stack
+        if expr.type in [NodeType.ADDITION, NodeType.MULTIPLICATION, NodeType.EQUALITY,
+                         NodeType.COMPARISION, NodeType.BITSHIFT]:
+            self.compile_expr(expr.children[2])
+            self.code.emit(BINARY_OPS[expr.children[0].type])
+        elif expr.type in BITWISE_OPS:
+            self.compile_expr(expr.children[1])
+            self.code.emit(BITWISE_OPS[expr.type])
+        elif expr.type == NodeType.LOGOR:
+            jump_right = self.code.emit(OpCode.JUMP_IF_FALSE)
+            self.code.emit(OpCode.LOAD_CONST, self.code.add_const(1))
+            jump_end = self.code.emit(OpCode.JUMP)
+            self.code.patch(jump_right)
+            self.compile_expr(expr.children[1])
+            self.code.patch(jump_end)
+        elif expr.type == NodeType.LOGAND:
+            jump_right = self.code.emit(OpCode.JUMP_IF_TRUE)
+            self.code.emit(OpCode.LOAD_CONST, self.code.add_const(0))
+            jump_end = self.code.emit(OpCode.JUMP)
+            self.code.patch(jump_right)
+            self.compile_expr(expr.children[1])
+            self.code.patch(jump_end)
+
+    def compile(self, stmts: List[ASTNode]) -> Code:
+        self.resolver.resolve(stmts)
+        self.code = Code('<script>', [])
+        for stmt in stmts:
+            self.compile_stmt(stmt)
+        self.code.emit(OpCode.LOAD_CONST, self.code.add_const(0))
+        self.code.emit(OpCode.RETURN)
+        self.code.frame_size = self.resolver.script_slots
+        return self.code
+
+    def compile_stream(self, stmts: Iterable[ASTNode]) -> Iterator[Code]:
+        # One Code per top-level statement, all meant to run in the same frame
+        for stmt in stmts:
+            self.resolver.resolve([stmt])
+            self.code = Code('<script>', [])
+            self.compile_stmt(stmt)
+            self.code.emit(OpCode.LOAD_CONST, self.code.add_const(0))
+            self.code.emit(OpCode.RETURN)
+            self.code.frame_size = self.resolver.script_slots
+            yield self.code
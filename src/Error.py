@@ -1,3 +1,8 @@
+class TipyError(Exception):
+    pass
+
+
 def error(what: str) -> None:
-    print('Error: ' + what + '\n')
-    exit(-1)
+    # Raised rather than exiting, so that tipy can be embedded; main.py turns
+    # it back into a message and exit status
+    raise TipyError(what)
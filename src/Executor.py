@@ -1,64 +1,236 @@
-from enum import Enum, auto, unique
+import sys
+from collections import OrderedDict
 from typing import *
 
 from Error import *
+from Idioms import TESTS, counter_test, self_update
+from Natives import NATIVES
 from Parser import ASTNode, NodeType
-from Token import TokenType
+from Resolver import GLOBAL, Resolver
+from Token import Token, TokenType
+from Value import FUNCTION_TYPES, INTEGER_TYPES, NUMBER_TYPES, STRING_TYPES, Array, Closure, Native, concat, kind
 
 
-@unique
-class IdentifierType(Enum):
-    VARIABLE = auto()
-    FUNCTION = auto()
+# Nodes of the binary operators, their left operand is always children[-2]
+OPERATORS = [NodeType.ADDITION, NodeType.MULTIPLICATION, NodeType.COMPARISION, NodeType.EQUALITY,
+             NodeType.BITSHIFT, NodeType.BITOR, NodeType.BITXOR, NodeType.BITAND, NodeType.LOGOR,
+             NodeType.LOGAND]
+# Every other kind of expression, most common first
+OPERANDS = [NodeType.IDENTIFIER, NodeType.NUMBER, NodeType.CALL, NodeType.STRING, NodeType.UNARY]
+
+
+# Inline cache of a CALL node calling the global print, which prints each
+# argument as soon as it is evaluated while print is still the native one
+PRINT_CALL = 'print'
+NATIVE_PRINT = NATIVES['print']
+# Inline cache of a WHILE node that is not a counted loop (see loop_plan)
+GENERIC_LOOP = 'generic'
+
+# Results of pure function calls kept by default
+MEMO_SIZE = 4096
+# Memoized calls to a function in a row that may miss before the function is
+# no longer memoized, as its arguments evidently do not repeat
+MEMO_PATIENCE = 1000
+# A tipy call takes one Python frame more here (invoke) than on the first
+# tree walker, which took at least two, so the recursion limit is raised by
+# half while a script runs for scripts to recurse at least as deep as they did
+RECURSION_SCALE = 1.5
 
 
 class ReturnValue(BaseException):
-    def __init__(self, value: ASTNode):
+    def __init__(self, value: Any):
         self.value = value
 
 
 class Executor:
-    def __init__(self):
-        self.environments = [dict()]
+    # Whether while loops may run through counted_loop
+    counted_loops = True
+
+    def __init__(self, output: Optional[TextIO] = None, memo_size: int = MEMO_SIZE):
+        # Globals live in cells, one element lists, so that a node can cache
+        # the cell of its name: assigning to a global writes into its cell,
+        # and a cell is never replaced once created. A cache entry is only
+        # trusted while its 'cells' is this very dict, which keeps a tree
+        # shared between runs, each with its own globals, correct.
+        self.cells = {name: [native] for name, native in NATIVES.items()}
+        self.output = output  # None prints to sys.stdout
+        self.frame = [None]
+        self.resolver = Resolver()
+        self.identifier_hits = 0
+        self.identifier_misses = 0
+        self.call_hits = 0
+        self.call_misses = 0
+        # Results of calls to pure functions, keyed by the function, the
+        # arguments and their types (so that 1 and 1.0 stay apart), least
+        # recently used first. 'impure' is set whenever a function that is
+        # not pure runs, so that a pure function calling one is not memoized.
+        self.memo = OrderedDict() if memo_size > 0 else None
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.impure = False
+
+    @property
+    def globals(self) -> Dict[str, Any]:
+        return {name: cell[0] for name, cell in self.cells.items()}
+
+    def define(self, name: str, value: Any) -> None:
+        self.assign(name, GLOBAL, 0, False, value)
+
+    def cache_report(self) -> str:
+        lines = []
+        for what, hits, misses in [('identifiers', self.identifier_hits, self.identifier_misses),
+                                   ('calls', self.call_hits, self.call_misses),
+                                   ('memoized calls', self.memo_hits, self.memo_misses)]:
+            total = hits + misses
+            rate = 100 * hits / total if total else 0.0
+            lines.append(f'inline cache: {what} {hits} hits, {misses} misses ({rate:.1f}% hit rate)')
+        return '\n'.join(lines)
+
+    def lookup(self, expr: ASTNode) -> Any:
+        name, depth, slot, fallback = expr.children
+        if depth != GLOBAL:
+            frame = self.frame
+            for _ in range(depth):
+                frame = frame[0]
+            value = frame[slot]
+            if value is not None:
+                return value
+            elif not fallback:
+                error(f'{name}: no such variable in scope')
+        cell = self.cells.get(name)
+        if cell is None:
+            error(f'{name}: no such variable in scope')
+        if depth == GLOBAL:
+            # A fallback slot can still be filled in later, so only names
+            # that are always global are cached
+            self.identifier_misses += 1
+            expr.cache = (self.cells, cell)
+        return cell[0]
+
+    def assign(self, name: str, depth: int, slot: int, fallback: bool, value: Any) -> None:
+        if depth == GLOBAL:
+            cell = self.cells.get(name)
+            if cell is None:
+                self.cells[name] = [value]
+            else:
+                if type(cell[0]) is Closure and self.memo:
+                    # Memoized results may depend on the function this
+                    # name held
+                    self.memo.clear()
+                cell[0] = value
+            return
+        frame = self.frame
+        for _ in range(depth):
+            frame = frame[0]
+        if fallback and frame[slot] is None and name in self.cells:
+            self.assign(name, GLOBAL, 0, False, value)
+        else:
+            frame[slot] = value
 
     def block_stmt(self, block: ASTNode) -> None:
-        self.environments.append(dict())
         for stmt in block.children:
             self.exec_stmt(stmt)
-        self.environments.pop()
 
     def if_stmt(self, stmt: ASTNode) -> None:
-        cond = self.exec_expr(stmt.children[0])
-        if (cond.type == NodeType.STRING and cond.children[0] != '') or \
-                (cond.type == NodeType.NUMBER and cond.children[0] != 0.0):
+        if self.exec_expr(stmt.children[0]):
             self.exec_stmt(stmt.children[1])
-        elif stmt.children[2] != None:
+        elif stmt.children[2] is not None:
             self.exec_stmt(stmt.children[2])
 
     def while_stmt(self, stmt: ASTNode) -> None:
-        cond = self.exec_expr(stmt.children[0])
-        while cond.children[0]:
-            self.exec_stmt(stmt.children[1])
-            cond = self.exec_expr(stmt.children[0])
+        plan = stmt.cache
+        if plan is None:
+            stmt.cache = plan = self.loop_plan(stmt) if self.counted_loops else GENERIC_LOOP
+        if plan is GENERIC_LOOP:
+            self.generic_loop(stmt)
+        else:
+            self.counted_loop(stmt, plan)
+
+    def generic_loop(self, stmt: ASTNode) -> None:
+        cond = stmt.children[0]
+        body = stmt.children[1]
+        while self.exec_expr(cond):
+            self.exec_stmt(body)
+
+    @staticmethod
+    def loop_plan(stmt: ASTNode) -> Any:
+        # A counted loop tests a variable against a number or another
+        # variable, and usually ends its body by stepping that variable, as
+        # in: while i < n { ...; i = i + 1; }
+        test = counter_test(stmt.children[0])
+        if test is None:
+            return GENERIC_LOOP
+        op, counter, limit = test
+        body = stmt.children[1]
+        stmts = body.children if body.type == NodeType.BLOCK else [body]
+        increment = stmts[-1] if stmts else None
+        update = self_update(increment) if increment is not None else None
+        step = None
+        if update is not None and update[1].type == NodeType.NUMBER and increment.children[2:5] == counter.children[1:]:
+            step = update[1].children[0] if update[0].type == TokenType.PLUS else -update[1].children[0]
+            stmts = stmts[:-1]
+        return TESTS[op.type], counter, limit, stmts, step, increment
+
+    def box(self, expr: ASTNode) -> Optional[Tuple[List[Any], int]]:
+        # Where the value of a resolved identifier is kept, as a list and an
+        # index into it, which stays put while the current function runs.
+        # None while the name has no value of its own, or stands for a global.
+        name, depth, slot, fallback = expr.children
+        if depth == GLOBAL:
+            cell = self.cells.get(name)
+            return None if cell is None else (cell, 0)
+        frame = self.frame
+        for _ in range(depth):
+            frame = frame[0]
+        return None if frame[slot] is None else (frame, slot)
+
+    def counted_loop(self, stmt: ASTNode, plan: Any) -> None:
+        # Runs a loop found by loop_plan with its counter and limit read
+        # straight from where they are kept and the increment done in place.
+        # The body may still assign anything to them: the loop goes on the
+        # generic way as soon as either is not a number.
+        test, counter, limit, stmts, step, increment = plan
+        counter_box = self.box(counter)
+        limit_box = self.box(limit) if limit.type == NodeType.IDENTIFIER else (limit.children, 0)
+        if counter_box is None or limit_box is None:
+            self.generic_loop(stmt)
+            return
+        values, index = counter_box
+        limits, limit_index = limit_box
+        exec_stmt = self.exec_stmt
+        while True:
+            value = values[index]
+            bound = limits[limit_index]
+            if type(value) not in NUMBER_TYPES or type(bound) not in NUMBER_TYPES:
+                self.generic_loop(stmt)
+                return
+            if not test(value, bound):
+                return
+            for body_stmt in stmts:
+                exec_stmt(body_stmt)
+            if step is not None:
+                value = values[index]
+                if type(value) in NUMBER_TYPES:
+                    values[index] = value + step
+                else:
+                    exec_stmt(increment)
 
     def var_decl(self, stmt: ASTNode) -> None:
-        init = self.exec_expr(stmt.children[1])
-        for environment in self.environments[::-1]:
-            if any(name == stmt.children[0].lexeme for name in environment.keys()):
-                environment[stmt.children[0].lexeme] = (
-                    IdentifierType.VARIABLE, init)
+        name, init, depth, slot, fallback = stmt.children
+        value = self.exec_expr(init)
+        frame = self.frame
+        if depth == 0 and (not fallback or frame[slot] is not None):
+            # A local of the running function, which assign would also pick
+            frame[slot] = value
         else:
-            self.environments[-1][stmt.children[0].lexeme] = (
-                IdentifierType.VARIABLE, init)
+            self.assign(name.lexeme, depth, slot, fallback, value)
 
     def fun_decl(self, stmt: ASTNode) -> None:
-        for environment in self.environments[::-1]:
-            if any(name == stmt.children[0].lexeme for name in environment.keys()):
-                environment[stmt.children[0].lexeme] = (
-                    IdentifierType.FUNCTION, [stmt.children[1], stmt.children[2]])
-        else:
-            self.environments[-1][stmt.children[0].lexeme] = (
-                IdentifierType.FUNCTION, [stmt.children[1], stmt.children[2]])
+        function = Closure(stmt.children[0].lexeme, len(stmt.children[1]),
+                           stmt.children[6], stmt.children[2].children, self.frame, not stmt.children[7],
+                           stmt.children[8])
+        self.assign(stmt.children[0].lexeme, *stmt.children[3:6], function)
 
     def exec_stmt(self, stmt: ASTNode) -> None:
         if stmt.type == NodeType.BLOCK:
@@ -77,165 +249,289 @@ class Executor:
         elif stmt.type == NodeType.EXPR:
             self.exec_expr(stmt.children[0])
 
-    def exec_expr(self, expr: ASTNode) -> ASTNode:
-        if expr.type == NodeType.STRING or expr.type == NodeType.NUMBER:
-            return expr
-        elif expr.type == NodeType.ADDITION:
-            left = self.exec_expr(expr.children[1])
+    def exec_expr(self, expr: ASTNode) -> Any:
+        if expr.type == NodeType.IDENTIFIER:
+            cache = expr.cache
+            if cache is not None and cache[0] is self.cells:
+                self.identifier_hits += 1
+                return cache[1][0]
+            children = expr.children
+            if children[1] == 0:
+                # A local of the running function
+                value = self.frame[children[2]]
+                if value is not None:
+                    return value
+            return self.lookup(expr)
+        elif expr.type == NodeType.NUMBER or expr.type == NodeType.STRING:
+            return expr.children[0]
+        elif expr.type == NodeType.CALL:
+            # Handled here rather than in a method of their own, so that a
+            # tipy call takes one Python frame less. The cache of a CALL node
+            # holds the function it called last and its arguments, which were
+            # already checked against that function.
+            cache = expr.cache
+            if cache is None:
+                callee = expr.children[0]
+                if callee.type == NodeType.IDENTIFIER and callee.children[0] == 'print' \
+                        and callee.children[1] == GLOBAL:
+                    expr.cache = cache = PRINT_CALL
+            if cache is PRINT_CALL:
+                if self.cells['print'][0] is NATIVE_PRINT:
+                    for arg in expr.children[1:]:
+                        print(self.exec_expr(arg), file=self.output)
+                    return 1
+                # The script defined a print of its own, which is called as
+                # any other function, without caching it
+                cache = None
+            function = self.exec_expr(expr.children[0])
+            if cache is not None and cache[0] is function:
+                self.call_hits += 1
+                args = cache[1]
+            else:
+                # The function is checked before any of its arguments runs
+                args = expr.children[1:]
+                if type(function) is not Closure and type(function) is not Native:
+                    error('cannot call a non-function')
+                elif function.arity is not None and function.arity != len(args):
+                    error(
+                        f'arity mismatch, expected {function.arity} arguments, got {len(args)}')
+                elif type(function) is Native:
+                    # Not cached, a native needs all of its arguments evaluated first
+                    return self.apply(function, [self.exec_expr(arg) for arg in args])
+                self.call_misses += 1
+                if expr.cache is not PRINT_CALL:
+                    expr.cache = (function, args)
+            frame = function.new_frame()
+            slot = 1
+            for arg in args:
+                frame[slot] = self.exec_expr(arg)
+                slot += 1
+            return self.invoke(function, frame)
+        elif expr.type == NodeType.UNARY:
+            # Chains like --x are applied innermost first, without recursing
+            ops = []
+            while expr.type == NodeType.UNARY:
+                ops.append(expr.children[0])
+                expr = expr.children[1]
+            operand = self.exec_expr(expr)
+            for op in reversed(ops):
+                operand = self.unary(op, operand)
+            return operand
+        else:
+            # Binary operators: walk down the left operands first and apply the
+            # operators on the way back up, so that a long chain like
+            # a + b + c + ... is evaluated without recursing once per operator
+            left = expr.children[-2]
+            if left.type in OPERANDS:
+                return self.operate(expr, self.exec_expr(left))
+            spine = []
+            while expr.type in OPERATORS:
+                spine.append(expr)
+                expr = expr.children[-2]
+            value = self.exec_expr(expr)
+            for expr in reversed(spine):
+                value = self.operate(expr, value)
+            return value
+
+    def operate(self, expr: ASTNode, left: Any) -> Any:
+        # Applies a binary operator to its already evaluated left operand
+        if expr.type == NodeType.ADDITION:
+            op = expr.children[0].type
             right = self.exec_expr(expr.children[2])
-            if expr.children[0].type == TokenType.MODULO and (left.type != NodeType.NUMBER or right.type != NodeType.NUMBER):
+            if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES and op != TokenType.MODULO:
+                return left + right if op == TokenType.PLUS else left - right
+            if type(left) is int and type(right) is int and right:
+                # Only % gets here with two numbers
+                return left % right
+            if op == TokenType.MODULO and (type(left) not in NUMBER_TYPES or type(right) not in NUMBER_TYPES):
                 error('can only calculate remainders of numbers')
-            if left.type != right.type:
+            if kind(left) != kind(right):
                 error(
-                    f'cannot {"add" if expr.children[0].type == TokenType.PLUS else "subtract"} instances of {left.type} and {right.type}')
-            elif left.type != NodeType.FUNCTION:
-                if expr.children[0].type == TokenType.PLUS:
-                    return ASTNode(NodeType.NUMBER, [left.children[0] + right.children[0]])
-                elif expr.children[0].type == TokenType.MINUS:
-                    return ASTNode(NodeType.NUMBER, [left.children[0] - right.children[0]])
-                else:
-                    return ASTNode(NodeType.NUMBER, [left.children[0] % right.children[0]])
-            else:
+                    f'cannot {"add" if op == TokenType.PLUS else "subtract"} instances of {kind(left)} and {kind(right)}')
+            elif type(left) in FUNCTION_TYPES:
                 error('cannot do arithmetic on functions')
+            elif type(left) is Array:
+                error('cannot do arithmetic on arrays')
+            elif op == TokenType.PLUS:
+                return concat(left, right)
+            elif type(left) in STRING_TYPES:
+                error('can only subtract numbers')
+            elif right == 0:
+                error('cannot divide by zero')
+            else:
+                return left % right
+        elif expr.type == NodeType.COMPARISION or expr.type == NodeType.EQUALITY:
+            op = expr.children[0].type
+            right = self.exec_expr(expr.children[2])
+            if type(left) not in NUMBER_TYPES or type(right) not in NUMBER_TYPES:
+                if type(left) in FUNCTION_TYPES or type(right) in FUNCTION_TYPES:
+                    error('cannot compare functions')
+                elif type(left) is Array or type(right) is Array:
+                    error('cannot compare arrays')
+                elif kind(left) != kind(right):
+                    error('cannot compare unequal types')
+            if op == TokenType.LESSER:
+                return int(left < right)
+            elif op == TokenType.EQUALS_EQUALS:
+                return int(left == right)
+            elif op == TokenType.BANG_EQUALS:
+                return int(left != right)
+            elif op == TokenType.GREATER:
+                return int(left > right)
+            elif op == TokenType.GREATER_EQUALS:
+                return int(left >= right)
+            else:
+                return int(left <= right)
         elif expr.type == NodeType.MULTIPLICATION:
-            left = self.exec_expr(expr.children[1])
             right = self.exec_expr(expr.children[2])
-            if left.type != NodeType.NUMBER or right.type != NodeType.NUMBER:
+            if type(left) not in NUMBER_TYPES or type(right) not in NUMBER_TYPES:
                 error('can only multiply or divide numbers')
             elif expr.children[0].type == TokenType.STAR:
-                return ASTNode(NodeType.NUMBER, [left.children[0] * right.children[0]])
-            elif right.children[1] == 0.0:
+                return left * right
+            elif right == 0:
                 error('cannot divide by zero')
             else:
-                return ASTNode(NodeType.NUMBER, [left.children[0] / right.children[0]])
-        elif expr.type == NodeType.EQUALITY:
-            left = self.exec_expr(expr.children[1])
-            right = self.exec_expr(expr.children[2])
-            if left.type == NodeType.FUNCTION or right.type == NodeType.FUNCTION:
-                error('cannot compare functions')
-
-            if left.type != right.type:
-                error('cannot compare unequal types')
-            elif expr.children[0].type == TokenType.EQUALS_EQUALS:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] == right.children[0])])
-            else:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] != right.children[0])])
-        elif expr.type == NodeType.COMPARISION:
-            left = self.exec_expr(expr.children[1])
-            right = self.exec_expr(expr.children[2])
-            if left.type == NodeType.FUNCTION or right.type == NodeType.FUNCTION:
-                error('cannot compare functions')
-
-            if left.type != right.type:
-                error('cannot compare unequal types')
-            elif expr.children[0].type == TokenType.GREATER:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] > right.children[0])])
-            elif expr.children[0].type == TokenType.GREATER_EQUALS:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] >= right.children[0])])
-            elif expr.children[0].type == TokenType.LESSER:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] < right.children[0])])
-            elif expr.children[0].type == TokenType.LESSER_EQUALS:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] <= right.children[0])])
+                return left / right
         elif expr.type == NodeType.BITSHIFT:
-            left = self.exec_expr(expr.children[1])
             right = self.exec_expr(expr.children[2])
-            if left.type == NodeType.FUNCTION or right.type == NodeType.FUNCTION:
+            if type(left) in FUNCTION_TYPES or type(right) in FUNCTION_TYPES:
                 error('cannot bitshift functions')
 
-            if left.type != NodeType.NUMBER or right.type != NodeType.NUMBER:
-                error('can only bitshift numbers')
+            if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+                error('can only bitshift integers')
+            elif right < 0:
+                error('cannot shift by a negative amount')
             elif expr.children[0].type == TokenType.LEFT_SHIFT:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] << right.children[0])])
-            else:
-                return ASTNode(NodeType.NUMBER, [int(left.children[0] >> right.children[0])])
-        elif expr.type == NodeType.UNARY:
-            left = self.exec_expr(expr.children[1])
-            if left.type == NodeType.FUNCTION:
-                error(f'cannot use "{expr.children[0].lexeme}" on functions')
-
-            if expr.children[0].type == TokenType.BANG:
-                return ASTNode(NodeType.NUMBER, [not left.children[0]])
-            elif left.type != NodeType.NUMBER:
-                error(f'can only use "{expr.children[0].lexeme}" on numbers')
-            elif expr.children[0].type == TokenType.MINUS:
-                return ASTNode(NodeType.NUMBER, [-left.children[0]])
+                return int(left << right)
             else:
-                return ASTNode(NodeType.NUMBER, [~left.children[0]])
+                return int(left >> right)
         elif expr.type == NodeType.LOGOR:
-            left = self.exec_expr(expr.children[0])
-            if left.children[0]:
-                return ASTNode(NodeType.NUMBER, [1.0])
+            if left:
+                return 1
             else:
                 return self.exec_expr(expr.children[1])
         elif expr.type == NodeType.LOGAND:
-            left = self.exec_expr(expr.children[0])
-            if not left.children[0]:
-                return ASTNode(NodeType.NUMBER, [0.0])
+            if not left:
+                return 0
             else:
                 return self.exec_expr(expr.children[1])
         elif expr.type == NodeType.BITOR:
-            left = self.exec_expr(expr.children[0])
             right = self.exec_expr(expr.children[1])
-            if left.type != NodeType.NUMBER or right.type != NodeType.NUMBER:
-                error('can only perform bitwise or on numbers')
+            if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+                error('can only perform bitwise or on integers')
             else:
-                return ASTNode(NodeType.NUMBER, [left.children[0] | right.children[0]])
+                return left | right
         elif expr.type == NodeType.BITXOR:
-            left = self.exec_expr(expr.children[0])
             right = self.exec_expr(expr.children[1])
-            if left.type != NodeType.NUMBER or right.type != NodeType.NUMBER:
-                error('can only perform bitwise xor on numbers')
+            if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+                error('can only perform bitwise xor on integers')
             else:
-                return ASTNode(NodeType.NUMBER, [left.children[0] ^ right.children[0]])
+                return left ^ right
         elif expr.type == NodeType.BITAND:
-            left = self.exec_expr(expr.children[0])
             right = self.exec_expr(expr.children[1])
-            if left.type != NodeType.NUMBER or right.type != NodeType.NUMBER:
-                error('can only perform bitwise and on numbers')
-            else:
-                return ASTNode(NodeType.NUMBER, [left.children[0] ^ right.children[0]])
-        elif expr.type == NodeType.IDENTIFIER:
-            for environment in self.environments[::-1]:
-                if any(name == expr.children[0] for name in environment):
-                    var = environment[expr.children[0]]
-                    if var[0] == IdentifierType.VARIABLE:
-                        return var[1]
-                    else:
-                        return ASTNode(NodeType.FUNCTION, var[1])
+            if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+                error('can only perform bitwise and on integers')
             else:
-                error(f'{expr.children[0]}: no such variable in scope')
-        elif expr.type == NodeType.CALL:
-            if expr.children[0].type == NodeType.IDENTIFIER and expr.children[0].children[0] == 'print':
-                for arg in expr.children[1:]:
-                    arg = self.exec_expr(arg)
-                    print(arg.children[0])
-                return ASTNode(NodeType.NUMBER, [1.0])
-            function = self.exec_expr(expr.children[0])
-            if function.type != NodeType.FUNCTION:
-                error('cannot call a non-function')
-            elif len(function.children[0]) != len(expr.children[1:]):
-                error(
-                    f'arity mismatch, expected {len(function.children[0])} arguments, got {len(expr.children[1:])}')
+                return left & right
+
+    def unary(self, op: Token, operand: Any) -> Any:
+        if type(operand) in FUNCTION_TYPES:
+            error(f'cannot use "{op.lexeme}" on functions')
+
+        if op.type == TokenType.BANG:
+            return not operand
+        elif type(operand) not in NUMBER_TYPES:
+            error(f'can only use "{op.lexeme}" on numbers')
+        elif op.type == TokenType.MINUS:
+            return -operand
+        elif type(operand) not in INTEGER_TYPES:
+            error(f'can only use "{op.lexeme}" on integers')
+        else:
+            return ~operand
+
+    def apply(self, function: Any, args: List[Any]) -> Any:
+        # Calls a function with arguments that are already evaluated
+        if type(function) is not Closure and type(function) is not Native:
+            error('cannot call a non-function')
+        elif function.arity is not None and function.arity != len(args):
+            error(
+                f'arity mismatch, expected {function.arity} arguments, got {len(args)}')
+        elif type(function) is Native:
+            # Natives are never memoized: their results may be fresh arrays,
+            # or depend on what an array holds at the time
+            self.impure = True
+            return function.function(self, args)
+        frame = function.new_frame()
+        frame[1:len(args) + 1] = args
+        return self.invoke(function, frame)
+
+    def invoke(self, function: Closure, frame: List[Any]) -> Any:
+        # Runs the body of 'function' in 'frame', which holds its arguments.
+        # The memo is looked up here rather than in a method of its own, so
+        # that a memoized call takes no more Python frames than any other.
+        key = None
+        if function.pure is not None and self.memo is not None:
+            cells = self.cells
+            for name in function.pure:
+                if name in cells:
+                    # The function would read or assign that global
+                    break
             else:
-                self.environments.append(dict())
-                for (param, arg) in zip(function.children[0], expr.children[1:]):
-                    arg = self.exec_expr(arg)
-                    if arg.type == NodeType.FUNCTION:
-                        self.environments[-1][param.lexeme] = (
-                            IdentifierType.FUNCTION, arg.children)
-                    else:
-                        self.environments[-1][param.lexeme] = (
-                            IdentifierType.VARIABLE, arg)
-                try:
-                    for stmt in function.children[1].children:
-                        self.exec_stmt(stmt)
-                except ReturnValue as value:
-                    return value.value
-                self.environments.pop()
-
-    def execute(self, stmts: List[ASTNode]) -> int:
-        self.environments.append(dict())
+                args = tuple(frame[1:function.arity + 1])
+                key = (function, args, tuple(map(type, args)))
+                memo = self.memo
+                value = memo.get(key)
+                if value is not None:
+                    memo.move_to_end(key)
+                    self.memo_hits += 1
+                    function.misses = 0
+                    function.release(frame)
+                    return value
+                self.memo_misses += 1
+                function.misses += 1
+                if function.misses >= MEMO_PATIENCE:
+                    function.pure = None
+                outer = self.impure
+                self.impure = False
+        if key is None:
+            self.impure = True
+
+        caller = self.frame
+        self.frame = frame
+        value = 0
+        try:
+            for stmt in function.body:
+                self.exec_stmt(stmt)
+        except ReturnValue as returned:
+            value = returned.value
+        finally:
+            self.frame = caller
+            function.release(frame)
+
+        if key is not None:
+            if not self.impure:
+                memo[key] = value
+                if len(memo) > self.memo_size:
+                    memo.popitem(last=False)
+            self.impure = outer or self.impure
+        return value
+
+    def execute(self, stmts: Iterable[ASTNode]) -> int:
+        # Each top-level statement is resolved and run before the next one is
+        # pulled, so a generator from Parser.parse_stream works as well as a list
         for stmt in stmts:
-            self.exec_stmt(stmt)
-        self.environments.pop()
+            self.resolver.resolve([stmt])
+            self.run([stmt], self.resolver.script_slots)
         return 0
+
+    def run(self, stmts: List[ASTNode], slots: int) -> None:
+        # Runs statements that were already resolved, needing a script frame
+        # of 'slots' slots
+        self.frame.extend([None] * (slots - len(self.frame)))
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(int(limit * RECURSION_SCALE))
+        try:
+            for stmt in stmts:
+                self.exec_stmt(stmt)
+        finally:
+            sys.setrecursionlimit(limit)
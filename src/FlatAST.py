@@ -0,0 +1,171 @@
+from array import array
+from typing import *
+
+from Parser import ASTNode, NodeType
+from Token import Token, TokenType
+from Value import constant_key
+
+# Every child of a node is stored as one int in 'operands', tagged in its low
+# two bits with what the rest of the int indexes
+NODE = 0  # another node id
+LITERAL = 1  # an entry in the literal pool (str, float, int, bool)
+TOKEN = 2  # a token id
+NONE = 3  # None, such as a missing else branch
+
+# Kind of the pseudo-node used for plain lists of children, like the
+# parameter list of a function
+LIST = 0
+
+NODE_TYPES = {node_type.value: node_type for node_type in NodeType}
+TOKEN_TYPES = {token_type.value: token_type for token_type in TokenType}
+
+
+class FlatAST:
+    def __init__(self):
+        # Nodes, indexed by node id
+        self.kinds = array('B')
+        self.first = array('I')  # offset of the node's children in operands
+        self.counts = array('I')
+        self.lines = array('I')
+        self.operands = array('I')
+        # Tokens, indexed by token id
+        self.token_types = array('B')
+        self.token_lines = array('I')
+        self.token_lexemes = array('I')  # index into literals
+        self.literals = []
+        self.literal_index = {}
+        self.roots = array('I')
+
+    def add_literal(self, value: Any) -> int:
+        key = constant_key(value)
+        if key not in self.literal_index:
+            self.literal_index[key] = len(self.literals)
+            self.literals.append(value)
+        return self.literal_index[key]
+
+    def add_token(self, token: Token) -> int:
+        self.token_types.append(token.type.value)
+        self.token_lines.append(token.line)
+        self.token_lexemes.append(self.add_literal(token.lexeme))
+        return len(self.token_types) - 1
+
+    def add_node(self, kind: int, count: int, line: int = 0) -> int:
+        self.kinds.append(kind)
+        self.first.append(len(self.operands))
+        self.counts.append(count)
+        self.lines.append(line)
+        self.operands.extend([0] * count)
+        return len(self.kinds) - 1
+
+    @classmethod
+    def from_nodes(cls, nodes: List[ASTNode]) -> 'FlatAST':
+        flat = cls()
+        # Explicit stack instead of recursion, so that deeply nested
+        # expressions do not hit the recursion limit. Each entry is a child
+        # still to be stored, and the operand slot that should point at it.
+        pending = [(node, None) for node in reversed(nodes)]
+        while pending:
+            child, where = pending.pop()
+            if isinstance(child, ASTNode):
+                ref = flat.add_node(child.type.value, len(child.children), child.line)
+                children = child.children
+            elif isinstance(child, list):
+                ref = flat.add_node(LIST, len(child))
+                children = child
+            else:
+                ref = None
+                children = ()
+
+            if ref is not None:
+                encoded = ref << 2 | NODE
+                start = flat.first[ref]
+                for i in range(len(children) - 1, -1, -1):
+                    pending.append((children[i], start + i))
+            elif isinstance(child, Token):
+                encoded = flat.add_token(child) << 2 | TOKEN
+            elif child is None:
+                encoded = NONE
+            else:
+                encoded = flat.add_literal(child) << 2 | LITERAL
+
+            if where is None:
+                flat.roots.append(encoded >> 2)
+            else:
+                flat.operands[where] = encoded
+        return flat
+
+    def to_nodes(self) -> List[ASTNode]:
+        tokens = [Token(self.literals[self.token_lexemes[i]], TOKEN_TYPES[self.token_types[i]],
+                        self.token_lines[i]) for i in range(len(self.token_types))]
+        nodes = [None] * len(self.kinds)
+        # Indexed by tag, so that an operand decodes to pools[tag][index]
+        # (a NONE operand has index 0)
+        pools = (nodes, self.literals, tokens, [None])
+        kinds = self.kinds.tolist()
+        first = self.first.tolist()
+        counts = self.counts.tolist()
+        operands = self.operands.tolist()
+        lines = self.lines.tolist()
+        # Children always have larger ids than their parents
+        for node in range(len(kinds) - 1, -1, -1):
+            start = first[node]
+            children = [pools[operand & 3][operand >> 2]
+                        for operand in operands[start:start + counts[node]]]
+            kind = kinds[node]
+            nodes[node] = children if kind == LIST else ASTNode(
+                NODE_TYPES[kind], children, lines[node])
+        return [nodes[root] for root in self.roots]
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def kind(self, node: int) -> Optional[NodeType]:
+        kind = self.kinds[node]
+        return None if kind == LIST else NODE_TYPES[kind]
+
+    def line(self, node: int) -> int:
+        return self.lines[node]
+
+    def child_count(self, node: int) -> int:
+        return self.counts[node]
+
+    def operand(self, node: int, i: int) -> Tuple[int, int]:
+        operand = self.operands[self.first[node] + i]
+        return operand & 3, operand >> 2
+
+    def child(self, node: int, i: int) -> Any:
+        # Node ids come back as ints, everything else as its value
+        tag, index = self.operand(node, i)
+        if tag == NODE:
+            return index
+        elif tag == LITERAL:
+            return self.literals[index]
+        elif tag == TOKEN:
+            return self.token(index)
+        else:
+            return None
+
+    def children(self, node: int) -> List[Any]:
+        return [self.child(node, i) for i in range(self.counts[node])]
+
+    def literal(self, node: int) -> Any:
+        # Payload of a STRING, NUMBER or IDENTIFIER node
+        return self.child(node, 0)
+
+    def token(self, token: int) -> Token:
+        return Token(self.literals[self.token_lexemes[token]], TOKEN_TYPES[self.token_types[token]],
+                     self.token_lines[token])
+
+    def token_type(self, token: int) -> TokenType:
+        return TOKEN_TYPES[self.token_types[token]]
+
+    def walk(self, root: int) -> Iterator[int]:
+        # Pre-order over the node ids below 'root', including list pseudo-nodes
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            yield node
+            for i in range(self.counts[node] - 1, -1, -1):
+                tag, index = self.operand(node, i)
+                if tag == NODE:
+                    stack.append(index)
@@ -0,0 +1,48 @@
+import operator
+from typing import *
+
+from Parser import ASTNode, NodeType
+from Token import Token, TokenType
+
+# Shapes of code common enough in loops that the engines give them fused fast
+# paths, Executor.counted_loop and the VM's TEST and UPDATE instructions.
+# Every fast path only applies while the values involved are numbers, and
+# otherwise does exactly what the unfused code would.
+
+# Comparisons a fused test may use, as the function comparing two numbers
+TESTS = {
+    TokenType.LESSER: operator.lt,
+    TokenType.LESSER_EQUALS: operator.le,
+    TokenType.GREATER: operator.gt,
+    TokenType.GREATER_EQUALS: operator.ge,
+    TokenType.EQUALS_EQUALS: operator.eq,
+    TokenType.BANG_EQUALS: operator.ne,
+}
+
+
+def counter_test(expr: ASTNode) -> Optional[Tuple[Token, ASTNode, ASTNode]]:
+    # The operator and operands of a comparison like 'i < n', of a variable
+    # against a variable or a number
+    if expr.type != NodeType.COMPARISION and expr.type != NodeType.EQUALITY:
+        return None
+    op, left, right = expr.children
+    if op.type in TESTS and left.type == NodeType.IDENTIFIER \
+            and (right.type == NodeType.IDENTIFIER or right.type == NodeType.NUMBER):
+        return op, left, right
+    return None
+
+
+def self_update(stmt: ASTNode) -> Optional[Tuple[Token, ASTNode]]:
+    # The operator and right operand of a statement like 'i = i + 1' or
+    # 't = t - x', adding or subtracting a number or a variable, None for any
+    # other statement
+    if stmt.type != NodeType.VAR:
+        return None
+    init = stmt.children[1]
+    if init.type != NodeType.ADDITION or init.children[0].type == TokenType.MODULO:
+        return None
+    op, left, right = init.children
+    if left.type != NodeType.IDENTIFIER or (right.type != NodeType.NUMBER and right.type != NodeType.IDENTIFIER) \
+            or left.children != [stmt.children[0].lexeme] + stmt.children[2:5]:
+        return None
+    return op, right
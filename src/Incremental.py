@@ -0,0 +1,268 @@
+import re
+from bisect import bisect_left
+from typing import *
+
+from Error import *
+from Executor import MEMO_SIZE, Executor
+from Optimizer import LEVELS, Optimizer
+from Parser import ASTNode, Parser
+from Scanner import TOKEN_PATTERN, FastScanner
+from Token import Token
+
+
+def common_prefix(a: str, b: str) -> int:
+    # Length of the longest common prefix of a and b, found by comparing
+    # slices, halving the range each time, rather than character by character
+    low, high = 0, min(len(a), len(b))
+    if a[:high] == b[:high]:
+        return high
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    # Length of the longest common suffix of a and b, up to 'limit'
+    end_a, end_b = len(a), len(b)
+    if a[end_a - limit:] == b[end_b - limit:]:
+        return limit
+    low, high = 0, limit
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[end_a - middle:end_a - low] == b[end_b - middle:end_b - low]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+# Characters the scanner skips, and comments, which it skips to the end of
+# the line
+BLANK = r"(?:[^\w'\#|&^!=<>+%*/~(){};,-]|\#[^\n]*(?![^\n]))"
+
+# What declaration_spans looks at: newlines (counted as the scanner does,
+# not inside strings), braces, semicolons, a '}' that 'else' follows, and
+# strings and comments, whose contents are skipped. Anything else is passed
+# over a run at a time.
+STRUCTURE_PATTERN = re.compile(r"""
+    (\n)
+  | (\{)
+  | (\}(?=""" + BLANK + r"""*else(?!\w)))
+  | (\})
+  | (;)
+  | '(?:[^'\\]|\\.)*'|'
+  | \#[^\n]*
+  | [^{};'\#\n]+
+""", re.VERBOSE | re.DOTALL)
+
+BLANK_PATTERN = re.compile(BLANK + '*')
+
+NEWLINE, OPEN, CONTINUED, CLOSE, SEMICOLON = 1, 2, 3, 4, 5
+
+
+def declaration_spans(source: str, start: int = 0, line: int = 1) -> Iterator[Tuple[int, int, bool]]:
+    # The ends of the top-level declarations in 'source' from offset 'start'
+    # on, which is on line 'line', found without scanning or parsing: one
+    # ends after a ';' or a '}' outside of any braces, unless 'else' follows
+    # the '}'. Each is (offset of its end, line of its end, whether it is
+    # finished); only the last one can be unfinished, and then ends at the
+    # end of the source.
+    depth = 0
+    end = start
+    for match in STRUCTURE_PATTERN.finditer(source, start):
+        kind = match.lastindex
+        if kind is None:
+            continue
+        elif kind == NEWLINE:
+            line += 1
+        elif kind == OPEN:
+            depth += 1
+        elif kind == CONTINUED:
+            depth = max(depth - 1, 0)
+        elif kind == CLOSE:
+            # An unbalanced '}' ends the declaration, for the parser to reject
+            depth = max(depth - 1, 0)
+            if depth == 0:
+                end = match.end()
+                yield end, line, True
+        elif depth == 0:
+            end = match.end()
+            yield end, line, True
+    if BLANK_PATTERN.match(source, end).end() < len(source):
+        yield len(source), line, False
+
+
+def shift_lines(stmts: List[ASTNode], delta: int) -> None:
+    # Moves the nodes and tokens of a declaration 'delta' lines down, once
+    # each even where the optimizer shares them. Lines of 0 stay unknown.
+    stack = list(stmts)
+    seen = set()
+    while stack:
+        item = stack.pop()
+        if type(item) is list or type(item) is tuple:
+            stack.extend(item)
+        elif (type(item) is ASTNode or type(item) is Token) and id(item) not in seen:
+            seen.add(id(item))
+            if item.line:
+                item.line += delta
+            if type(item) is ASTNode:
+                stack.extend(item.children)
+
+
+def complete(source: str) -> bool:
+    # Whether every declaration in 'source' is finished, so that a REPL
+    # knows when to stop reading lines
+    return all(finished for _, _, finished in declaration_spans(source))
+
+
+class Declaration:
+    __slots__ = ('end', 'end_line', 'line', 'text', 'nodes', 'moved', 'done')
+
+    def __init__(self, end: int, end_line: int, line: int, text: str, stmts: List[ASTNode]):
+        self.end = end  # offset in the source just past the declaration
+        self.end_line = end_line
+        self.line = line  # the line its text starts on
+        self.text = text  # from its first token on, which is its fingerprint
+        self.nodes = stmts
+        self.moved = 0  # lines its nodes are behind 'line'
+        self.done = False  # set once it has run
+
+    @property
+    def stmts(self) -> List[ASTNode]:
+        # Lines added or removed before the declaration are only applied to
+        # its nodes when they are next needed, so that an edit does not cost
+        # a walk over every declaration after it
+        if self.moved:
+            shift_lines(self.nodes, self.moved)
+            self.moved = 0
+        return self.nodes
+
+
+class IncrementalParser:
+    # Parses successive versions of a script, re-parsing only the top-level
+    # declarations that changed. The declarations before the first change
+    # and after the last one are kept without even being scanned again, and
+    # those in between are only split up by declaration_spans, reusing every
+    # one whose text is unchanged, so that a small edit costs about the same
+    # whatever the size of the script.
+    def __init__(self, optimizer: Optional[Optimizer] = None):
+        self.optimizer = optimizer
+        self.source = ''
+        self.declarations = []
+        self.ends = []  # the end offset of each declaration, for bisecting
+        self.parsed = 0  # declarations parsed by the last update
+
+    def update(self, source: str) -> List[Declaration]:
+        old, declarations = self.source, self.declarations
+        prefix = common_prefix(old, source)
+        suffix = common_suffix(old, source, min(len(old), len(source)) - prefix)
+        delta = len(source) - len(old)
+
+        # Splitting starts a declaration before the one the edit starts in,
+        # as whether a declaration ends with its '}' depends on the token
+        # after it, which the edit may have turned into an 'else'
+        first = max(bisect_left(self.ends, prefix) - 1, 0)
+        start, line = (declarations[first - 1].end, declarations[first - 1].end_line) if first else (0, 1)
+
+        # Split from there until a declaration ends where one used to end
+        # in the unchanged suffix, after which the old ones are kept
+        last = len(declarations)
+        shift = 0
+        spans = []
+        for end, end_line, _ in declaration_spans(source, start, line):
+            spans.append((start, end, line, end_line))
+            start, line = end, end_line
+            if end >= len(source) - suffix:
+                last = bisect_left(self.ends, end - delta, first)
+                if last < len(declarations) and self.ends[last] == end - delta:
+                    last += 1
+                    shift = end_line - declarations[last - 1].end_line
+                    break
+                last = len(declarations)
+
+        # Unchanged declarations among those the edit may have touched are
+        # reused, such as the ones between two edits far apart
+        unchanged = dict()
+        for declaration in declarations[first:last]:
+            unchanged.setdefault(declaration.text, []).append(declaration)
+
+        # Nothing is changed until every new declaration parsed, so that a
+        # syntax error leaves the previous version in place
+        replaced = []
+        parsed = 0
+        for begin, end, begin_line, end_line in spans:
+            text_start = BLANK_PATTERN.match(source, begin, end).end()
+            text = source[text_start:end]
+            text_line = begin_line + source.count('\n', begin, text_start)
+            reused = unchanged.get(text)
+            if reused:
+                replaced.append((reused.pop(0), end, end_line, text_line))
+                continue
+            stmts = Parser().parse(FastScanner().scan_source(source[begin:end], begin_line))
+            if self.optimizer is not None:
+                stmts = self.optimizer.optimize(stmts)
+            replaced.append((Declaration(end, end_line, text_line, text, stmts), end, end_line, text_line))
+            parsed += 1
+
+        # Reused and kept declarations keep their nodes, whose lines move
+        # with any lines added or removed before them
+        for declaration, end, end_line, text_line in replaced:
+            declaration.end = end
+            declaration.end_line = end_line
+            declaration.moved += text_line - declaration.line
+            declaration.line = text_line
+        kept = declarations[last:]
+        for declaration in kept:
+            declaration.end += delta
+            declaration.end_line += shift
+            declaration.line += shift
+            declaration.moved += shift
+        self.declarations = declarations[:first] + [declaration for declaration, _, _, _ in replaced] + kept
+        self.ends = [declaration.end for declaration in self.declarations]
+        self.source = source
+        self.parsed = parsed
+        return self.declarations
+
+
+class Session:
+    # A tree walker whose globals stay alive from one input to the next, as
+    # in a REPL. 'run' runs a piece of code, and 'update' brings in the
+    # current version of a script, running only the declarations that are
+    # new or changed (or did not finish running) since the last update of
+    # the script of the same name. Declarations that were removed are not
+    # undone: what they defined stays defined.
+    def __init__(self, output: Optional[TextIO] = None, level: int = 0, memo_size: int = MEMO_SIZE):
+        self.executor = Executor(output, memo_size)
+        self.optimizer = Optimizer(LEVELS[level])
+        self.scripts = dict()  # name -> IncrementalParser
+
+    @property
+    def globals(self) -> Dict[str, Any]:
+        return self.executor.globals
+
+    def run(self, source: str) -> None:
+        self.execute(self.optimizer.optimize(Parser().parse(FastScanner().scan_source(source))))
+
+    def update(self, source: str, name: str = '') -> int:
+        # Returns the number of declarations that ran
+        parser = self.scripts.get(name)
+        if parser is None:
+            parser = self.scripts[name] = IncrementalParser(self.optimizer)
+        ran = 0
+        for declaration in parser.update(source):
+            if not declaration.done:
+                self.execute(declaration.stmts)
+                declaration.done = True
+                ran += 1
+        return ran
+
+    def execute(self, stmts: List[ASTNode]) -> None:
+        try:
+            self.executor.execute(stmts)
+        except RecursionError:
+            # Deep recursion on the tree walker runs out of Python stack
+            error('maximum recursion depth exceeded')
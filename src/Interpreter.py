@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+from io import StringIO
+from typing import *
+
+from Compiler import Compiler
+from Error import *
+from Executor import Executor
+from Natives import NATIVES
+from Optimizer import LEVELS, Optimizer
+from Parser import ASTNode, Parser
+from Resolver import Resolver
+from Scanner import FastScanner
+from Transpiler import PythonEngine, Transpiler
+from Value import NUMBER_TYPES, Array, Rope
+from VM import VM
+
+ENGINES = ['tree', 'vm', 'python']
+
+
+class Result:
+    __slots__ = ('output', 'globals')
+
+    def __init__(self, output: str, globals: Dict[str, Any]):
+        self.output = output  # everything the script printed
+        self.globals = globals  # the script's globals once it finished
+
+
+class Program:
+    # A script scanned, parsed, optimized and resolved (or compiled) once, that
+    # can then be run any number of times. Every run starts from a fresh
+    # environment, so runs do not see each other's globals.
+    def __init__(self, source: str, engine: str = 'tree', level: int = 0, ast: Optional[List[ASTNode]] = None):
+        # 'ast' is the source already parsed, such as a copy from the cache
+        if engine not in ENGINES:
+            error(f'unknown engine {engine}')
+        if level not in LEVELS:
+            error(f'unknown optimization level {level}')
+        self.engine = engine
+        if ast is None:
+            ast = Parser().parse(FastScanner().scan_source(source))
+        ast = Optimizer(LEVELS[level]).optimize(ast)
+        if engine == 'vm':
+            self.code = Compiler().compile(ast)
+        elif engine == 'python':
+            self.code = Transpiler().compile(ast)
+        else:
+            resolver = Resolver()
+            self.stmts = resolver.resolve(ast)
+            self.slots = resolver.script_slots
+
+    def run(self, globals: Optional[Dict[str, Any]] = None, output: Optional[StringIO] = None) -> Result:
+        # Passing 'output' keeps what was printed readable if the script fails
+        if output is None:
+            output = StringIO()
+        return self.result(self.execute(globals, output), output)
+
+    def execute(self, globals: Optional[Dict[str, Any]] = None, output: Optional[TextIO] = None) -> Any:
+        # Runs the script printing to 'output' (sys.stdout if None), returning
+        # the engine it ran on
+        if self.engine == 'vm':
+            engine = VM(output)
+        elif self.engine == 'python':
+            engine = PythonEngine(output)
+        else:
+            engine = Executor(output)
+        self.seed(engine, globals)
+
+        try:
+            if self.engine != 'tree':
+                engine.execute(self.code)
+            else:
+                engine.run(self.stmts, self.slots)
+        except RecursionError:
+            # Deep recursion on the tree walker runs out of Python stack
+            error('maximum recursion depth exceeded')
+        return engine
+
+    @staticmethod
+    def seed(engine: Any, globals: Optional[Dict[str, Any]]) -> None:
+        # Defines the globals a run starts with
+        for name, value in (globals or {}).items():
+            if type(name) is not str:
+                error('global names must be strings')
+            elif type(value) not in NUMBER_TYPES and type(value) is not str:
+                error(f'{name}: globals must be numbers or strings')
+            engine.define(name, value)
+
+    def result(self, engine: Any, output: StringIO) -> Result:
+        return Result(output.getvalue(), {name: self.export(value) for name, value in engine.globals.items()
+                                          if value is not NATIVES.get(name)})
+
+    @staticmethod
+    def export(value: Any) -> Any:
+        # Ropes are an implementation detail, callers get plain strings, and
+        # arrays come out as lists
+        if type(value) is Rope:
+            return str(value)
+        elif type(value) is Array:
+            return value.values.tolist()
+        return value
+
+
+class Interpreter:
+    # Compiles scripts into Programs, keeping the most recently used ones so
+    # that running the same source again skips straight to executing it
+    def __init__(self, engine: str = 'tree', level: int = 0, cache_size: int = 128):
+        if engine not in ENGINES:
+            error(f'unknown engine {engine}')
+        if level not in LEVELS:
+            error(f'unknown optimization level {level}')
+        self.engine = engine
+        self.level = level
+        self.cache_size = cache_size
+        self.programs = OrderedDict()  # source -> Program, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, source: str) -> Program:
+        with self.lock:
+            program = self.programs.get(source)
+            if program is not None:
+                self.programs.move_to_end(source)
+                self.hits += 1
+                return program
+            self.misses += 1
+
+        # Compiled outside the lock, so that one slow script does not hold up
+        # the others; a script that fails to compile is not cached
+        program = Program(source, self.engine, self.level)
+        with self.lock:
+            self.programs[source] = program
+            self.programs.move_to_end(source)
+            while len(self.programs) > self.cache_size:
+                self.programs.popitem(last=False)
+        return program
+
+    def lookup(self, source: str) -> Optional[Program]:
+        # The program kept for 'source', None if there is none, never
+        # compiling it
+        with self.lock:
+            program = self.programs.get(source)
+            if program is not None:
+                self.programs.move_to_end(source)
+                self.hits += 1
+            return program
+
+    def run(self, source: str, globals: Optional[Dict[str, Any]] = None) -> Result:
+        return self.compile(source).run(globals)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.programs.clear()
@@ -0,0 +1,160 @@
+import time
+from array import array
+from operator import mul
+from typing import *
+
+from Error import *
+from Value import INTEGER_TYPES, NUMBER_TYPES, STRING_TYPES, Array, Native
+
+# Builtin functions, defined as globals before a script starts, so a script
+# may still declare a function or variable of the same name in their place.
+# Calls reach them like any other global function, a call site remembering
+# the native it found (see Executor.exec_expr). Each one is a single Python
+# operation over a whole array, instead of a tipy loop doing one element
+# per iteration. Builtins that wait, sleep and read_file, also come as a
+# coroutine for the AsyncVM, so that waiting only holds up the calling script.
+
+
+def make_array(values: Iterable[Any]) -> Array:
+    # Integers stay integers unless a float is among the values
+    values = [int(value) if type(value) is bool else value for value in values]
+    for value in values:
+        if type(value) not in NUMBER_TYPES:
+            error('arrays can only hold numbers')
+    try:
+        return Array(array('d' if float in map(type, values) else 'q', values))
+    except OverflowError:
+        error('array elements must fit in 64 bits')
+
+
+def check_array(name: str, value: Any) -> Array:
+    if type(value) is not Array:
+        error(f'{name}: expected an array')
+    return value
+
+
+def check_index(name: str, values: Array, index: Any) -> int:
+    if type(index) not in INTEGER_TYPES:
+        error(f'{name}: array indices must be integers')
+    elif not 0 <= index < len(values):
+        error(f'{name}: index {index} out of range for an array of length {len(values)}')
+    return index
+
+
+def native_print(engine: Any, args: List[Any]) -> int:
+    # Only runs when print is called through another name: a call written
+    # as print(...), while print is still this native, prints each argument
+    # as soon as it is evaluated instead
+    for value in args:
+        print(value, file=engine.output)
+    return 1
+
+
+def native_array(engine: Any, args: List[Any]) -> Array:
+    length, value = args
+    if type(length) not in INTEGER_TYPES or length < 0:
+        error('array: length must be a non-negative integer')
+    return Array(make_array([value]).values * length)
+
+
+def native_len(engine: Any, args: List[Any]) -> int:
+    value = args[0]
+    if type(value) is not Array and type(value) not in STRING_TYPES:
+        error('len: expected an array or a string')
+    return len(value)
+
+
+def native_get(engine: Any, args: List[Any]) -> Any:
+    values = check_array('get', args[0])
+    return values.values[check_index('get', values, args[1])]
+
+
+def native_set(engine: Any, args: List[Any]) -> Any:
+    values = check_array('set', args[0])
+    index = check_index('set', values, args[1])
+    value = args[2]
+    if type(value) not in NUMBER_TYPES:
+        error('set: arrays can only hold numbers')
+    if type(value) is float and values.values.typecode == 'q':
+        values.values = array('d', values.values)
+    try:
+        values.values[index] = value
+    except OverflowError:
+        error('array elements must fit in 64 bits')
+    return value
+
+
+def native_sum(engine: Any, args: List[Any]) -> Any:
+    return sum(check_array('sum', args[0]).values)
+
+
+def native_dot(engine: Any, args: List[Any]) -> Any:
+    left = check_array('dot', args[0])
+    right = check_array('dot', args[1])
+    if len(left) != len(right):
+        error(f'dot: arrays of length {len(left)} and {len(right)} differ in length')
+    return sum(map(mul, left.values, right.values))
+
+
+def native_map(engine: Any, args: List[Any]) -> Array:
+    # Applies a function to every element, into a new array
+    function = args[0]
+    values = check_array('map', args[1])
+    return make_array([engine.apply(function, [value]) for value in values.values])
+
+
+def check_seconds(value: Any) -> Any:
+    if type(value) not in NUMBER_TYPES or value < 0:
+        error('sleep: expected a non-negative number of seconds')
+    return value
+
+
+def native_sleep(engine: Any, args: List[Any]) -> int:
+    time.sleep(check_seconds(args[0]))
+    return 0
+
+
+async def async_sleep(engine: Any, args: List[Any]) -> int:
+    # asyncio is only imported once a script runs asynchronously, the
+    # command line never needs it
+    import asyncio
+    await asyncio.sleep(check_seconds(args[0]))
+    return 0
+
+
+def check_path(value: Any) -> str:
+    if type(value) not in STRING_TYPES:
+        error('read_file: expected a file name')
+    return str(value)
+
+
+def read_file(path: str) -> str:
+    try:
+        with open(path, 'rt') as file:
+            return file.read()
+    except (OSError, UnicodeDecodeError):
+        error(f'read_file: cannot read {path}')
+
+
+def native_read_file(engine: Any, args: List[Any]) -> str:
+    return read_file(check_path(args[0]))
+
+
+async def async_read_file(engine: Any, args: List[Any]) -> str:
+    # Reading runs on a worker thread, files have no non-blocking reads
+    import asyncio
+    return await asyncio.to_thread(read_file, check_path(args[0]))
+
+
+NATIVES = {native.name: native for native in [
+    Native('print', None, native_print),
+    Native('array', 2, native_array),
+    Native('len', 1, native_len),
+    Native('get', 2, native_get),
+    Native('set', 3, native_set),
+    Native('sum', 1, native_sum),
+    Native('dot', 2, native_dot),
+    Native('map', 2, native_map),
+    Native('sleep', 1, native_sleep, async_sleep),
+    Native('read_file', 1, native_read_file, async_read_file),
+]}
@@ -0,0 +1,192 @@
+from typing import *
+
+from Parser import ASTNode, NodeType
+from Token import TokenType
+
+FOLD = 'fold'
+BRANCHES = 'branches'
+UNREACHABLE = 'unreachable'
+
+# Passes enabled at each -O level
+LEVELS = {
+    0: [],
+    1: [FOLD],
+    2: [FOLD, BRANCHES, UNREACHABLE],
+}
+
+NUMBER_TYPES = (int, float, bool)
+LITERALS = (NodeType.NUMBER, NodeType.STRING)
+
+# Shifting by more than this is left for runtime, rather than building huge
+# integers while optimizing
+MAX_FOLDED_SHIFT = 64
+
+
+def literal(value: Any, line: int = 0) -> ASTNode:
+    if type(value) is str:
+        return ASTNode(NodeType.STRING, [value], line)
+    return ASTNode(NodeType.NUMBER, [value], line)
+
+
+class Optimizer:
+    def __init__(self, passes: Iterable[str] = LEVELS[2]):
+        self.passes = set(passes)
+        self.changes = {FOLD: 0, BRANCHES: 0, UNREACHABLE: 0}
+
+    def report(self) -> str:
+        return '\n'.join([
+            f'{FOLD}: {self.changes[FOLD]} constant expressions folded',
+            f'{BRANCHES}: {self.changes[BRANCHES]} constant branches pruned',
+            f'{UNREACHABLE}: {self.changes[UNREACHABLE]} unreachable statements removed',
+        ])
+
+    def optimize(self, stmts: List[ASTNode]) -> List[ASTNode]:
+        return self.optimize_block(stmts)
+
+    def optimize_stream(self, stmts: Iterable[ASTNode]) -> Iterator[ASTNode]:
+        for stmt in stmts:
+            yield from self.optimize_block([stmt])
+
+    def optimize_block(self, stmts: List[ASTNode]) -> List[ASTNode]:
+        optimized = []
+        for i, stmt in enumerate(stmts):
+            stmt = self.optimize_stmt(stmt)
+            if stmt is not None:
+                optimized.append(stmt)
+            if stmt is not None and stmt.type == NodeType.RETURN and UNREACHABLE in self.passes:
+                self.changes[UNREACHABLE] += len(stmts) - i - 1
+                break
+        return optimized
+
+    def optimize_stmt(self, stmt: ASTNode) -> Optional[ASTNode]:
+        if stmt.type == NodeType.BLOCK:
+            stmt.children = self.optimize_block(stmt.children)
+        elif stmt.type == NodeType.FUN:
+            stmt.children[2].children = self.optimize_block(
+                stmt.children[2].children)
+        elif stmt.type == NodeType.IF:
+            stmt.children[0] = self.optimize_expr(stmt.children[0])
+            stmt.children[1] = self.optimize_stmt(stmt.children[1])
+            if stmt.children[2] is not None:
+                stmt.children[2] = self.optimize_stmt(stmt.children[2])
+            if stmt.children[0].type in LITERALS and BRANCHES in self.passes:
+                self.changes[BRANCHES] += 1
+                if stmt.children[0].children[0]:
+                    return stmt.children[1]
+                return stmt.children[2]
+        elif stmt.type == NodeType.WHILE:
+            stmt.children[0] = self.optimize_expr(stmt.children[0])
+            stmt.children[1] = self.optimize_stmt(stmt.children[1])
+            cond = stmt.children[0]
+            if cond.type in LITERALS and not cond.children[0] and BRANCHES in self.passes:
+                self.changes[BRANCHES] += 1
+                return None
+        elif stmt.type == NodeType.RETURN or stmt.type == NodeType.EXPR:
+            stmt.children[0] = self.optimize_expr(stmt.children[0])
+        elif stmt.type == NodeType.VAR:
+            stmt.children[1] = self.optimize_expr(stmt.children[1])
+        return stmt
+
+    def optimize_expr(self, expr: ASTNode) -> ASTNode:
+        # Post-order walk with an explicit stack, so that long operator chains
+        # do not hit the recursion limit. Each entry is the list holding a
+        # node, its index there, and whether its children are done.
+        root = [expr]
+        stack = [(root, 0, False)]
+        while stack:
+            parent, i, done = stack.pop()
+            expr = parent[i]
+            if expr.type in LITERALS or expr.type == NodeType.IDENTIFIER:
+                continue
+            elif not done:
+                stack.append((parent, i, True))
+                for j, child in enumerate(expr.children):
+                    if isinstance(child, ASTNode):
+                        stack.append((expr.children, j, False))
+            elif FOLD in self.passes:
+                folded = self.fold(expr)
+                if folded is not None:
+                    self.changes[FOLD] += 1
+                    if not folded.line:
+                        folded.line = expr.line
+                    parent[i] = folded
+        return root[0]
+
+    def fold(self, expr: ASTNode) -> Optional[ASTNode]:
+        # Only fold what evaluates without error, so that runtime errors
+        # still happen at runtime, with the same message
+        children = expr.children
+        if expr.type in [NodeType.LOGOR, NodeType.LOGAND]:
+            if children[0].type not in LITERALS:
+                return None
+            if expr.type == NodeType.LOGOR:
+                return literal(1) if children[0].children[0] else children[1]
+            return children[1] if children[0].children[0] else literal(0)
+        elif expr.type == NodeType.UNARY:
+            if children[1].type not in LITERALS:
+                return None
+            return self.fold_unary(children[0].type, children[1].children[0])
+        elif expr.type in [NodeType.BITOR, NodeType.BITXOR, NodeType.BITAND]:
+            left, right = children
+            op = expr.type
+        elif expr.type == NodeType.CALL:
+            return None
+        else:
+            op, left, right = children
+            op = op.type
+
+        if left.type not in LITERALS or right.type not in LITERALS:
+            return None
+        return self.fold_binary(op, left.children[0], right.children[0])
+
+    def fold_unary(self, op: TokenType, operand: Any) -> Optional[ASTNode]:
+        if op == TokenType.BANG:
+            return literal(not operand)
+        elif type(operand) not in NUMBER_TYPES:
+            return None
+        elif op == TokenType.MINUS:
+            return literal(-operand)
+        elif type(operand) is not float:
+            return literal(~operand)
+        return None
+
+    def fold_binary(self, op: Any, left: Any, right: Any) -> Optional[ASTNode]:
+        numbers = type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES
+        strings = type(left) is str and type(right) is str
+        if not numbers and not strings:
+            return None
+
+        if op == TokenType.PLUS:
+            return literal(left + right)
+        elif op in [TokenType.EQUALS_EQUALS, TokenType.BANG_EQUALS, TokenType.GREATER,
+                    TokenType.GREATER_EQUALS, TokenType.LESSER, TokenType.LESSER_EQUALS]:
+            return literal(int({
+                TokenType.EQUALS_EQUALS: left == right,
+                TokenType.BANG_EQUALS: left != right,
+                TokenType.GREATER: left > right,
+                TokenType.GREATER_EQUALS: left >= right,
+                TokenType.LESSER: left < right,
+                TokenType.LESSER_EQUALS: left <= right,
+            }[op]))
+        elif not numbers:
+            return None
+        elif op == TokenType.MINUS:
+            return literal(left - right)
+        elif op == TokenType.STAR:
+            return literal(left * right)
+        elif op in [TokenType.SLASH, TokenType.MODULO]:
+            if right == 0:
+                return None
+            return literal(left / right if op == TokenType.SLASH else left % right)
+        elif type(left) is float or type(right) is float:
+            return None
+        elif op in [TokenType.LEFT_SHIFT, TokenType.RIGHT_SHIFT]:
+            if not 0 <= right <= MAX_FOLDED_SHIFT:
+                return None
+            return literal(int(left << right if op == TokenType.LEFT_SHIFT else left >> right))
+        elif op == NodeType.BITOR:
+            return literal(left | right)
+        elif op == NodeType.BITXOR:
+            return literal(left ^ right)
+        else:
+            return literal(left & right)
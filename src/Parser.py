@@ -34,27 +34,79 @@ class NodeType(Enum):
     VAR = auto()
     FUN = auto()
 
+    # Only the kind of a runtime value, never a node
+    ARRAY = auto()
+
+    # Members are singletons, so hashing by identity is consistent with
+    # equality, and much cheaper than Enum's hash of the member name in the
+    # dictionaries keyed by this type
+    __hash__ = object.__hash__
+
+
+# Infix operators: binding power (higher binds tighter), the node they build,
+# and whether the node keeps the operator token. Every level is left
+# associative.
+INFIX = {
+    TokenType.OR: (1, NodeType.LOGOR, False),
+    TokenType.LOGOR: (1, NodeType.LOGOR, False),
+    TokenType.AND: (2, NodeType.LOGAND, False),
+    TokenType.LOGAND: (2, NodeType.LOGAND, False),
+    TokenType.BITOR: (3, NodeType.BITOR, False),
+    TokenType.BITXOR: (4, NodeType.BITXOR, False),
+    TokenType.BITAND: (5, NodeType.BITAND, False),
+    TokenType.BANG_EQUALS: (6, NodeType.EQUALITY, True),
+    TokenType.EQUALS_EQUALS: (6, NodeType.EQUALITY, True),
+    TokenType.GREATER: (7, NodeType.COMPARISION, True),
+    TokenType.GREATER_EQUALS: (7, NodeType.COMPARISION, True),
+    TokenType.LESSER: (7, NodeType.COMPARISION, True),
+    TokenType.LESSER_EQUALS: (7, NodeType.COMPARISION, True),
+    TokenType.LEFT_SHIFT: (8, NodeType.BITSHIFT, True),
+    TokenType.RIGHT_SHIFT: (8, NodeType.BITSHIFT, True),
+    TokenType.PLUS: (9, NodeType.ADDITION, True),
+    TokenType.MINUS: (9, NodeType.ADDITION, True),
+    TokenType.MODULO: (9, NodeType.ADDITION, True),
+    TokenType.STAR: (10, NodeType.MULTIPLICATION, True),
+    TokenType.SLASH: (10, NodeType.MULTIPLICATION, True),
+}
+PREFIX = [TokenType.BANG, TokenType.MINUS, TokenType.BITNOT]
+
+# Entries on the expression parser's stack
+UNARY_FRAME = 0  # a prefix operator waiting for its operand
+BINARY_FRAME = 1  # a left operand and infix operator waiting for the right operand
+GROUP_FRAME = 2  # an open '(' waiting for its expression
+CALL_FRAME = 3  # a call waiting for its next argument
+
 
 class ASTNode:
-    def __init__(self, node_type: NodeType, children: List[Any]):
+    __slots__ = ('type', 'children', 'line', 'cache')
+
+    def __init__(self, node_type: NodeType, children: List[Any], line: int = 0):
         self.type = node_type
         self.children = children
+        self.line = line  # source line the node starts on, 0 when unknown
+        self.cache = None  # inline cache filled in by Executor, never saved
 
 
 class Parser:
     def __init__(self):
         self.ast = []
-        self.tokens = []
+        self.tokens = []  # lookahead buffer, refilled from self.source
+        self.source = iter(())
         self.current = 0
         self.in_function = False
 
+    def fill(self) -> bool:
+        for token in self.source:
+            self.tokens.append(token)
+            return True
+        return False
+
     def is_at_end(self) -> bool:
-        return self.current >= len(self.tokens)
+        return self.current >= len(self.tokens) and not self.fill()
 
     def peek(self) -> Token:
         if self.is_at_end():
-            print('bruh')
-            return None
+            error('EOF has been reached (parser)')
         else:
             return self.tokens[self.current]
 
@@ -72,8 +124,8 @@ class Parser:
             return self.tokens[self.current - 1]
 
     def match(self, token_type: List[TokenType]) -> bool:
-        if self.peek().type in token_type:
-            self.advance()
+        if (self.current < len(self.tokens) or self.fill()) and self.tokens[self.current].type in token_type:
+            self.current += 1
             return True
         else:
             return False
@@ -88,160 +140,112 @@ class Parser:
             error(f'[line {self.previous().line}] {msg}')
 
     def expression(self) -> ASTNode:
-        return self.logor()
-
-    def logor(self) -> ASTNode:
-        left = self.logand()
-
-        while self.match([TokenType.OR]):
-            right = self.logand()
-            left = ASTNode(NodeType.LOGOR, [left, right])
-
-        return left
-
-    def logand(self) -> ASTNode:
-        left = self.bitor()
-
-        while self.match([TokenType.AND]):
-            right = self.bitor()
-            left = ASTNode(NodeType.LOGAND, [left, right])
-
-        return left
-
-    def bitor(self) -> ASTNode:
-        left = self.bitxor()
-
-        while self.match([TokenType.BITOR]):
-            right = self.bitxor()
-            left = ASTNode(NodeType.BITOR, [left, right])
-
-        return left
-
-    def bitxor(self) -> ASTNode:
-        left = self.bitand()
-
-        while self.match([TokenType.BITXOR]):
-            right = self.bitand()
-            left = ASTNode(NodeType.BITXOR, [left, right])
-
-        return left
-
-    def bitand(self) -> ASTNode:
-        left = self.equality()
-
-        while self.match([TokenType.BITAND]):
-            right = self.equality()
-            left = ASTNode(NodeType.BITAND, [left, right])
-
-        return left
-
-    def equality(self) -> ASTNode:
-        left = self.comparison()
-
-        while self.match([TokenType.BANG_EQUALS, TokenType.EQUALS_EQUALS]):
-            op = self.previous()
-            right = self.comparison()
-            left = ASTNode(NodeType.EQUALITY, [op, left, right])
-
-        return left
-
-    def comparison(self) -> ASTNode:
-        left = self.bitshift()
-
-        while self.match([TokenType.GREATER, TokenType.GREATER_EQUALS, TokenType.LESSER, TokenType.LESSER_EQUALS]):
-            op = self.previous()
-            right = self.bitshift()
-            left = ASTNode(NodeType.COMPARISION, [op, left, right])
-
-        return left
-
-    def bitshift(self) -> ASTNode:
-        left = self.addition()
-
-        while self.match([TokenType.LEFT_SHIFT, TokenType.RIGHT_SHIFT]):
-            op = self.previous()
-            right = self.addition()
-            left = ASTNode(NodeType.BITSHIFT, [op, left, right])
-
-        return left
-
-    def addition(self) -> ASTNode:
-        left = self.multiplication()
-
-        while self.match([TokenType.PLUS, TokenType.MINUS, TokenType.MODULO]):
-            op = self.previous()
-            right = self.multiplication()
-            left = ASTNode(NodeType.ADDITION, [op, left, right])
-
-        return left
-
-    def multiplication(self) -> ASTNode:
-        left = self.unary()
-
-        while self.match([TokenType.STAR, TokenType.SLASH]):
-            op = self.previous()
-            right = self.unary()
-            left = ASTNode(NodeType.MULTIPLICATION, [op, left, right])
-
-        return left
-
-    def unary(self) -> ASTNode:
-        if self.match([TokenType.BANG, TokenType.MINUS, TokenType.BITNOT]):
-            op = self.previous()
-            return ASTNode(NodeType.UNARY, [op, self.unary()])
-        else:
-            return self.call()
-
-    def call(self) -> ASTNode:
-        left = self.primary()
-
-        if self.match([TokenType.LEFT_PAREN]):
-            left = ASTNode(NodeType.CALL, [left])
-            if self.peek().type != TokenType.RIGHT_PAREN:
-                left.children.append(self.expression())
-                while self.peek().type != TokenType.RIGHT_PAREN:
-                    self.consume(TokenType.COMMA,
-                                 "expect ',' after function argument")
-                    left.children.append(self.expression())
-            self.consume(TokenType.RIGHT_PAREN,
-                         "expect ')' after function call")
-
-        return left
-
-    def primary(self) -> ASTNode:
-        if self.match([TokenType.IDENTIFIER]):
-            return ASTNode(NodeType.IDENTIFIER, [self.previous().lexeme])
-        elif self.match([TokenType.NUMBER]):
-            return ASTNode(NodeType.NUMBER, [float(self.previous().lexeme)])
-        elif self.match([TokenType.STRING]):
-            return ASTNode(NodeType.STRING, [self.previous().lexeme])
-        elif self.match([TokenType.LEFT_PAREN]):
-            expr = self.expression()
-            self.consume(TokenType.RIGHT_PAREN,
-                         "expect ')' after grouping expression")
-            return expr
-        else:
-            error(
-                f"[line {self.peek().line}] Unexpected token '{self.peek().lexeme}' in expression")
+        # Pratt parser, driven by INFIX, with the pending operators kept on an
+        # explicit stack instead of the Python stack, so that long operator
+        # chains and deep nesting do not hit the recursion limit
+        tokens = self.tokens
+        stack = []
+        while True:
+            # Prefix position: an operand, or a unary operator or group before one
+            if self.is_at_end():
+                error('EOF has been reached (parser)')
+            token = tokens[self.current]
+            self.current += 1
+            if token.type == TokenType.IDENTIFIER:
+                left = ASTNode(NodeType.IDENTIFIER, [token.lexeme], token.line)
+            elif token.type == TokenType.NUMBER:
+                try:
+                    value = float(token.lexeme) if '.' in token.lexeme else int(token.lexeme)
+                except ValueError:
+                    # Python refuses to convert integers of more than 4300 digits
+                    error(f'[line {token.line}] Number literal too long')
+                left = ASTNode(NodeType.NUMBER, [value], token.line)
+            elif token.type == TokenType.STRING:
+                left = ASTNode(NodeType.STRING, [token.lexeme], token.line)
+            elif token.type in PREFIX:
+                stack.append((UNARY_FRAME, token))
+                continue
+            elif token.type == TokenType.LEFT_PAREN:
+                stack.append((GROUP_FRAME, None))
+                continue
+            else:
+                error(
+                    f"[line {token.line}] Unexpected token '{token.lexeme}' in expression")
+            callable = True
+
+            # Infix position: apply what the operand completes, until another
+            # operand is needed or the expression ends
+            while True:
+                next_type = tokens[self.current].type if (
+                    self.current < len(tokens) or self.fill()) else None
+                if next_type == TokenType.LEFT_PAREN and callable:
+                    self.current += 1
+                    call = ASTNode(NodeType.CALL, [left], left.line)
+                    if self.peek().type != TokenType.RIGHT_PAREN:
+                        stack.append((CALL_FRAME, call))
+                        break
+                    self.current += 1
+                    left = call
+                    callable = False
+                    continue
+
+                # Unary operators bind tighter than every infix operator
+                while stack and stack[-1][0] == UNARY_FRAME:
+                    op = stack.pop()[1]
+                    left = ASTNode(NodeType.UNARY, [op, left], op.line)
+
+                infix = INFIX.get(next_type)
+                power = infix[0] if infix is not None else 0
+                while stack and stack[-1][0] == BINARY_FRAME and stack[-1][1][0] >= power:
+                    _, (_, node_type, op), operand = stack.pop()
+                    left = ASTNode(node_type, [operand, left] if op is None else [op, operand, left],
+                                   operand.line)
+
+                if infix is not None:
+                    op = tokens[self.current]
+                    self.current += 1
+                    stack.append((BINARY_FRAME, (power, infix[1], op if infix[2] else None), left))
+                    break
+                elif not stack:
+                    return left
+                elif stack[-1][0] == GROUP_FRAME:
+                    self.consume(TokenType.RIGHT_PAREN,
+                                 "expect ')' after grouping expression")
+                    stack.pop()
+                    callable = True
+                else:
+                    call = stack[-1][1]
+                    call.children.append(left)
+                    if self.peek().type != TokenType.RIGHT_PAREN:
+                        self.consume(TokenType.COMMA,
+                                     "expect ',' after function argument")
+                        break
+                    self.consume(TokenType.RIGHT_PAREN,
+                                 "expect ')' after function call")
+                    stack.pop()
+                    left = call
+                    callable = False
 
     def expr_stmt(self) -> ASTNode:
         expr = self.expression()
         self.consume(TokenType.SEMICOLON, "expect ';' after expression")
-        return ASTNode(NodeType.EXPR, [expr])
+        return ASTNode(NodeType.EXPR, [expr], expr.line)
 
     def block_stmt(self) -> ASTNode:
+        line = self.previous().line
         block = []
         if self.peek().type != TokenType.RIGHT_BRACE:
             while self.peek().type != TokenType.RIGHT_BRACE:
                 block.append(self.declaration())
 
         self.consume(TokenType.RIGHT_BRACE, "expect '}' after block statement")
-        return ASTNode(NodeType.BLOCK, block)
+        return ASTNode(NodeType.BLOCK, block, line)
 
     def if_stmt(self) -> ASTNode:
+        line = self.previous().line
         cond = self.expression()
         self.consume(TokenType.LEFT_BRACE, "expect '{' after if statement")
-        then_body = self.blockstmt()
+        then_body = self.block_stmt()
         else_stmt = None
         if self.match([TokenType.ELSE]):
             if self.match([TokenType.IF]):
@@ -250,22 +254,24 @@ class Parser:
                 self.consume(TokenType.LEFT_BRACE,
                              "expect '{' after else keyword")
                 else_stmt = self.block_stmt()
-        return ASTNode(NodeType.IF, [cond, then_body, else_stmt])
+        return ASTNode(NodeType.IF, [cond, then_body, else_stmt], line)
 
     def return_stmt(self) -> ASTNode:
         if not self.in_function:
             error(
                 f"[line {self.previous().line}] cannot use 'return' outside a function")
 
+        line = self.previous().line
         expr = self.expression()
         self.consume(TokenType.SEMICOLON, "expect ';' after return statement")
-        return ASTNode(NodeType.RETURN, [expr])
+        return ASTNode(NodeType.RETURN, [expr], line)
 
     def while_stmt(self) -> ASTNode:
+        line = self.previous().line
         cond = self.expression()
         self.consume(TokenType.LEFT_BRACE, "expect '{' after while header")
         body = self.block_stmt()
-        return ASTNode(NodeType.WHILE, [cond, body])
+        return ASTNode(NodeType.WHILE, [cond, body], line)
 
     def var_decl(self) -> ASTNode:
         name = self.previous()
@@ -273,7 +279,7 @@ class Parser:
             init = self.expression()
             self.consume(TokenType.SEMICOLON,
                          "expect ';' after variable initializer")
-            return ASTNode(NodeType.VAR, [name, init])
+            return ASTNode(NodeType.VAR, [name, init], name.line)
         else:
             self.unmatch()
             return self.expr_stmt()
@@ -297,36 +303,54 @@ class Parser:
         self.in_function = True
         body = self.block_stmt()
         self.in_function = prev
-        return ASTNode(NodeType.FUN, [name, parameters, body])
+        return ASTNode(NodeType.FUN, [name, parameters, body], name.line)
 
     def declaration(self) -> ASTNode:
         if self.is_at_end():
             return None
 
-        if self.match([TokenType.IDENTIFIER]):
+        token_type = self.tokens[self.current].type
+        if token_type == TokenType.IDENTIFIER:
+            self.current += 1
             return self.var_decl()
-        elif self.match([TokenType.FUN]):
+        elif token_type == TokenType.FUN:
+            self.current += 1
             return self.fun_decl()
         else:
             return self.statement()
 
     def statement(self) -> ASTNode:
-        if self.match([TokenType.LEFT_BRACE]):
+        token_type = self.tokens[self.current].type
+        if token_type == TokenType.LEFT_BRACE:
+            self.current += 1
             return self.block_stmt()
-        elif self.match([TokenType.IF]):
+        elif token_type == TokenType.IF:
+            self.current += 1
             return self.if_stmt()
-        elif self.match([TokenType.RETURN]):
+        elif token_type == TokenType.RETURN:
+            self.current += 1
             return self.return_stmt()
-        elif self.match([TokenType.WHILE]):
+        elif token_type == TokenType.WHILE:
+            self.current += 1
             return self.while_stmt()
         else:
             return self.expr_stmt()
 
     def parse(self, tokens: List[Token]) -> List[ASTNode]:
-        self.tokens = tokens
+        self.ast.extend(self.parse_stream(tokens))
+        return self.ast
+
+    def parse_stream(self, tokens: Iterable[Token]) -> Iterator[ASTNode]:
+        streaming = not isinstance(tokens, list)
+        if streaming:
+            self.source = iter(tokens)
+        else:
+            self.tokens = tokens
         while not self.is_at_end():
             decl = self.declaration()
             if decl is not None:
-                self.ast.append(decl)
-
-        return self.ast
+                yield decl
+            if streaming and self.current > 1:
+                # Drop what has been consumed, keeping one token for previous()
+                del self.tokens[:self.current - 1]
+                self.current = 1
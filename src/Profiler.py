@@ -0,0 +1,109 @@
+import sys
+from collections import defaultdict
+from time import perf_counter
+from typing import *
+
+from Executor import MEMO_SIZE, Executor
+from Parser import ASTNode, NodeType
+from Value import Closure
+
+# Root of every collapsed stack, standing for the top level of the script
+SCRIPT = '<script>'
+
+
+class FunctionStats:
+    __slots__ = ('calls', 'inclusive', 'exclusive')
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0.0  # counted once per outermost activation, so recursion is not double counted
+        self.exclusive = 0.0
+
+
+class ProfilingExecutor(Executor):
+    # Used instead of Executor only when profiling, so that the hooks cost
+    # nothing otherwise
+
+    # Counted loops skip exec_stmt for their increment, which would go
+    # missing from the line counts
+    counted_loops = False
+
+    def __init__(self, memo_size: int = MEMO_SIZE):
+        super().__init__(memo_size=memo_size)
+        self.functions = defaultdict(FunctionStats)
+        self.lines = defaultdict(int)  # source line -> statements executed
+        self.stacks = defaultdict(float)  # collapsed stack -> exclusive seconds
+        self.definitions = dict()  # id of a function body -> line of its 'fun'
+        self.active = defaultdict(int)  # activations per function on the stack
+        # One entry per running function: [key, collapsed stack, time spent in callees]
+        self.running = [[SCRIPT, SCRIPT, 0.0]]
+        self.start = perf_counter()
+
+    def key(self, function: Closure) -> str:
+        line = self.definitions.get(id(function.body))
+        return f'{function.name}:{line}' if line is not None else function.name
+
+    def exec_stmt(self, stmt: ASTNode) -> None:
+        if stmt.type == NodeType.FUN:
+            self.definitions[id(stmt.children[2].children)] = stmt.line
+        if stmt.type != NodeType.BLOCK:
+            self.lines[stmt.line] += 1
+        # Each hook adds a Python frame to the ones the tree walker uses. The
+        # recursion limit is raised by one while it runs, so that a script
+        # runs out of stack exactly where it would without profiling.
+        sys.setrecursionlimit(sys.getrecursionlimit() + 1)
+        try:
+            super().exec_stmt(stmt)
+        finally:
+            sys.setrecursionlimit(sys.getrecursionlimit() - 1)
+
+    def invoke(self, function: Closure, frame: List[Any]) -> Any:
+        key = self.key(function)
+        entry = [key, self.running[-1][1] + ';' + key, 0.0]
+        self.running.append(entry)
+        self.active[key] += 1
+        sys.setrecursionlimit(sys.getrecursionlimit() + 1)
+        start = perf_counter()
+        try:
+            return super().invoke(function, frame)
+        finally:
+            sys.setrecursionlimit(sys.getrecursionlimit() - 1)
+            elapsed = perf_counter() - start
+            self.running.pop()
+            self.active[key] -= 1
+            stats = self.functions[key]
+            stats.calls += 1
+            stats.exclusive += elapsed - entry[2]
+            if not self.active[key]:
+                stats.inclusive += elapsed
+            self.stacks[entry[1]] += elapsed - entry[2]
+            self.running[-1][2] += elapsed
+
+    def finish(self) -> None:
+        # Charges the time spent at the top level of the script
+        elapsed = perf_counter() - self.start
+        script = self.running[0]
+        self.stacks[SCRIPT] += elapsed - script[2]
+        script[2] = elapsed
+
+    def report(self, source: List[str], limit: int = 20) -> str:
+        total = self.running[0][2]
+        lines = [f'total: {total:.6f}s', '',
+                 f'{"function":<24} {"calls":>10} {"inclusive":>12} {"exclusive":>12} {"excl %":>7}']
+        for key, stats in sorted(self.functions.items(), key=lambda item: -item[1].exclusive):
+            share = 100 * stats.exclusive / total if total else 0.0
+            lines.append(f'{key:<24} {stats.calls:>10} {stats.inclusive:>11.6f}s {stats.exclusive:>11.6f}s '
+                         f'{share:>6.1f}%')
+
+        lines += ['', f'{"line":>6} {"count":>10}  source']
+        hottest = sorted(self.lines.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        for line, count in hottest:
+            text = source[line - 1].strip() if 0 < line <= len(source) else ''
+            lines.append(f'{line:>6} {count:>10}  {text}')
+        return '\n'.join(lines)
+
+    def collapsed(self) -> str:
+        # One 'frame;frame;frame microseconds' line per stack, the format
+        # read by flamegraph.pl and speedscope
+        return ''.join(f'{stack} {round(seconds * 1e6)}\n'
+                       for stack, seconds in sorted(self.stacks.items()))
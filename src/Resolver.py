@@ -0,0 +1,182 @@
+from typing import *
+
+from Error import *
+from Parser import ASTNode, NodeType
+
+# Depth of a name that lives in the global dictionary instead of a frame slot
+GLOBAL = -1
+
+# Annotations appended by the resolver:
+#   IDENTIFIER  [name, depth, slot, fallback]
+#   VAR         [name, init, depth, slot, fallback]
+#   FUN         [name, params, body, depth, slot, fallback, frame_size, captured, pure]
+#
+# Frames are lists: slot 0 holds the enclosing frame, so a binding at (depth,
+# slot) is found by following slot 0 'depth' times. A binding created by an
+# assignment inside a function is a 'fallback' slot: at runtime the
+# assignment goes to the global of the same name if one exists and the slot
+# is still empty, which keeps the "assign to the nearest existing binding,
+# otherwise declare a local" rule without resolving globals statically.
+# 'captured' is set when a function declares nested functions, which keep a
+# reference to its frame.
+# 'pure' is None unless the function only depends on its arguments: it never
+# prints, declares no nested functions, reads and assigns only its own
+# locals, and calls only functions that are its locals or globals. It then
+# holds the names of the function's fallback slots, which are only local as
+# long as no global of that name exists. Whether the functions it calls are
+# pure as well can only be known at runtime.
+
+
+class FunctionScope:
+    def __init__(self, outer: List[List[Dict[str, Tuple[int, bool]]]]):
+        self.outer = outer  # block chains of the enclosing functions, innermost first
+        self.blocks = [dict()]
+        self.slots = 1  # slot 0 is the enclosing frame
+        self.pending = []
+        self.captured = False
+        self.pure = True
+        self.fallbacks = []
+
+    def declare(self, name: str, fallback: bool) -> int:
+        slot = self.slots
+        self.slots += 1
+        self.blocks[-1][name] = (slot, fallback)
+        if fallback:
+            self.fallbacks.append(name)
+        return slot
+
+
+class Resolver:
+    def __init__(self):
+        self.globals = dict()
+        self.script = FunctionScope([])
+        # The outermost block of the script is the global scope, its entries
+        # have no slot
+        self.script.blocks = [self.globals]
+        self.function = self.script
+
+    @property
+    def script_slots(self) -> int:
+        return self.script.slots
+
+    def lookup(self, name: str) -> Optional[Tuple[int, int, bool]]:
+        for block in reversed(self.function.blocks):
+            if name in block:
+                return self.binding(0, block[name])
+        for depth, blocks in enumerate(self.function.outer, 1):
+            for block in reversed(blocks):
+                if name in block:
+                    return self.binding(depth, block[name])
+        return None
+
+    def binding(self, depth: int, entry: Optional[Tuple[int, bool]]) -> Tuple[int, int, bool]:
+        if entry is None:
+            return (GLOBAL, 0, False)
+        return (depth, entry[0], entry[1])
+
+    def assign(self, name: str) -> Tuple[int, int, bool]:
+        binding = self.lookup(name)
+        if binding is not None:
+            return binding
+        elif self.function.blocks[-1] is self.globals:
+            self.globals[name] = None
+            return (GLOBAL, 0, False)
+        else:
+            return (0, self.function.declare(name, True), True)
+
+    def block_stmt(self, block: ASTNode) -> None:
+        self.function.blocks.append(dict())
+        for stmt in block.children:
+            self.resolve_stmt(stmt)
+        self.function.blocks.pop()
+
+    def fun_decl(self, stmt: ASTNode) -> None:
+        stmt.children[3:] = [*self.assign(stmt.children[0].lexeme), 0, False, None]
+        self.function.captured = True
+        self.function.pure = False
+        # Bodies are resolved once the enclosing function is done, so that
+        # they can see every local it declares, including ones declared
+        # after the nested function itself
+        outer = [list(self.function.blocks)] + self.function.outer
+        self.function.pending.append((stmt, outer))
+
+    def function_body(self, stmt: ASTNode, outer: List[List[Dict[str, Tuple[int, bool]]]]) -> None:
+        enclosing = self.function
+        self.function = FunctionScope(outer)
+        for param in stmt.children[1]:
+            self.function.declare(param.lexeme, False)
+        for inner in stmt.children[2].children:
+            self.resolve_stmt(inner)
+        self.flush()
+        stmt.children[6] = self.function.slots
+        stmt.children[7] = self.function.captured
+        stmt.children[8] = tuple(self.function.fallbacks) if self.function.pure else None
+        self.function = enclosing
+
+    def flush(self) -> None:
+        while self.function.pending:
+            stmt, outer = self.function.pending.pop(0)
+            self.function_body(stmt, outer)
+
+    def resolve_stmt(self, stmt: ASTNode) -> None:
+        if stmt.type == NodeType.BLOCK:
+            self.block_stmt(stmt)
+        elif stmt.type == NodeType.FUN:
+            self.fun_decl(stmt)
+        elif stmt.type == NodeType.IF:
+            self.resolve_expr(stmt.children[0])
+            self.resolve_stmt(stmt.children[1])
+            if stmt.children[2] is not None:
+                self.resolve_stmt(stmt.children[2])
+        elif stmt.type == NodeType.RETURN:
+            self.resolve_expr(stmt.children[0])
+        elif stmt.type == NodeType.VAR:
+            # The initializer is evaluated before the name is bound
+            self.resolve_expr(stmt.children[1])
+            stmt.children[2:] = self.assign(stmt.children[0].lexeme)
+            if stmt.children[2] != 0:
+                self.function.pure = False
+        elif stmt.type == NodeType.WHILE:
+            self.resolve_expr(stmt.children[0])
+            self.resolve_stmt(stmt.children[1])
+        elif stmt.type == NodeType.EXPR:
+            self.resolve_expr(stmt.children[0])
+
+    def identifier(self, expr: ASTNode) -> int:
+        binding = self.lookup(expr.children[0])
+        expr.children[1:] = binding if binding is not None else (GLOBAL, 0, False)
+        return expr.children[1]
+
+    def resolve_expr(self, expr: ASTNode) -> None:
+        # Explicit stack rather than recursion, so that long operator chains
+        # do not hit the recursion limit. Expressions never declare names, so
+        # the order in which they are visited does not matter.
+        stack = [expr]
+        while stack:
+            expr = stack.pop()
+            if expr.type == NodeType.IDENTIFIER:
+                if self.identifier(expr) != 0:
+                    self.function.pure = False
+            elif expr.type == NodeType.CALL:
+                callee = expr.children[0]
+                if callee.type != NodeType.IDENTIFIER:
+                    stack.append(callee)
+                elif self.identifier(callee) > 0:
+                    # Calling a global is fine, it is checked when called,
+                    # unless it is print
+                    self.function.pure = False
+                elif callee.children[0] == 'print' and callee.children[1] == GLOBAL:
+                    self.function.pure = False
+                stack.extend(expr.children[1:])
+            elif expr.type in [NodeType.STRING, NodeType.NUMBER]:
+                pass
+            else:
+                for child in expr.children:
+                    if isinstance(child, ASTNode):
+                        stack.append(child)
+
+    def resolve(self, stmts: List[ASTNode]) -> List[ASTNode]:
+        for stmt in stmts:
+            self.resolve_stmt(stmt)
+            self.flush()
+        return stmts
@@ -1,3 +1,5 @@
+import re
+import sys
 from io import TextIOWrapper
 from typing import *
 
@@ -5,6 +7,176 @@ from Error import *
 from Token import Token, TokenType
 
 
+IGNORED = {TokenType.NEWLINE, TokenType.WHITESPACE}
+
+KEYWORDS = {
+    'and': TokenType.AND,
+    'or': TokenType.OR,
+    'else': TokenType.ELSE,
+    'fun': TokenType.FUN,
+    'if': TokenType.IF,
+    'return': TokenType.RETURN,
+    'while': TokenType.WHILE,
+}
+
+OPERATORS = {
+    '||': TokenType.LOGOR,
+    '|': TokenType.BITOR,
+    '&&': TokenType.LOGAND,
+    '&': TokenType.BITAND,
+    '^': TokenType.BITXOR,
+    '!=': TokenType.BANG_EQUALS,
+    '!': TokenType.BANG,
+    '==': TokenType.EQUALS_EQUALS,
+    '=': TokenType.EQUALS,
+    '>=': TokenType.GREATER_EQUALS,
+    '>>': TokenType.RIGHT_SHIFT,
+    '>': TokenType.GREATER,
+    '<=': TokenType.LESSER_EQUALS,
+    '<<': TokenType.LEFT_SHIFT,
+    '<': TokenType.LESSER,
+    '+': TokenType.PLUS,
+    '-': TokenType.MINUS,
+    '%': TokenType.MODULO,
+    '*': TokenType.STAR,
+    '/': TokenType.SLASH,
+    '~': TokenType.BITNOT,
+    '(': TokenType.LEFT_PAREN,
+    ')': TokenType.RIGHT_PAREN,
+    '{': TokenType.LEFT_BRACE,
+    '}': TokenType.RIGHT_BRACE,
+    ';': TokenType.SEMICOLON,
+    ',': TokenType.COMMA,
+}
+
+ESCAPES = {'\\': '\\', 'b': '\b', 'f': '\f', 'n': '\n',
+           'r': '\r', 't': '\t', '"': '\"', '\'': '\''}
+
+# What identifiers and numbers are made of, for both scanners so that they
+# split a script the same way. An identifier starts with a letter or '_' and
+# goes on with letters, digits and '_', letters being the Unicode word
+# characters that are not decimal digits (so '²' is a letter). Numbers only
+# have decimal digits, which int and float can read.
+LETTER = r'[^\W\d]'
+WORD = r'\w'
+DIGIT = r'\d'
+
+LETTER_PATTERN = re.compile(LETTER)
+WORD_PATTERN = re.compile(WORD)
+DIGIT_PATTERN = re.compile(DIGIT)
+
+# Anything the pattern does not match is skipped by findall, which is what
+# Scanner does with characters it does not recognise. Comments are matched
+# without a group so that their contents are skipped too. A lone quote is an
+# unterminated string.
+TOKEN_PATTERN = re.compile(r"""
+    (""" + LETTER + WORD + r"""*)
+  | (\|\||&&|!=|==|>=|>>|<=|<<|[-|&^!=><+%*/~(){};,])
+  | (\n)
+  | (""" + DIGIT + r'+(?:\.' + DIGIT + r"""+)?)
+  | ('(?:[^'\\]|\\.)*'|')
+  | \#[^\n]*
+""", re.VERBOSE | re.DOTALL)
+
+ESCAPE_PATTERN = re.compile(r'\\(.)', re.DOTALL)
+
+
+def unescape(match: re.Match) -> str:
+    ch = match.group(1)
+    if ch in ESCAPES:
+        return ESCAPES[ch]
+    print('Warning: unknown escape sequence \'\\', ch, '\'', file=sys.stderr)
+    return ''
+
+
+class FastScanner:
+    def __init__(self):
+        self.tokens = []
+
+    def scan_source(self, source: str, line: int = 1) -> List[Token]:
+        # 'line' is the line 'source' starts on, for a piece of a larger file
+        tokens = self.tokens
+        append = tokens.append
+        keyword = KEYWORDS.get
+        operators = OPERATORS
+        identifier = TokenType.IDENTIFIER
+        number = TokenType.NUMBER
+        string = TokenType.STRING
+
+        for name, op, newline, num, quoted in TOKEN_PATTERN.findall(source):
+            if name:
+                append(Token(name, keyword(name, identifier), line))
+            elif op:
+                append(Token(op, operators[op], line))
+            elif newline:
+                # Newlines inside strings never get here, so like Scanner
+                # they do not advance the line number
+                line += 1
+            elif num:
+                append(Token(num, number, line))
+            elif quoted:
+                if len(quoted) == 1:
+                    error('EOF has been reached')
+                lexeme = quoted[1:-1]
+                if '\\' in lexeme:
+                    lexeme = ESCAPE_PATTERN.sub(unescape, lexeme)
+                append(Token(lexeme, string, line))
+
+        return tokens
+
+    def scan(self, file: TextIOWrapper) -> List[Token]:
+        return self.scan_source(file.read())
+
+    def stream(self, file: TextIOWrapper, chunk_size: int = 1 << 16) -> Iterator[Token]:
+        keyword = KEYWORDS.get
+        operators = OPERATORS
+        identifier = TokenType.IDENTIFIER
+        number = TokenType.NUMBER
+        string = TokenType.STRING
+        line = 1
+        pending = ''
+
+        while True:
+            chunk = file.read(chunk_size)
+            at_end = not chunk
+            pending += chunk
+            if at_end:
+                cut = len(pending)
+            else:
+                # Only tokens before the last newline are complete, except
+                # for strings, which may span lines
+                cut = pending.rfind('\n') + 1
+                if cut == 0:
+                    continue
+
+            resume = cut
+            for match in TOKEN_PATTERN.finditer(pending, 0, cut):
+                name, op, newline, num, quoted = match.groups()
+                if name:
+                    yield Token(name, keyword(name, identifier), line)
+                elif op:
+                    yield Token(op, operators[op], line)
+                elif newline:
+                    line += 1
+                elif num:
+                    yield Token(num, number, line)
+                elif quoted:
+                    if len(quoted) == 1:
+                        if at_end:
+                            error('EOF has been reached')
+                        # The string continues past the cut, read more first
+                        resume = match.start()
+                        break
+                    lexeme = quoted[1:-1]
+                    if '\\' in lexeme:
+                        lexeme = ESCAPE_PATTERN.sub(unescape, lexeme)
+                    yield Token(lexeme, string, line)
+
+            pending = pending[resume:]
+            if at_end:
+                return
+
+
 class Scanner:
     def __init__(self):
         self.tokens = []
@@ -110,9 +282,9 @@ class Scanner:
                 while self.peek() != '\n' and not self.is_at_end():
                     self.advance()
                 return Token('#', TokenType.WHITESPACE, self.line_number)
-            elif ch.isalpha() or ch == '_':
+            elif LETTER_PATTERN.match(ch):
                 ident = ch
-                while self.peek().isalnum() or self.peek() == '_':
+                while WORD_PATTERN.match(self.peek()):
                     ident += self.advance()
 
                 if ident == 'and':
@@ -131,21 +303,20 @@ class Scanner:
                     return Token('while', TokenType.WHILE, self.line_number)
                 else:
                     return Token(ident, TokenType.IDENTIFIER, self.line_number)
-            elif ch.isdigit():
+            elif DIGIT_PATTERN.match(ch):
                 num = ch
-                while self.peek().isdigit():
+                while DIGIT_PATTERN.match(self.peek()):
                     num += self.advance()
 
-                if self.match('.') and self.peek().isdigit():
+                if self.match('.') and DIGIT_PATTERN.match(self.peek()):
                     num += '.'
-                    while self.peek().isdigit():
+                    while DIGIT_PATTERN.match(self.peek()):
                         num += self.advance()
 
                 return Token(num, TokenType.NUMBER, self.line_number)
             elif ch == '\'':
                 string = ''
-                escapes = {'\\': '\\', 'b': '\b', 'f': '\f', 'n': '\n',
-                           'r': '\r', 't': '\t', '"': '\"', '\'': '\''}
+                escapes = ESCAPES
                 while self.peek() != '\'':
                     next_ch = self.advance()
                     if next_ch == '\\':
@@ -154,7 +325,7 @@ class Scanner:
                             string += escapes[next_ch]
                         else:
                             print('Warning: unknown escape sequence \'\\',
-                                  next_ch, '\'')
+                                  next_ch, '\'', file=sys.stderr)
                     else:
                         string += next_ch
 
@@ -166,7 +337,7 @@ class Scanner:
     def scan(self, file: TextIOWrapper) -> List[Token]:
         self.file = file.read()
         while (tok := self.scan_token()) is not None:
-            if tok.type not in [TokenType.NEWLINE, TokenType.WHITESPACE]:
+            if tok.type not in IGNORED:
                 self.tokens.append(tok)
 
         return self.tokens
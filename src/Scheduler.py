@@ -0,0 +1,88 @@
+import asyncio
+from io import StringIO
+from typing import *
+
+from Compiler import Code
+from Error import *
+from Interpreter import Interpreter, Result
+from Value import Native
+from VM import VM
+
+# Jumps and calls a script runs before giving the other scripts a turn
+SLICE = 1000
+
+
+class AsyncVM(VM):
+    # Runs compiled code as an asyncio coroutine. Every 'slice' jumps and
+    # calls (so at least once per loop iteration or call after that), and
+    # whenever an async builtin like sleep waits, control goes back to the
+    # event loop, so that a long loop in one script does not hold up others.
+    def __init__(self, output: Optional[TextIO] = None, slice: int = SLICE):
+        super().__init__(output)
+        if slice < 1:
+            error('the time slice must be at least 1')
+        self.slice = slice
+
+    def apply(self, function: Any, args: List[Any]) -> Any:
+        # Functions called by builtins, like the one passed to map, run to
+        # the end without suspending, so they cannot wait on anything
+        if type(function) is Native and function.coroutine is not None and function.arity == len(args):
+            error(f'{function.name} cannot be called from a function called by a builtin')
+        return super().apply(function, args)
+
+    async def execute_async(self, code: Code) -> int:
+        steps = self.steps(code, [None] * code.frame_size, self.slice)
+        sent = None
+        try:
+            while True:
+                try:
+                    awaitable = steps.send(sent)
+                except StopIteration:
+                    return 0
+                if awaitable is None:
+                    # The slice is used up, let the other tasks run
+                    await asyncio.sleep(0)
+                    sent = None
+                else:
+                    sent = await awaitable
+        finally:
+            # A cancelled script stops where it was suspended
+            steps.close()
+
+
+class Scheduler:
+    # Runs many scripts concurrently on one thread, as asyncio tasks on the
+    # running event loop. Scripts take turns a time slice at a time, and any
+    # one of them can be cancelled through its task without affecting the
+    # others. Sources are compiled once and kept, as by Interpreter.
+    def __init__(self, level: int = 0, slice: int = SLICE, cache_size: int = 128):
+        if slice < 1:
+            error('the time slice must be at least 1')
+        self.interpreter = Interpreter('vm', level, cache_size)
+        self.slice = slice
+        self.tasks = set()  # scripts submitted and not finished yet
+
+    async def run(self, source: str, globals: Optional[Dict[str, Any]] = None,
+                  output: Optional[StringIO] = None) -> Result:
+        # Passing 'output' keeps what was printed readable if the script
+        # fails or is cancelled
+        if output is None:
+            output = StringIO()
+        program = self.interpreter.compile(source)
+        vm = AsyncVM(output, self.slice)
+        program.seed(vm, globals)
+        await vm.execute_async(program.code)
+        return program.result(vm, output)
+
+    def submit(self, source: str, globals: Optional[Dict[str, Any]] = None,
+               output: Optional[StringIO] = None) -> 'asyncio.Task[Result]':
+        # Starts a script without waiting for it. The task gives its Result,
+        # raises its TipyError, or stops it when cancelled.
+        task = asyncio.ensure_future(self.run(source, globals, output))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel_all(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
@@ -0,0 +1,235 @@
+import gc
+import io
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+from typing import *
+
+from Error import *
+from Interpreter import Interpreter
+
+# The protocol spoken with client.py over a Unix domain socket. A request is
+# a length followed by NUL separated strings: whether the client's stdout is
+# a terminal ('1' or '0'), the client's working directory and the command
+# line arguments it was given. The reply is a series of frames, each a kind
+# and a length followed by that many bytes: output for the client's stdout
+# or stderr, and last the exit status as a signed 32 bit integer.
+LENGTH = struct.Struct('<I')
+FRAME = struct.Struct('<cI')
+STATUS = struct.Struct('<i')
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+
+# Requests larger than this are refused
+MAX_REQUEST = 1 << 20
+# Larger scripts are never compiled by the server itself, only by the child
+# running them (from the .tic cache when it can), so that compiling one
+# script does not hold up the requests of other clients for long
+MAX_COMPILED_SOURCE = 1 << 13
+
+
+def receive(connection: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(connection: socket.socket, kind: bytes, data: bytes) -> None:
+    connection.sendall(FRAME.pack(kind, len(data)) + data)
+
+
+def stop(signum: int, frame: Any) -> None:
+    raise KeyboardInterrupt
+
+
+class FrameWriter(io.RawIOBase):
+    # A binary stream sending everything written to it as frames of one kind
+    def __init__(self, connection: socket.socket, kind: bytes):
+        super().__init__()
+        self.connection = connection
+        self.kind = kind
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        send_frame(self.connection, self.kind, bytes(data))
+        return len(data)
+
+
+class Server:
+    # A daemon answering run requests from client.py. Every module is already
+    # imported and the scripts it has run stay compiled, so a request only
+    # costs a fork: each one runs in its own child process, which shares the
+    # server's memory copy-on-write and cannot disturb the server or other
+    # requests. 'command' runs a command line as main.py would, returning its
+    # exit status, and 'plan' picks out the commands that only run a script,
+    # as (file name, engine, optimization level), for which the compiled
+    # program is taken from the server instead.
+    def __init__(self, path: str, command: Callable[[List[str]], int],
+                 plan: Callable[[List[str]], Optional[Tuple[str, str, int]]], cache_size: int = 128):
+        self.path = path
+        self.command = command
+        self.plan = plan
+        self.cache_size = cache_size
+        self.interpreters = dict()  # (engine, level) -> Interpreter keeping its compiled programs
+        self.listener = None
+
+    def listen(self) -> None:
+        # A socket file left behind by a server that is gone is replaced, one
+        # that is still answering is not
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.remove(self.path)
+            else:
+                error(f'a server is already listening on {self.path}')
+            finally:
+                probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Scripts run as this user, so only this user may send them. The
+        # socket file is created that way rather than changed after binding,
+        # so that it is never open to anyone else.
+        umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.path)
+            self.listener.listen(128)
+        except OSError as exception:
+            self.listener.close()
+            error(f'unable to listen on {self.path}: {exception.strerror}')
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self) -> int:
+        self.listen()
+        # Everything imported so far stays put, so that the collector running
+        # in a child does not copy the pages it is on. Done once: freezing
+        # after every compile would keep each program out of reach of the
+        # collector for good.
+        gc.freeze()
+        # Children are reaped by the kernel, the server never waits for them
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        # Stopping the server the usual way removes its socket file as well
+        signal.signal(signal.SIGTERM, stop)
+        print(f'tipy server listening on {self.path}', file=sys.stderr)
+        try:
+            while True:
+                connection, _ = self.listener.accept()
+                try:
+                    self.handle(connection)
+                except (OSError, EOFError, ValueError):
+                    # A client that went away or sent garbage only loses its
+                    # own request
+                    pass
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            self.listener.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def handle(self, connection: socket.socket) -> None:
+        length = LENGTH.unpack(receive(connection, LENGTH.size))[0]
+        if length > MAX_REQUEST:
+            raise ValueError('request too large')
+        fields = receive(connection, length).decode().split('\0')
+        if len(fields) < 2:
+            raise ValueError('malformed request')
+        terminal, cwd, argv = fields[0] == '1', fields[1], fields[2:]
+
+        # A script the server compiled before runs from its program. Any
+        # other one is compiled by the child, and then by the server once
+        # the child is on its way, for the next request running it.
+        interpreter, source = self.script(cwd, argv)
+        program = interpreter.lookup(source) if interpreter is not None else None
+        if os.fork() == 0:
+            status = 1
+            try:
+                status = self.run(connection, terminal, cwd, argv, program)
+            finally:
+                os._exit(status & 0xff)
+        if interpreter is not None and program is None:
+            try:
+                interpreter.compile(source)
+            except (TipyError, RecursionError):
+                # The child reports the error
+                pass
+
+    def script(self, cwd: str, argv: List[str]) -> Tuple[Optional[Interpreter], str]:
+        # The interpreter and source of a request the server compiles, or
+        # (None, '') for one that the child handles on its own
+        plan = self.plan(argv)
+        if plan is None:
+            return None, ''
+        file_name, engine, level = plan
+        try:
+            with open(os.path.join(cwd, file_name), 'rt') as file:
+                source = file.read(MAX_COMPILED_SOURCE + 1)
+        except (OSError, UnicodeDecodeError):
+            return None, ''
+        if len(source) > MAX_COMPILED_SOURCE:
+            return None, ''
+        interpreter = self.interpreters.get((engine, level))
+        if interpreter is None:
+            interpreter = self.interpreters[(engine, level)] = Interpreter(engine, level, self.cache_size)
+        return interpreter, source
+
+    def run(self, connection: socket.socket, terminal: bool, cwd: str, argv: List[str], program: Any) -> int:
+        # Runs in the child, with its output going back to the client
+        self.listener.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # The server's input is not the client's
+        sys.stdin = open(os.devnull, 'rt')
+        sys.stdout = io.TextIOWrapper(io.BufferedWriter(FrameWriter(connection, STDOUT)), encoding='utf-8',
+                                      line_buffering=terminal)
+        sys.stderr = io.TextIOWrapper(io.BufferedWriter(FrameWriter(connection, STDERR)), encoding='utf-8',
+                                      errors='backslashreplace', line_buffering=True)
+        try:
+            os.chdir(cwd)
+            if program is not None:
+                status = self.run_program(program)
+            else:
+                status = self.command(argv)
+        except SystemExit as exception:
+            # Raised by argparse, for --help or bad arguments
+            if exception.code is None or type(exception.code) is int:
+                status = exception.code or 0
+            else:
+                print(exception.code, file=sys.stderr)
+                status = 1
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        try:
+            # The child leaves through os._exit, which flushes nothing
+            sys.stdout.flush()
+            sys.stderr.flush()
+            send_frame(connection, EXIT, STATUS.pack(status))
+        except OSError:
+            pass
+        return status
+
+    @staticmethod
+    def run_program(program: Any) -> int:
+        try:
+            program.execute()
+        except TipyError as exception:
+            print(f'Error: {exception}\n')
+            return -1
+        return 0
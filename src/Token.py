@@ -56,8 +56,15 @@ class TokenType(Enum):
     NEWLINE = auto()  # Ignored by the scanner
     WHITESPACE = auto()
 
+    # Members are singletons, so hashing by identity is consistent with
+    # equality, and much cheaper than Enum's hash of the member name in the
+    # dictionaries keyed by this type
+    __hash__ = object.__hash__
+
 
 class Token:
+    __slots__ = ('lexeme', 'type', 'line')
+
     def __init__(self, lexeme: str, token_type: TokenType, where: int):
         self.lexeme = lexeme
         self.type = token_type
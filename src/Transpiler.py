@@ -0,0 +1,534 @@
+import math
+from types import CodeType
+from typing import *
+
+from Compiler import BINARY_OPS, BITWISE_OPS, OPERATORS, UNARY_OPS, OpCode
+from Error import *
+from Natives import NATIVES
+from Parser import ASTNode, NodeType
+from Resolver import GLOBAL, Resolver
+from Value import INTEGER_TYPES, NUMBER_TYPES, Closure, Native
+from VM import VM
+
+# Names in the generated code. Globals, locals and temporaries each get a
+# prefix, so that they cannot clash with one another or with the names the
+# generated code needs from its namespace, which are all upper case. Python
+# folds some non-ASCII identifiers into others (NFKC) where tipy does not, so
+# those are spelled out in hex under a prefix of their own.
+GLOBAL_PREFIX = 'G_'
+UNICODE_GLOBAL_PREFIX = 'H_'
+TEMPORARY_PREFIX = 'T'
+
+# The VM's opcodes, which its operator methods take, under their own names
+OPCODES = ['ADD', 'SUBTRACT', 'MODULO', 'MULTIPLY', 'DIVIDE', 'EQUALS', 'NOT_EQUALS', 'GREATER', 'GREATER_EQUALS',
+           'LESSER', 'LESSER_EQUALS', 'LEFT_SHIFT', 'RIGHT_SHIFT', 'BITOR', 'BITXOR', 'BITAND', 'NOT', 'NEGATE',
+           'BITNOT']
+
+# Python operator of each tipy operator, by the opcode the VM uses for it
+PYTHON_OPERATORS = {
+    OpCode.ADD: '+', OpCode.SUBTRACT: '-', OpCode.MODULO: '%', OpCode.MULTIPLY: '*', OpCode.DIVIDE: '/',
+    OpCode.EQUALS: '==', OpCode.NOT_EQUALS: '!=', OpCode.GREATER: '>', OpCode.GREATER_EQUALS: '>=',
+    OpCode.LESSER: '<', OpCode.LESSER_EQUALS: '<=', OpCode.LEFT_SHIFT: '<<', OpCode.RIGHT_SHIFT: '>>',
+    OpCode.BITOR: '|', OpCode.BITXOR: '^', OpCode.BITAND: '&',
+}
+COMPARISONS = [OpCode.EQUALS, OpCode.NOT_EQUALS, OpCode.GREATER, OpCode.GREATER_EQUALS, OpCode.LESSER,
+               OpCode.LESSER_EQUALS]
+
+# Which VM method handles an operator when its operands are not the plain
+# numbers (or integers) of its fast path
+SLOW_PATHS = {
+    NodeType.ADDITION: 'ARITHMETIC',
+    NodeType.MULTIPLICATION: 'MULTIPLICATION',
+    NodeType.COMPARISION: 'COMPARISON',
+    NodeType.EQUALITY: 'COMPARISON',
+    NodeType.BITSHIFT: 'BITWISE',
+    NodeType.BITOR: 'BITWISE',
+    NodeType.BITXOR: 'BITWISE',
+    NodeType.BITAND: 'BITWISE',
+}
+
+
+def mangle(name: str) -> str:
+    return name if name.isascii() else name.encode().hex()
+
+
+def global_name(name: str) -> str:
+    return (GLOBAL_PREFIX if name.isascii() else UNICODE_GLOBAL_PREFIX) + mangle(name)
+
+
+def unmangle(name: str) -> Optional[str]:
+    # The tipy name of a global in the generated code, None for other names
+    if name.startswith(GLOBAL_PREFIX):
+        return name[len(GLOBAL_PREFIX):]
+    elif name.startswith(UNICODE_GLOBAL_PREFIX):
+        return bytes.fromhex(name[len(UNICODE_GLOBAL_PREFIX):]).decode()
+    return None
+
+
+def literal(value: Any) -> str:
+    if type(value) is float and not math.isfinite(value):
+        return f"float('{value}')"
+    elif type(value) is int and value.bit_length() > 64:
+        # Decimal literals this long hit Python's limit on digits
+        return f'({hex(value)})'
+    return repr(value)
+
+
+class Atom:
+    # An operand in the generated code. 'stable' ones (literals and
+    # temporaries) keep their value for the rest of the statement, while a
+    # variable may be changed by a call evaluated after it.
+    __slots__ = ('text', 'stable', 'kind')
+
+    def __init__(self, text: str, stable: bool, kind: Optional[type] = None):
+        self.text = text
+        self.stable = stable
+        self.kind = kind  # the type of a literal, None when only known at runtime
+
+
+class FunctionContext:
+    def __init__(self, level: int, arity: int):
+        self.level = level  # how deeply the function is nested, 0 for the script
+        self.arity = arity
+        self.slots = dict()  # slot -> name of the variable, for the slots it declares
+        self.nonlocals = set()
+        self.globals = set()
+        self.temporaries = 0
+
+
+class Transpiler:
+    # Translates resolved statements into Python source, with a Python
+    # function for every tipy function and a Python variable for every slot.
+    # Operators get their fast path inline, and leave everything else,
+    # errors included, to the same methods of the VM that it would use.
+    def __init__(self):
+        self.resolver = Resolver()
+        self.function = None
+        self.functions = []  # contexts of the functions being transpiled, outermost first
+        self.lines = []
+        self.indent = 0
+
+    def emit(self, line: str) -> None:
+        self.lines.append('    ' * self.indent + line)
+
+    def temporary(self) -> str:
+        self.function.temporaries += 1
+        return f'{TEMPORARY_PREFIX}{self.function.temporaries}'
+
+    def slot(self, name: str, depth: int, slot: int) -> str:
+        level = self.function.level - depth
+        variable = f'L{level}_{slot}_{mangle(name)}'
+        # Declared by the function owning it, even if only inner ones use it
+        self.functions[level].slots[slot] = variable
+        return variable
+
+    def is_param(self, depth: int, slot: int) -> bool:
+        # Parameters are always assigned, so reading one needs no check
+        return depth == 0 and slot <= self.function.arity
+
+    def load(self, name: str, depth: int, slot: int, fallback: bool) -> Atom:
+        if depth == GLOBAL:
+            return Atom(global_name(name), False)
+        variable = self.slot(name, depth, slot)
+        if self.is_param(depth, slot):
+            return Atom(variable, False)
+        temporary = self.temporary()
+        self.emit(f'{temporary} = {variable} if {variable} is not None else LOAD({name!r}, {fallback})')
+        return Atom(temporary, True)
+
+    def store(self, name: str, depth: int, slot: int, fallback: bool, value: Union[Atom, str]) -> None:
+        if isinstance(value, Atom):
+            value = value.text
+        if depth == GLOBAL:
+            variable = global_name(name)
+            self.function.globals.add(variable)
+            self.emit(f'{variable} = {value}')
+            return
+        variable = self.slot(name, depth, slot)
+        if depth > 0:
+            self.function.nonlocals.add(variable)
+        if fallback:
+            # An empty fallback slot gives way to a global of the same name
+            key = global_name(name)
+            self.emit(f'if {variable} is None and {key!r} in NS:')
+            self.emit(f'    NS[{key!r}] = {value}')
+            self.emit('else:')
+            self.emit(f'    {variable} = {value}')
+        else:
+            self.emit(f'{variable} = {value}')
+
+    def atom(self, expr: ASTNode) -> Atom:
+        # Compiles an expression down to an operand, emitting whatever
+        # statements it takes
+        text = self.expr(expr)
+        if isinstance(text, Atom):
+            return text
+        temporary = self.temporary()
+        self.emit(f'{temporary} = {text}')
+        return Atom(temporary, True)
+
+    def simple(self, expr: ASTNode) -> bool:
+        # Whether compiling an expression emits no statements, so that
+        # operands before it cannot be changed by it
+        if expr.type == NodeType.NUMBER or expr.type == NodeType.STRING:
+            return True
+        elif expr.type == NodeType.IDENTIFIER:
+            return len(expr.children) > 1 and (expr.children[1] == GLOBAL or self.is_param(*expr.children[1:3]))
+        return False
+
+    def stabilize(self, atom: Atom) -> Atom:
+        if atom.stable:
+            return atom
+        temporary = self.temporary()
+        self.emit(f'{temporary} = {atom.text}')
+        return Atom(temporary, True)
+
+    def expr(self, expr: ASTNode, test: bool = False) -> Union[Atom, str]:
+        # Returns either an operand or the text of a Python expression. With
+        # 'test', the expression is only used for whether it is true, so a
+        # comparison can leave its result as a bool rather than 1 or 0.
+        if expr.type == NodeType.NUMBER or expr.type == NodeType.STRING:
+            return Atom(literal(expr.children[0]), True, type(expr.children[0]))
+        elif expr.type == NodeType.IDENTIFIER:
+            return self.load(*expr.children)
+        elif expr.type == NodeType.CALL:
+            return self.call(expr)
+        elif expr.type == NodeType.UNARY:
+            ops = []
+            while expr.type == NodeType.UNARY:
+                ops.append(UNARY_OPS[expr.children[0].type])
+                expr = expr.children[1]
+            operand = self.atom(expr)
+            text = None
+            for op in reversed(ops):
+                if text is not None:
+                    operand = self.stabilize(Atom(text, False))
+                text = self.unary(op, operand)
+            return text
+        else:
+            # Binary operators: the leftmost operand of a chain first, then
+            # each operator on the way back up, without recursing once per
+            # operator
+            spine = []
+            while expr.type in OPERATORS:
+                spine.append(expr)
+                expr = expr.children[-2]
+            left = self.atom(expr)
+            text = None
+            for expr in reversed(spine):
+                if text is not None:
+                    left = text if isinstance(text, Atom) else self.stabilize(Atom(text, False))
+                text = self.operator(expr, left, test and expr is spine[0])
+            return text
+
+    def unary(self, op: OpCode, operand: Atom) -> str:
+        x = operand.text
+        if op == OpCode.BITNOT:
+            kinds, check, fast = INTEGER_TYPES, f'type({x}) is int', f'~{x}'
+        else:
+            kinds, check, fast = NUMBER_TYPES, f'type({x}) in NUMBER', f'not {x}' if op == OpCode.NOT else f'-{x}'
+        slow = f'UNARY({op.name}, {x})'
+        if operand.kind is not None:
+            return f'({fast})' if operand.kind in kinds else slow
+        return f'({fast} if {check} else {slow})'
+
+    def operator(self, expr: ASTNode, left: Atom, test: bool = False) -> Union[Atom, str]:
+        # Compiles the rest of a binary operator, whose left operand is done.
+        # The operator itself runs inline while its operands are numbers (or
+        # integers, for the bitwise ones), and through the VM otherwise.
+        if expr.type == NodeType.LOGOR or expr.type == NodeType.LOGAND:
+            return self.logical(expr, left)
+        right_expr = expr.children[-1]
+        if not self.simple(right_expr):
+            left = self.stabilize(left)
+        right = self.atom(right_expr)
+
+        op = BITWISE_OPS[expr.type] if expr.type in BITWISE_OPS else BINARY_OPS[expr.children[0].type]
+        l, r = left.text, right.text
+        slow = f'{SLOW_PATHS[expr.type]}({op.name}, {l}, {r})'
+        integers = op in [OpCode.LEFT_SHIFT, OpCode.RIGHT_SHIFT, OpCode.BITOR, OpCode.BITXOR, OpCode.BITAND]
+
+        checks = []
+        for operand in [left, right]:
+            if operand.kind is None:
+                checks.append(f'type({operand.text}) is int' if integers else f'type({operand.text}) in NUMBER')
+            elif operand.kind not in (INTEGER_TYPES if integers else NUMBER_TYPES):
+                return slow
+        # Dividing by zero and shifting by a negative amount are errors
+        if op in [OpCode.MODULO, OpCode.DIVIDE, OpCode.LEFT_SHIFT, OpCode.RIGHT_SHIFT]:
+            value = right_expr.children[0] if right.kind is not None else None
+            if op == OpCode.MODULO or op == OpCode.DIVIDE:
+                if value is None:
+                    checks.append(r)
+                elif value == 0:
+                    return slow
+            elif value is None:
+                checks.append(f'{r} >= 0')
+            elif value < 0:
+                return slow
+
+        fast = f'{l} {PYTHON_OPERATORS[op]} {r}'
+        if op in COMPARISONS and not test:
+            fast = f'(1 if {fast} else 0)'
+        if not checks:
+            return f'({fast})'
+        return f'({fast} if {" and ".join(checks)} else {slow})'
+
+    def logical(self, expr: ASTNode, left: Atom) -> Union[Atom, str]:
+        # || gives 1 without evaluating its right operand when the left one
+        # is true, && gives 0 when it is false
+        short = '1' if expr.type == NodeType.LOGOR else '0'
+        test = left.text if expr.type == NodeType.LOGOR else f'not {left.text}'
+        right_expr = expr.children[1]
+        if self.simple(right_expr):
+            right = self.atom(right_expr)
+            return f'({short} if {test} else {right.text})'
+        result = self.temporary()
+        self.emit(f'if {test}:')
+        self.emit(f'    {result} = {short}')
+        self.emit('else:')
+        self.indent += 1
+        right = self.atom(right_expr)
+        self.emit(f'{result} = {right.text}')
+        self.indent -= 1
+        return Atom(result, True)
+
+    def call(self, expr: ASTNode) -> Union[Atom, str]:
+        callee, args = expr.children[0], expr.children[1:]
+        if callee.type == NodeType.IDENTIFIER and callee.children[0] == 'print' and callee.children[1] == GLOBAL:
+            # Each argument is printed as soon as it is evaluated, unless the
+            # script defined a print of its own
+            result = self.temporary()
+            self.emit(f'if {global_name("print")} is PRINT:')
+            self.indent += 1
+            for arg in args:
+                self.emit(f'print({self.atom(arg).text}, file=OUT)')
+            self.emit(f'{result} = 1')
+            self.indent -= 1
+            self.emit('else:')
+            self.indent += 1
+            self.emit(f'{result} = {self.invoke(callee, args)}')
+            self.indent -= 1
+            return Atom(result, True)
+        return self.invoke(callee, args)
+
+    def invoke(self, callee: ASTNode, args: List[ASTNode]) -> str:
+        function = self.temporary()
+        self.emit(f'{function} = {self.atom(callee).text}')
+        # Anything but a tipy function taking this many arguments is turned
+        # into one, or reported, before the arguments are evaluated
+        self.emit(f'if type({function}) is not Closure or {function}.arity != {len(args)}:')
+        self.emit(f'    {function} = CALLABLE({function}, {len(args)})')
+        values = []
+        for i, arg in enumerate(args):
+            value = self.atom(arg)
+            if not all(self.simple(later) for later in args[i + 1:]):
+                value = self.stabilize(value)
+            values.append(value.text)
+        return f'{function}.body({", ".join(values)})'
+
+    def condition(self, expr: ASTNode) -> str:
+        text = self.expr(expr, True)
+        return text.text if isinstance(text, Atom) else text
+
+    def block(self, stmts: List[ASTNode]) -> None:
+        self.indent += 1
+        start = len(self.lines)
+        for stmt in stmts:
+            self.stmt(stmt)
+        if len(self.lines) == start:
+            self.emit('pass')
+        self.indent -= 1
+
+    def stmts_of(self, stmt: ASTNode) -> List[ASTNode]:
+        return stmt.children if stmt.type == NodeType.BLOCK else [stmt]
+
+    def stmt(self, stmt: ASTNode) -> None:
+        if stmt.type == NodeType.BLOCK:
+            for inner in stmt.children:
+                self.stmt(inner)
+        elif stmt.type == NodeType.EXPR:
+            text = self.expr(stmt.children[0])
+            if not isinstance(text, Atom):
+                self.emit(text)
+            elif not text.stable:
+                # Reading a global that does not exist is still an error
+                self.emit(text.text)
+        elif stmt.type == NodeType.VAR:
+            name, init, depth, slot, fallback = stmt.children
+            value = self.atom(init) if fallback else self.expr(init)
+            self.store(name.lexeme, depth, slot, fallback, value)
+        elif stmt.type == NodeType.IF:
+            cond, then, otherwise = stmt.children
+            self.emit(f'if {self.condition(cond)}:')
+            self.block(self.stmts_of(then))
+            if otherwise is not None:
+                self.emit('else:')
+                self.block(self.stmts_of(otherwise))
+        elif stmt.type == NodeType.WHILE:
+            cond, body = stmt.children
+            start = len(self.lines)
+            self.indent += 1
+            test = self.condition(cond)
+            self.indent -= 1
+            if len(self.lines) == start:
+                self.emit(f'while {test}:')
+            else:
+                # The condition takes statements of its own
+                self.lines.insert(start, '    ' * self.indent + 'while True:')
+                self.emit(f'    if not {test}:')
+                self.emit('        break')
+            self.block(self.stmts_of(body))
+        elif stmt.type == NodeType.RETURN:
+            self.emit(f'return {self.atom(stmt.children[0]).text}')
+        elif stmt.type == NodeType.FUN:
+            self.fun_decl(stmt)
+
+    def fun_decl(self, stmt: ASTNode) -> None:
+        name, params, body = stmt.children[:3]
+        enclosing, lines, indent = self.function, self.lines, self.indent
+        self.function = FunctionContext(enclosing.level + 1, len(params))
+        self.functions.append(self.function)
+        self.lines, self.indent = [], 1
+        names = [self.slot(param.lexeme, 0, slot) for slot, param in enumerate(params, 1)]
+        for inner in body.children:
+            self.stmt(inner)
+        self.emit('return 0')
+        inner_lines = self.function_header(f'def F_{mangle(name.lexeme)}({", ".join(names)}):') + self.lines
+
+        self.functions.pop()
+        self.function, self.lines, self.indent = enclosing, lines, indent
+        for line in inner_lines:
+            self.emit(line)
+        function = f'Closure({name.lexeme!r}, {len(params)}, 0, F_{mangle(name.lexeme)}, None, False)'
+        if stmt.children[5]:
+            function = self.stabilize(Atom(function, False))
+        self.store(name.lexeme, *stmt.children[3:6], function)
+
+    def function_header(self, signature: str) -> List[str]:
+        # The def line, declarations, and the slots starting out empty
+        header = [signature]
+        if self.function.globals:
+            header.append(f'    global {", ".join(sorted(self.function.globals))}')
+        if self.function.nonlocals:
+            header.append(f'    nonlocal {", ".join(sorted(self.function.nonlocals))}')
+        empty = [variable for slot, variable in sorted(self.function.slots.items()) if slot > self.function.arity]
+        if empty:
+            header.append(f'    {" = ".join(empty)} = None')
+        return header
+
+    def script(self, stmts: List[ASTNode]) -> str:
+        # The whole module: a function holding the script, called right away
+        self.function = FunctionContext(0, 0)
+        self.functions = [self.function]
+        self.lines, self.indent = [], 1
+        for stmt in stmts:
+            self.stmt(stmt)
+        self.emit('return 0')
+        lines = self.function_header('def SCRIPT():') + self.lines + ['SCRIPT()', '']
+        return '\n'.join(lines)
+
+    def transpile(self, stmts: List[ASTNode]) -> str:
+        self.resolver.resolve(stmts)
+        return self.script(stmts)
+
+    def transpile_stream(self, stmts: Iterable[ASTNode]) -> Iterator[str]:
+        # One module per top-level statement, all meant to run in the same
+        # namespace
+        for stmt in stmts:
+            self.resolver.resolve([stmt])
+            yield self.script([stmt])
+
+    def compile(self, stmts: List[ASTNode], file_name: str = '<tipy>') -> CodeType:
+        return compile_source(self.transpile(stmts), file_name)
+
+
+def compile_source(source: str, file_name: str = '<tipy>') -> CodeType:
+    try:
+        return compile(source, file_name, 'exec')
+    except (SyntaxError, RecursionError, MemoryError):
+        # Python only allows so many levels of indentation and nesting
+        error('script is nested too deeply for the python engine')
+
+
+class PythonEngine:
+    # Runs transpiled code. Natives are handed this engine, as they are the
+    # Executor or the VM on the other engines.
+    def __init__(self, output: Optional[TextIO] = None):
+        self.output = output  # None prints to sys.stdout
+        operators = VM(output)
+        self.namespace = {
+            'OUT': output,
+            'NUMBER': NUMBER_TYPES,
+            'Closure': Closure,
+            'LOAD': self.load,
+            'CALLABLE': self.callable,
+            'PRINT': NATIVES['print'],
+            'ARITHMETIC': operators.arithmetic,
+            'MULTIPLICATION': operators.multiplication,
+            'COMPARISON': operators.comparison,
+            'BITWISE': operators.bitwise,
+            'UNARY': operators.unary,
+        }
+        self.namespace['NS'] = self.namespace
+        for name in OPCODES:
+            self.namespace[name] = OpCode[name].value
+        self.natives = dict()  # (native, arity) -> Closure calling it, see callable
+        for name, native in NATIVES.items():
+            self.define(name, native)
+
+    @property
+    def globals(self) -> Dict[str, Any]:
+        globals = dict()
+        for name, value in self.namespace.items():
+            name = unmangle(name)
+            if name is not None:
+                globals[name] = value
+        return globals
+
+    def define(self, name: str, value: Any) -> None:
+        self.namespace[global_name(name)] = value
+
+    def load(self, name: str, fallback: bool) -> Any:
+        # Reading a local that holds nothing: the global of the same name for
+        # a fallback slot, an error otherwise
+        if fallback and global_name(name) in self.namespace:
+            return self.namespace[global_name(name)]
+        error(f'{name}: no such variable in scope')
+
+    def callable(self, function: Any, arity: int) -> Closure:
+        # A Closure standing for a native, so that generated code calls every
+        # function the same way; anything else is an error
+        if type(function) is not Closure and type(function) is not Native:
+            error('cannot call a non-function')
+        elif function.arity is not None and function.arity != arity:
+            error(f'arity mismatch, expected {function.arity} arguments, got {arity}')
+        closure = self.natives.get((function, arity))
+        if closure is None:
+            closure = Closure(function.name, arity, 0, lambda *args: function.function(self, list(args)), None, False)
+            self.natives[(function, arity)] = closure
+        return closure
+
+    def apply(self, function: Any, args: List[Any]) -> Any:
+        # Calls a function with arguments that are already evaluated
+        if type(function) is not Closure or function.arity != len(args):
+            function = self.callable(function, len(args))
+        return function.body(*args)
+
+    def execute(self, code: CodeType) -> int:
+        try:
+            exec(code, self.namespace)
+        except NameError as exception:
+            # Generated code reads globals as Python globals
+            name = unmangle(getattr(exception, 'name', None) or '')
+            if name is None:
+                raise
+            error(f'{name}: no such variable in scope')
+        except RecursionError:
+            error('maximum recursion depth exceeded')
+        return 0
+
+    def execute_stream(self, codes: Iterable[CodeType]) -> int:
+        for code in codes:
+            self.execute(code)
+        return 0
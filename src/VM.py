@@ -0,0 +1,467 @@
+from typing import *
+
+from Compiler import CONST_OPERAND, GLOBAL_OPERAND, LOCAL_OPERAND, Code, OpCode
+from Error import *
+from Natives import NATIVES
+from Parser import NodeType
+from Resolver import GLOBAL
+from Value import (FUNCTION_TYPES, INTEGER_TYPES, MAX_POOLED_FRAMES, NUMBER_TYPES, STRING_TYPES, Array, Closure,
+                   Native, concat, kind)
+
+
+# Bind the opcodes to module globals, comparing plain ints in the dispatch
+# loop is noticeably cheaper than going through the IntEnum each time
+LOAD_CONST = OpCode.LOAD_CONST.value
+LOAD_LOCAL = OpCode.LOAD_LOCAL.value
+STORE_LOCAL = OpCode.STORE_LOCAL.value
+LOAD_GLOBAL = OpCode.LOAD_GLOBAL.value
+STORE_GLOBAL = OpCode.STORE_GLOBAL.value
+LOAD_REF = OpCode.LOAD_REF.value
+STORE_REF = OpCode.STORE_REF.value
+POP = OpCode.POP.value
+JUMP = OpCode.JUMP.value
+JUMP_IF_FALSE = OpCode.JUMP_IF_FALSE.value
+JUMP_IF_TRUE = OpCode.JUMP_IF_TRUE.value
+ADD = OpCode.ADD.value
+SUBTRACT = OpCode.SUBTRACT.value
+MODULO = OpCode.MODULO.value
+MULTIPLY = OpCode.MULTIPLY.value
+DIVIDE = OpCode.DIVIDE.value
+EQUALS = OpCode.EQUALS.value
+NOT_EQUALS = OpCode.NOT_EQUALS.value
+GREATER = OpCode.GREATER.value
+GREATER_EQUALS = OpCode.GREATER_EQUALS.value
+LESSER = OpCode.LESSER.value
+LESSER_EQUALS = OpCode.LESSER_EQUALS.value
+LEFT_SHIFT = OpCode.LEFT_SHIFT.value
+RIGHT_SHIFT = OpCode.RIGHT_SHIFT.value
+BITOR = OpCode.BITOR.value
+BITXOR = OpCode.BITXOR.value
+BITAND = OpCode.BITAND.value
+NOT = OpCode.NOT.value
+NEGATE = OpCode.NEGATE.value
+BITNOT = OpCode.BITNOT.value
+MAKE_FUNCTION = OpCode.MAKE_FUNCTION.value
+CALL = OpCode.CALL.value
+PRINT = OpCode.PRINT.value
+RETURN = OpCode.RETURN.value
+TAIL_CALL = OpCode.TAIL_CALL.value
+TEST_LOCAL = OpCode.TEST_LOCAL.value
+TEST_GLOBAL = OpCode.TEST_GLOBAL.value
+UPDATE_LOCAL = OpCode.UPDATE_LOCAL.value
+UPDATE_GLOBAL = OpCode.UPDATE_GLOBAL.value
+CHECK_CALL = OpCode.CHECK_CALL.value
+JUMP_IF_PRINT = OpCode.JUMP_IF_PRINT.value
+
+NATIVE_PRINT = NATIVES['print']
+
+
+class VM:
+    def __init__(self, output: Optional[TextIO] = None):
+        self.globals = dict(NATIVES)
+        self.output = output  # None prints to sys.stdout
+
+    def define(self, name: str, value: Any) -> None:
+        self.globals[name] = value
+
+    def load_ref(self, frame: List[Any], name: str, depth: int, slot: int, fallback: bool) -> Any:
+        for _ in range(depth):
+            frame = frame[0]
+        value = frame[slot]
+        if value is not None:
+            return value
+        elif fallback and name in self.globals:
+            return self.globals[name]
+        error(f'{name}: no such variable in scope')
+
+    def store_ref(self, frame: List[Any], name: str, depth: int, slot: int, fallback: bool, value: Any) -> None:
+        for _ in range(depth):
+            frame = frame[0]
+        if fallback and frame[slot] is None and name in self.globals:
+            self.globals[name] = value
+        else:
+            frame[slot] = value
+
+    def operand(self, code: Code, frame: List[Any], source: int, operand: Any) -> Any:
+        # An operand of a TEST or UPDATE, as LOAD_CONST, LOAD_LOCAL or
+        # LOAD_GLOBAL would push it
+        if source == CONST_OPERAND:
+            return operand
+        elif source == LOCAL_OPERAND:
+            value = frame[operand]
+            return value if value is not None else self.load_ref(frame, code.slot_names[operand], 0, operand, True)
+        elif operand not in self.globals:
+            error(f'{operand}: no such variable in scope')
+        return self.globals[operand]
+
+    def test(self, code: Code, frame: List[Any], target: int, operands: Tuple[Any, ...]) -> int:
+        # What a TEST stands for when either operand is not a plain number:
+        # loading both operands and comparing them
+        _, op, left, source, right = operands
+        left = self.operand(code, frame, target, left)
+        return self.comparison(op, left, self.operand(code, frame, source, right))
+
+    def update(self, code: Code, frame: List[Any], target: int, operands: Tuple[Any, ...]) -> None:
+        # What an UPDATE stands for when either operand is not a plain number
+        op, where, source, right = operands
+        left = self.operand(code, frame, target, where)
+        right = self.operand(code, frame, source, right)
+        if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+            value = left + right if op == ADD else left - right
+        else:
+            value = self.arithmetic(op, left, right)
+        if target == GLOBAL_OPERAND:
+            self.globals[where] = value
+        elif frame[where] is None:
+            self.store_ref(frame, code.slot_names[where], 0, where, True, value)
+        else:
+            frame[where] = value
+
+    def arithmetic(self, op: int, left: Any, right: Any) -> Any:
+        if op == MODULO and (type(left) not in NUMBER_TYPES or type(right) not in NUMBER_TYPES):
+            error('can only calculate remainders of numbers')
+        if kind(left) != kind(right):
+            error(
+                f'cannot {"add" if op == ADD else "subtract"} instances of {kind(left)} and {kind(right)}')
+        elif type(left) in FUNCTION_TYPES:
+            error('cannot do arithmetic on functions')
+        elif type(left) is Array:
+            error('cannot do arithmetic on arrays')
+        elif op == ADD:
+            return concat(left, right)
+        elif type(left) in STRING_TYPES:
+            error('can only subtract numbers')
+        elif op == SUBTRACT:
+            return left - right
+        elif right == 0:
+            error('cannot divide by zero')
+        else:
+            return left % right
+
+    def multiplication(self, op: int, left: Any, right: Any) -> Any:
+        if type(left) not in NUMBER_TYPES or type(right) not in NUMBER_TYPES:
+            error('can only multiply or divide numbers')
+        elif op == MULTIPLY:
+            return left * right
+        elif right == 0:
+            error('cannot divide by zero')
+        else:
+            return left / right
+
+    def comparison(self, op: int, left: Any, right: Any) -> int:
+        if type(left) in FUNCTION_TYPES or type(right) in FUNCTION_TYPES:
+            error('cannot compare functions')
+        elif type(left) is Array or type(right) is Array:
+            error('cannot compare arrays')
+
+        if kind(left) != kind(right):
+            error('cannot compare unequal types')
+        elif op == EQUALS:
+            return int(left == right)
+        elif op == NOT_EQUALS:
+            return int(left != right)
+        elif op == GREATER:
+            return int(left > right)
+        elif op == GREATER_EQUALS:
+            return int(left >= right)
+        elif op == LESSER:
+            return int(left < right)
+        else:
+            return int(left <= right)
+
+    def bitwise(self, op: int, left: Any, right: Any) -> Any:
+        if op == LEFT_SHIFT or op == RIGHT_SHIFT:
+            if type(left) in FUNCTION_TYPES or type(right) in FUNCTION_TYPES:
+                error('cannot bitshift functions')
+            if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+                error('can only bitshift integers')
+            elif right < 0:
+                error('cannot shift by a negative amount')
+            elif op == LEFT_SHIFT:
+                return int(left << right)
+            else:
+                return int(left >> right)
+
+        name = {BITOR: 'or', BITXOR: 'xor', BITAND: 'and'}[op]
+        if type(left) not in INTEGER_TYPES or type(right) not in INTEGER_TYPES:
+            error(f'can only perform bitwise {name} on integers')
+        elif op == BITOR:
+            return left | right
+        elif op == BITXOR:
+            return left ^ right
+        else:
+            return left & right
+
+    def unary(self, op: int, operand: Any) -> Any:
+        lexeme = {NOT: '!', NEGATE: '-', BITNOT: '~'}[op]
+        if type(operand) in FUNCTION_TYPES:
+            error(f'cannot use "{lexeme}" on functions')
+
+        if op == NOT:
+            return not operand
+        elif type(operand) not in NUMBER_TYPES:
+            error(f'can only use "{lexeme}" on numbers')
+        elif op == NEGATE:
+            return -operand
+        elif type(operand) not in INTEGER_TYPES:
+            error(f'can only use "{lexeme}" on integers')
+        else:
+            return ~operand
+
+    @staticmethod
+    def check_call(function: Any, arity: int) -> None:
+        if type(function) is not Closure and type(function) is not Native:
+            error('cannot call a non-function')
+        if function.arity is not None and function.arity != arity:
+            error(
+                f'arity mismatch, expected {function.arity} arguments, got {arity}')
+
+    def apply(self, function: Any, args: List[Any]) -> Any:
+        # Calls a function with arguments that are already evaluated
+        self.check_call(function, len(args))
+        if type(function) is Native:
+            return function.function(self, args)
+        frame = function.new_frame()
+        frame[1:len(args) + 1] = args
+        # A frame is only released when the call returns normally, one left
+        # behind by an error is simply never reused
+        value = self.run(function.body, frame)
+        function.release(frame)
+        return value
+
+    def run(self, code: Code, frame: List[Any]) -> Any:
+        # Without a time slice, steps never suspends and runs to the end
+        try:
+            next(self.steps(code, frame))
+        except StopIteration as stop:
+            return stop.value
+
+    def steps(self, code: Code, frame: List[Any], slice: int = 0) -> Generator[Optional[Awaitable[Any]], Any, Any]:
+        # Runs code as a generator that can suspend in between instructions,
+        # returning what the code returned. Given a time slice, it yields None
+        # after every 'slice' jumps and calls, and yields the awaitable of an
+        # async builtin to be sent its result (see AsyncVM).
+        # Calls do not recurse into steps: the caller's state is saved on
+        # 'calls' and the loop carries on with the callee, so the depth of
+        # tipy recursion is not limited by the Python stack
+        budget = slice  # jumps and calls left, below zero without a slice
+        calls = []  # (code, frame, pc, stack, function) of each caller
+        function = None  # closure of the running code, None for 'code' itself
+        ops = code.ops
+        consts = code.consts
+        names = code.names
+        refs = code.refs
+        operands = code.operands
+        globals = self.globals
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        pc = 0
+
+        while True:
+            op = ops[pc]
+            arg = ops[pc + 1]
+            pc += 2
+
+            if op == LOAD_LOCAL:
+                value = frame[arg]
+                if value is None:
+                    value = self.load_ref(frame, code.slot_names[arg], 0, arg, True)
+                push(value)
+            elif op == LOAD_CONST:
+                push(consts[arg])
+            elif op == LOAD_GLOBAL:
+                name = names[arg]
+                if name not in globals:
+                    error(f'{name}: no such variable in scope')
+                push(globals[name])
+            elif op == STORE_LOCAL:
+                if frame[arg] is None:
+                    self.store_ref(frame, code.slot_names[arg], 0, arg, True, pop())
+                else:
+                    frame[arg] = pop()
+            elif op == STORE_GLOBAL:
+                globals[names[arg]] = pop()
+            elif op == JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+                budget -= 1
+                if budget == 0:
+                    budget = slice
+                    yield None
+            elif op == JUMP_IF_PRINT:
+                if globals.get('print') is NATIVE_PRINT:
+                    pc = arg
+            elif op == TEST_LOCAL or op == TEST_GLOBAL:
+                # Always followed by the JUMP_IF_FALSE of the condition,
+                # which is skipped when the comparison holds
+                test, _, left, source, right = operands[arg]
+                left = frame[left] if op == TEST_LOCAL else globals.get(left)
+                if source == LOCAL_OPERAND:
+                    right = frame[right]
+                elif source == GLOBAL_OPERAND:
+                    right = globals.get(right)
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    if test(left, right):
+                        pc += 2
+                    else:
+                        pc = ops[pc + 1]
+                else:
+                    push(self.test(code, frame, LOCAL_OPERAND if op == TEST_LOCAL else GLOBAL_OPERAND, operands[arg]))
+            elif op == UPDATE_LOCAL:
+                update, slot, source, right = operands[arg]
+                left = frame[slot]
+                if source == LOCAL_OPERAND:
+                    right = frame[right]
+                elif source == GLOBAL_OPERAND:
+                    right = globals.get(right)
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    frame[slot] = left + right if update == ADD else left - right
+                else:
+                    self.update(code, frame, LOCAL_OPERAND, operands[arg])
+            elif op == UPDATE_GLOBAL:
+                update, name, source, right = operands[arg]
+                left = globals.get(name)
+                if source == LOCAL_OPERAND:
+                    right = frame[right]
+                elif source == GLOBAL_OPERAND:
+                    right = globals.get(right)
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    globals[name] = left + right if update == ADD else left - right
+                else:
+                    self.update(code, frame, GLOBAL_OPERAND, operands[arg])
+            elif op == LESSER:
+                right = pop()
+                left = pop()
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    push(int(left < right))
+                else:
+                    push(self.comparison(op, left, right))
+            elif op == ADD:
+                right = pop()
+                left = pop()
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    push(left + right)
+                else:
+                    push(self.arithmetic(op, left, right))
+            elif op == SUBTRACT:
+                right = pop()
+                left = pop()
+                if type(left) in NUMBER_TYPES and type(right) in NUMBER_TYPES:
+                    push(left - right)
+                else:
+                    push(self.arithmetic(op, left, right))
+            elif op == POP:
+                pop()
+            elif op == LOAD_REF:
+                push(self.load_ref(frame, *refs[arg]))
+            elif op == STORE_REF:
+                self.store_ref(frame, *refs[arg], pop())
+            elif op == CHECK_CALL:
+                callee = stack[-1]
+                if type(callee) is not Closure or callee.arity != arg:
+                    self.check_call(callee, arg)
+            elif op == CALL or op == TAIL_CALL:
+                if arg:
+                    args = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    args = []
+                callee = pop()
+                if type(callee) is not Closure or callee.arity != arg:
+                    # Natives run right away, anything else reports the
+                    # error. A tail call is followed by a RETURN, which
+                    # returns what a native pushed.
+                    if slice and type(callee) is Native and callee.coroutine is not None and callee.arity == arg:
+                        push((yield callee.coroutine(self, args)))
+                    else:
+                        push(self.apply(callee, args))
+                    continue
+                pool = callee.pool
+                callee_frame = pool.pop() if pool else [None] * callee.frame_size
+                callee_frame[0] = callee.frame
+                callee_frame[1:arg + 1] = args
+                if op == CALL:
+                    calls.append((code, frame, pc, stack, function))
+                    stack = []
+                    push = stack.append
+                    pop = stack.pop
+                elif function is not None and function.pooled and len(function.pool) < MAX_POOLED_FRAMES:
+                    # A tail call is done with the current frame
+                    frame[:] = function.blank
+                    function.pool.append(frame)
+                function = callee
+                frame = callee_frame
+                code = callee.body
+                ops = code.ops
+                consts = code.consts
+                names = code.names
+                refs = code.refs
+                operands = code.operands
+                pc = 0
+                budget -= 1
+                if budget == 0:
+                    budget = slice
+                    yield None
+            elif op == RETURN:
+                value = pop()
+                if not calls:
+                    return value
+                if function.pooled and len(function.pool) < MAX_POOLED_FRAMES:
+                    frame[:] = function.blank
+                    function.pool.append(frame)
+                code, frame, pc, stack, function = calls.pop()
+                ops = code.ops
+                consts = code.consts
+                names = code.names
+                refs = code.refs
+                operands = code.operands
+                push = stack.append
+                pop = stack.pop
+                push(value)
+            elif op == PRINT:
+                if arg:
+                    for value in stack[-arg:]:
+                        print(value, file=self.output)
+                    del stack[-arg:]
+                push(1)
+            elif op == JUMP_IF_TRUE:
+                if pop():
+                    pc = arg
+            elif op == MODULO:
+                right = pop()
+                left = pop()
+                if type(left) is int and type(right) is int and right:
+                    push(left % right)
+                else:
+                    push(self.arithmetic(op, left, right))
+            elif op == MULTIPLY or op == DIVIDE:
+                right = pop()
+                push(self.multiplication(op, pop(), right))
+            elif EQUALS <= op <= LESSER_EQUALS:
+                right = pop()
+                push(self.comparison(op, pop(), right))
+            elif LEFT_SHIFT <= op <= BITAND:
+                right = pop()
+                push(self.bitwise(op, pop(), right))
+            elif NOT <= op <= BITNOT:
+                push(self.unary(op, pop()))
+            elif op == MAKE_FUNCTION:
+                body = consts[arg]
+                push(Closure(body.name, len(body.params),
+                             body.frame_size, body, frame, not body.captured))
+            else:
+                error(f'unknown opcode {op}')
+
+    def execute(self, code: Code) -> int:
+        self.run(code, [None] * code.frame_size)
+        return 0
+
+    def execute_stream(self, codes: Iterable[Code]) -> int:
+        frame = [None]
+        for code in codes:
+            frame.extend([None] * (code.frame_size - len(frame)))
+            self.run(code, frame)
+        return 0
@@ -0,0 +1,177 @@
+from array import array
+from typing import *
+
+from Parser import NodeType
+
+# Runtime values are plain Python objects: int/float/bool for numbers, str for
+# strings, Closure for functions, Native for builtins and Array for arrays.
+# Literals without a decimal point are ints, and arithmetic on ints stays
+# exact until a float or '/' gets involved. Comparisons produce ints and '!'
+# produces a bool, all of which count as numbers; only ints and bools are
+# integers for the bitwise operators.
+NUMBER_TYPES = (int, float, bool)
+INTEGER_TYPES = (int, bool)
+
+
+# Most frames a function keeps around for reuse
+MAX_POOLED_FRAMES = 16
+
+# Concatenations shorter than this make a plain str, which is cheaper than a
+# Rope while copying is cheap
+MIN_ROPE_LENGTH = 64
+
+
+class Closure:
+    __slots__ = ('name', 'arity', 'frame_size', 'body', 'frame', 'pooled', 'pool', 'blank', 'pure', 'misses')
+
+    def __init__(self, name: str, arity: int, frame_size: int, body: Any, frame: List[Any], pooled: bool,
+                 pure: Optional[Tuple[str, ...]] = None):
+        self.name = name
+        self.arity = arity
+        self.frame_size = frame_size
+        self.body = body  # statements for Executor, Code for the VM
+        self.frame = frame
+        # A function that declares no nested functions cannot have its frame
+        # captured, so its frames are recycled once a call returns
+        self.pooled = pooled
+        self.pool = []
+        self.blank = (None,) * frame_size
+        # Names of the fallback slots of a function whose results can be
+        # memoized, None for any other function (see Resolver)
+        self.pure = pure
+        self.misses = 0  # memoized calls in a row that missed
+
+    def new_frame(self) -> List[Any]:
+        frame = self.pool.pop() if self.pool else [None] * self.frame_size
+        frame[0] = self.frame
+        return frame
+
+    def release(self, frame: List[Any]) -> None:
+        if self.pooled and len(self.pool) < MAX_POOLED_FRAMES:
+            frame[:] = self.blank
+            self.pool.append(frame)
+
+    def __str__(self) -> str:
+        return f'<fun {self.name}>'
+
+
+class Native:
+    # A builtin function implemented in Python (see Natives). 'function' is
+    # called with the engine running the call, so that it can call back into
+    # tipy functions, and the list of arguments. Builtins that wait on
+    # something also have a 'coroutine' doing the same work without blocking,
+    # which the AsyncVM awaits instead (see Scheduler).
+    __slots__ = ('name', 'arity', 'function', 'coroutine')
+
+    def __init__(self, name: str, arity: Optional[int], function: Callable[[Any, List[Any]], Any],
+                 coroutine: Optional[Callable[[Any, List[Any]], Awaitable[Any]]] = None):
+        self.name = name
+        self.arity = arity  # None takes any number of arguments
+        self.function = function
+        self.coroutine = coroutine
+
+    def __str__(self) -> str:
+        return f'<native fun {self.name}>'
+
+
+class Array:
+    # A fixed length array of numbers, stored unboxed: as 64 bit integers
+    # while every element is an integer, as doubles once any is a float.
+    # Arrays are mutable, and like functions only ever equal to themselves.
+    __slots__ = ('values',)
+
+    def __init__(self, values: array):
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __str__(self) -> str:
+        return '[' + ', '.join(map(str, self.values)) + ']'
+
+
+class Rope:
+    # A string built by concatenation, kept as its pieces until something
+    # needs the whole text. Ropes built from one another share a single list
+    # of pieces, of which each rope uses the first 'count'. Appending to the
+    # rope that owns the end of the list just appends to it, so that a loop
+    # like s = s + 'x' takes linear rather than quadratic time, while any
+    # other rope that still uses the list is unaffected.
+    __slots__ = ('parts', 'count', 'length', 'flat')
+
+    def __init__(self, parts: List[str], count: int, length: int):
+        self.parts = parts
+        self.count = count
+        self.length = length
+        self.flat = None
+
+    def append(self, text: str) -> 'Rope':
+        parts = self.parts
+        if len(parts) != self.count:
+            # Someone else appended to this rope already
+            parts = parts[:self.count]
+        parts.append(text)
+        return Rope(parts, self.count + 1, self.length + len(text))
+
+    def __str__(self) -> str:
+        if self.flat is None:
+            self.flat = ''.join(self.parts[:self.count])
+        return self.flat
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+    def __eq__(self, other: Any) -> bool:
+        return str(self) == str(other) if type(other) in STRING_TYPES else NotImplemented
+
+    def __ne__(self, other: Any) -> bool:
+        return str(self) != str(other) if type(other) in STRING_TYPES else NotImplemented
+
+    def __lt__(self, other: Any) -> bool:
+        return str(self) < str(other)
+
+    def __le__(self, other: Any) -> bool:
+        return str(self) <= str(other)
+
+    def __gt__(self, other: Any) -> bool:
+        return str(self) > str(other)
+
+    def __ge__(self, other: Any) -> bool:
+        return str(self) >= str(other)
+
+
+STRING_TYPES = (str, Rope)
+FUNCTION_TYPES = (Closure, Native)
+
+
+def concat(left: Any, right: Any) -> Any:
+    # Adds two strings, either of which may be a Rope
+    if type(right) is Rope:
+        right = str(right)
+    if type(left) is Rope:
+        return left.append(right)
+    elif len(left) + len(right) < MIN_ROPE_LENGTH:
+        return left + right
+    return Rope([left, right], 2, len(left) + len(right))
+
+
+def kind(value: Any) -> NodeType:
+    if type(value) in STRING_TYPES:
+        return NodeType.STRING
+    elif type(value) in FUNCTION_TYPES:
+        return NodeType.FUNCTION
+    elif type(value) is Array:
+        return NodeType.ARRAY
+    else:
+        return NodeType.NUMBER
+
+
+def constant_key(value: Any) -> Tuple[type, Any]:
+    # Tells apart constants that compare equal but are not the same: 1.0 and
+    # True by their type, and -0.0 and 0.0 by their repr
+    if type(value) is float:
+        return float, repr(value)
+    return type(value), value
@@ -0,0 +1,3 @@
+# Bumped whenever the scanner, parser, AST layout or generated code changes,
+# which also invalidates every cached .tic file
+VERSION = '0.3.2'
@@ -0,0 +1,62 @@
+import os
+import socket
+import struct
+import sys
+
+# The protocol spoken with the server started by 'main.py --serve', see
+# Server.py. Only what is needed to talk to it is imported here, so that the
+# client starts as fast as Python can.
+LENGTH = struct.Struct('<I')
+FRAME = struct.Struct('<cI')
+STATUS = struct.Struct('<i')
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+
+
+def receive(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def main(argv):
+    if len(argv) < 2:
+        print('usage: client.py SOCKET script.ti [options]', file=sys.stderr)
+        return 2
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(argv[0])
+    except OSError as exception:
+        print(f'client.py: unable to connect to {argv[0]}: {exception.strerror}', file=sys.stderr)
+        return 1
+
+    terminal = '1' if sys.stdout.isatty() else '0'
+    request = '\0'.join([terminal, os.getcwd()] + argv[1:]).encode()
+    connection.sendall(LENGTH.pack(len(request)) + request)
+
+    streams = {STDOUT: sys.stdout.buffer, STDERR: sys.stderr.buffer}
+    while True:
+        header = receive(connection, FRAME.size)
+        if header is None:
+            break
+        kind, length = FRAME.unpack(header)
+        data = receive(connection, length)
+        if data is None:
+            break
+        if kind == EXIT:
+            return STATUS.unpack(data)[0]
+        stream = streams[kind]
+        stream.write(data)
+        stream.flush()
+    print('client.py: the server closed the connection before the script finished', file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
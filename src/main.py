@@ -1,33 +1,289 @@
+import argparse
+import contextlib
+import io
+import os
 import sys
 from typing import *
 
+from Batch import CRASHED, ERROR, OK, TIMEOUT, find_scripts, run_batch
+from Cache import Cache
+from Compiler import Compiler
 from Error import *
-from Executor import Executor
+from Executor import MEMO_SIZE, Executor
+from Incremental import Session, complete
+from Optimizer import LEVELS, Optimizer
 from Parser import Parser
-from Scanner import Scanner
+from Profiler import ProfilingExecutor
+from Scanner import FastScanner
+from Server import Server
+from Transpiler import PythonEngine, Transpiler, compile_source
+from VM import VM
 
 
-def main():
-    if len(sys.argv) != 2:
-        error('Need only file name')
+def argument_parser() -> argparse.ArgumentParser:
+    arg_parser = argparse.ArgumentParser(
+        description='tipy - Tiny Interpreter in Python')
+    arg_parser.add_argument('file', nargs='?', help='script to run, ending in .ti')
+    arg_parser.add_argument('--engine', choices=['tree', 'vm', 'python'], default='tree',
+                            help='walk the AST directly (tree), compile to bytecode first (vm) '
+                                 'or translate to Python (python)')
+    arg_parser.add_argument('--disassemble', action='store_true',
+                            help='print the compiled bytecode instead of running it (vm only)')
+    arg_parser.add_argument('--dump-py', action='store_true',
+                            help='print the generated Python instead of running it (python only)')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='run each top-level declaration as soon as it is parsed')
+    arg_parser.add_argument('-O', dest='level', type=int, choices=sorted(LEVELS), default=0,
+                            help='optimization level: 1 folds constants, 2 also prunes constant branches and unreachable code')
+    arg_parser.add_argument('--opt-report', action='store_true',
+                            help='print what the optimizer changed to stderr')
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help='always parse the script instead of using its cached copy in __tipycache__')
+    arg_parser.add_argument('--cache-stats', action='store_true',
+                            help='print hits and misses of the parse cache and, on the tree engine, '
+                                 'of the inline caches to stderr')
+    arg_parser.add_argument('--no-memo', action='store_true',
+                            help='never reuse the results of pure functions (tree engine)')
+    arg_parser.add_argument('--memo-size', type=int, default=MEMO_SIZE,
+                            help=f'results of pure functions to keep (default: {MEMO_SIZE})')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='report time per function and statements run per line to stderr (tree engine)')
+    arg_parser.add_argument('--profile-output', metavar='FILE',
+                            help='where --profile writes collapsed stacks for flamegraph tools '
+                                 '(default: the script name with .folded)')
+    arg_parser.add_argument('--batch', metavar='DIR',
+                            help='run every .ti script under DIR in worker processes, instead of a single file')
+    arg_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='worker processes for --batch (default: one per core)')
+    arg_parser.add_argument('--timeout', type=float, default=60.0,
+                            help='seconds a --batch script may run before it is stopped (default: 60, 0 for no limit)')
+    arg_parser.add_argument('--repl', action='store_true',
+                            help='read and run code interactively, after running the script if one is given')
+    arg_parser.add_argument('--serve', metavar='SOCKET',
+                            help='keep running as a server for client.py, listening on the Unix socket SOCKET')
+    return arg_parser
 
-    file_name = sys.argv[1]
 
+def main(argv: Optional[List[str]] = None) -> int:
+    args = argument_parser().parse_args(argv)
+
+    if args.serve is not None:
+        if args.file is not None or args.batch is not None:
+            error('--serve runs the scripts sent by clients, pass no script')
+        return Server(args.serve, run_command, simple_run).serve_forever()
+
+    if args.batch is not None:
+        if args.file is not None:
+            error('--batch runs a directory instead of a file, pass only one')
+        elif args.disassemble or args.dump_py or args.stream or args.profile:
+            error('--batch cannot be combined with --disassemble, --dump-py, --stream or --profile')
+        elif args.jobs < 1:
+            error('--jobs must be at least 1')
+        return run_batch_mode(args)
+
+    if args.repl:
+        if args.engine != 'tree' or args.disassemble or args.dump_py or args.stream or args.profile:
+            error('--repl only works with the tree engine')
+        elif args.file is not None and not args.file.endswith('.ti'):
+            error('File extension not recognized')
+        return run_repl(args)
+
+    # Reports asked for on the command line, printed once the script is done
+    # even if it ends in an error
+    reports = []
+    try:
+        return run_file(args, reports)
+    finally:
+        for report in reversed(reports):
+            report()
+
+
+def run_file(args: argparse.Namespace, reports: List[Callable[[], None]]) -> int:
+    file_name = args.file
+
+    if file_name is None:
+        error('No script given')
     if not file_name.endswith('.ti'):
         error('File extension not recognized')
+    if args.profile and (args.engine != 'tree' or args.disassemble or args.dump_py):
+        error('--profile only works with the tree engine')
+    elif args.disassemble and args.dump_py:
+        error('--disassemble and --dump-py cannot be combined')
+    if args.dump_py:
+        args.engine = 'python'
 
-    file = open(file_name, 'rt')
-
-    if not file:
+    try:
+        file = open(file_name, 'rt')
+    except OSError:
         error('Unable to open file')
 
-    scanner = Scanner()
-    tokens = scanner.scan(file)
+    memo_size = 0 if args.no_memo else args.memo_size
+    scanner = FastScanner()
     parser = Parser()
-    parser.parse(tokens)
-    executor = Executor()
-    return executor.execute(parser.parse(tokens))
+    optimizer = Optimizer(LEVELS[args.level])
+    if args.opt_report:
+        reports.append(lambda: print(optimizer.report(), file=sys.stderr))
+
+    if args.stream and not args.disassemble and not args.dump_py and not args.profile:
+        stmts = optimizer.optimize_stream(
+            parser.parse_stream(scanner.stream(file)))
+        if args.engine == 'vm':
+            return VM().execute_stream(Compiler().compile_stream(stmts))
+        elif args.engine == 'python':
+            modules = Transpiler().transpile_stream(stmts)
+            return PythonEngine().execute_stream(compile_source(module) for module in modules)
+        executor = Executor(memo_size=memo_size)
+        if args.cache_stats:
+            reports.append(lambda: print(executor.cache_report(), file=sys.stderr))
+        return executor.execute(stmts)
+
+    source = file.read()
+    cache = Cache(not args.no_cache)
+    if args.cache_stats:
+        reports.append(lambda: print(cache.report(), file=sys.stderr))
+    if args.engine == 'python' and not args.dump_py:
+        # The transpiled code is cached as well, skipping the parse entirely
+        code = cache.get_code(file_name, source.encode(), args.level)
+        if code is not None:
+            return PythonEngine().execute(code)
+    ast = cache.get(file_name, source.encode())
+    if ast is None:
+        ast = parser.parse(scanner.scan_source(source))
+        cache.put(file_name, source.encode(), ast)
+    ast = optimizer.optimize(ast)
+
+    if args.engine == 'vm' or args.disassemble:
+        code = Compiler().compile(ast)
+        if args.disassemble:
+            print(code.disassemble())
+            return 0
+        return VM().execute(code)
+    elif args.engine == 'python':
+        module = Transpiler().transpile(ast)
+        if args.dump_py:
+            print(module)
+            return 0
+        code = compile_source(module, file_name)
+        cache.put_code(file_name, source.encode(), args.level, code)
+        return PythonEngine().execute(code)
+
+    executor = ProfilingExecutor(memo_size) if args.profile else Executor(memo_size=memo_size)
+    if args.cache_stats:
+        reports.append(lambda: print(executor.cache_report(), file=sys.stderr))
+    if args.profile:
+        output = args.profile_output or file_name[:-len('.ti')] + '.folded'
+        reports.append(lambda: write_profile(executor, source, output))
+    return executor.execute(ast)
+
+
+def run_repl(args: argparse.Namespace) -> int:
+    try:
+        # Line editing and history where Python has them
+        import readline
+    except ImportError:
+        pass
+
+    session = Session(level=args.level, memo_size=0 if args.no_memo else args.memo_size)
+    script = args.file
+    lines = []
+    command = f':load {script}' if script is not None else None
+    while True:
+        if command is None:
+            try:
+                line = input('... ' if lines else '>>> ')
+            except EOFError:
+                print()
+                return 0
+            except KeyboardInterrupt:
+                print()
+                lines = []
+                continue
+            if not lines and line.startswith(':'):
+                command = line
+                continue
+            lines.append(line)
+            if not complete('\n'.join(lines)):
+                continue
+
+        try:
+            if command is not None:
+                # ':load FILE' runs a script, and ':reload' runs what changed
+                # in it since, as the rest of the session may depend on it
+                words = command.split(maxsplit=1)
+                command = None
+                if words[0] == ':load' and len(words) == 2:
+                    script = words[1]
+                elif words != [':reload']:
+                    error('commands are :load FILE and :reload')
+                elif script is None:
+                    error('no script loaded')
+                try:
+                    with open(script, 'rt') as file:
+                        source = file.read()
+                except OSError:
+                    error(f'Unable to open {script}')
+                ran = session.update(source, os.path.abspath(script))
+                print(f'{script}: {ran} declarations run', file=sys.stderr)
+            else:
+                source = '\n'.join(lines)
+                lines = []
+                session.run(source)
+        except TipyError as exception:
+            print(f'Error: {exception}')
+        except KeyboardInterrupt:
+            print('\ninterrupted')
+
+
+def run_batch_mode(args: argparse.Namespace) -> int:
+    scripts = find_scripts(args.batch)
+    counts = {outcome: 0 for outcome in [OK, ERROR, TIMEOUT, CRASHED]}
+    for result in run_batch(scripts, args.jobs, args.timeout or None, args.engine, args.level, not args.no_cache):
+        counts[result.outcome] += 1
+        print(f'==> {result.file_name}: {result.outcome}, exit status {result.status} ({result.elapsed:.3f}s)')
+        print(result.output, end='', flush=True)
+    print(f'{len(scripts)} scripts: ' + ', '.join(f'{count} {outcome}' for outcome, count in counts.items()),
+          file=sys.stderr)
+    return 0 if counts[OK] == len(scripts) else 1
+
+
+def write_profile(executor: ProfilingExecutor, source: str, output: str) -> None:
+    executor.finish()
+    print(executor.report(source.splitlines()), file=sys.stderr)
+    try:
+        with open(output, 'wt') as file:
+            file.write(executor.collapsed())
+    except OSError:
+        print(f'Unable to write {output}', file=sys.stderr)
+        return
+    print(f'\ncollapsed stacks written to {output}', file=sys.stderr)
+
+
+def run_command(argv: Optional[List[str]] = None) -> int:
+    try:
+        return main(argv)
+    except TipyError as exception:
+        print(f'Error: {exception}\n')
+        return -1
+    except RecursionError:
+        # Deep recursion on the tree walker runs out of Python stack
+        print('Error: maximum recursion depth exceeded\n')
+        return -1
+
+
+def simple_run(argv: List[str]) -> Optional[Tuple[str, str, int]]:
+    # The script, engine and optimization level of a command line that does
+    # nothing but run a script with default settings, None for any other
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            args = argument_parser().parse_args(argv)
+    except SystemExit:
+        return None
+    if args.file is None or not args.file.endswith('.ti') or args.batch is not None or args.serve is not None or args.repl \
+            or args.disassemble or args.dump_py or args.stream or args.opt_report or args.cache_stats \
+            or args.profile or args.no_memo or args.memo_size != MEMO_SIZE:
+        return None
+    return args.file, args.engine, args.level
 
 
 if __name__ == '__main__':
-    exit(main())
+    exit(run_command())